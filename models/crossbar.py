@@ -0,0 +1,136 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class CrossbarEngine(object):
+    '''
+    Tiled crossbar simulator for hard_mode='vmm', used as the hard_weight of NoiseConv/NoiseConv1d.
+
+    Every weight is a differential pair of conductances, W = pos - neg, as produced by
+    utility.utils.cond2weight. The [out, in] matrix of a layer is split into arrays of
+    tile = (rows, cols) cells: the inputs drive the rows of an array, the outputs are read
+    from its columns. On a read, the pos and neg arrays each see their own multiplicative
+    read noise, the differential column current of every array goes through an ADC of
+    adc_bits bits, and the digital partial sums of the row tiles are added up.
+
+    The ADC full scale of an array is the largest differential current any binary input can
+    produce on its columns, so a noise-free read is never clipped; adc_range overrides it.
+    All arrays of a layer and all input vectors of a chunk are evaluated with one batched
+    matmul per pos/neg, and the read noise is drawn on the column currents (see read).
+
+    Usage:
+        crossbar = CrossbarEngine(tile=(64, 64), read_noise=0.05, adc_bits=8)
+        model = get_model(..., hard_mode='vmm', hardweight=crossbar)
+        model, cond_dict = utils.replace_model_weight(model, sparsity)
+        crossbar.load(model, cond_dict)
+    '''
+    def __init__(self, tile=(64, 64), read_noise=0., adc_bits=None, adc_range=None):
+        self.rows, self.cols = tile
+        self.read_noise = read_noise
+        self.adc_bits = adc_bits
+        self.adc_range = adc_range
+        self.layers = []        # conv of every registered layer, indexed by its code
+        self.conductance = {}   # code -> (pos, neg), [out, in]
+        self.arrays = {}        # code -> tiled conductances and ADC full scale, see _arrays
+
+    def register(self, layer, bias=True):
+        self.layers.append(layer)
+        return len(self.layers) - 1
+
+    @torch.no_grad()
+    def load(self, model, cond_dict):
+        '''
+        Take the conductances of every layer on this crossbar from the cond_dict of
+        utils.replace_model_weight. Layers without a matching pair, e.g. after their weights
+        were loaded from a checkpoint, are mapped ideally: pos = relu(W), neg = relu(-W).
+        '''
+        self.conductance, self.arrays = {}, {}
+        for name, module in model.named_modules():
+            if getattr(module, 'hard_weight', None) is not self or module.code is None:
+                continue
+            weight = module.conv.weight.detach()
+            pos, neg = cond_dict.get(name + '.conv.weight', (None, None))
+            if pos is not None and torch.allclose((pos - neg).to(weight), weight, atol=1e-4):
+                self.conductance[module.code] = (pos.to(weight).reshape(weight.shape[0], -1),
+                                                 neg.to(weight).reshape(weight.shape[0], -1))
+        return self
+
+    def _conductance(self, conv, code):
+        if code not in self.conductance:
+            weight = conv.weight.detach().reshape(conv.out_channels, -1)
+            self.conductance[code] = (weight.clamp(min=0), (-weight).clamp(min=0))
+        return self.conductance[code]
+
+    def _arrays(self, conv, code, like):
+        '''
+        Conductances as [row tiles, rows, out] and the ADC full scale of every column, [row tiles, 1, out],
+        in the dtype and device of like.
+        '''
+        key = (code, like.dtype, like.device)
+        if key not in self.arrays:
+            pos, neg = [g.to(like) for g in self._conductance(conv, code)]
+            out, fan_in = pos.shape
+            tiles = math.ceil(fan_in / self.rows)
+            pad = tiles * self.rows - fan_in
+            pos, neg = [F.pad(g, (0, pad)).view(out, tiles, self.rows).permute(1, 2, 0).contiguous() for g in [pos, neg]]
+
+            if self.adc_range is None:
+                # largest differential column current of a binary input, shared by the columns of an array
+                diff = pos - neg
+                full_scale = torch.maximum(diff.clamp(min=0).sum(1), (-diff).clamp(min=0).sum(1))   # [tiles, out]
+                col_tiles = math.ceil(out / self.cols)
+                full_scale = F.pad(full_scale, (0, col_tiles * self.cols - out)).view(tiles, col_tiles, self.cols)
+                full_scale = full_scale.amax(-1, keepdim=True).expand(-1, -1, self.cols).reshape(tiles, -1)[:, :out]
+                full_scale = full_scale.clamp(min=1e-12).unsqueeze(1)
+            else:
+                full_scale = torch.full((tiles, 1, out), float(self.adc_range), dtype=like.dtype, device=like.device)
+            self.arrays[key] = (pos, neg, pos * pos, neg * neg, full_scale)
+        return self.arrays[key]
+
+    def num_arrays(self, conv):
+        return math.ceil(conv.weight[0].numel() / self.rows) * math.ceil(conv.out_channels / self.cols)
+
+    def summary(self):
+        adc = 'ideal ADC' if self.adc_bits is None else '%d-bit ADC' % self.adc_bits
+        return 'Crossbar: %d arrays of %dx%d over %d layers, read noise %g, %s' % (
+            sum(self.num_arrays(conv) for conv in self.layers), self.rows, self.cols, len(self.layers),
+            self.read_noise, adc)
+
+    def _noisy(self, g, P):
+        return g + g * self.read_noise * torch.randn(P, *g.shape, dtype=g.dtype, device=g.device)
+
+    def sample(self, conv, code, P):
+        '''P read realisations of the differential weights, [P, out, in], and the digital bias, [P, out]'''
+        pos, neg = self._conductance(conv, code)
+        return self._noisy(pos, P) - self._noisy(neg, P), conv.bias.detach().expand(P, -1)
+
+    def __call__(self, conv, code):
+        weight, bias = self.sample(conv, code, 1)
+        return weight[0].view_as(conv.weight), bias[0]
+
+    def read_bytes(self, conv, code):
+        '''bytes per input vector of read, for the chunking of NoiseModule.vmm_inference'''
+        tiles = math.ceil(conv.weight[0].numel() / self.rows)
+        return (5 * tiles * conv.out_channels + conv.weight[0].numel()) * 8
+
+    def read(self, conv, code, x):
+        '''
+        Outputs of one crossbar read per row of x, [P, in] -> [P, out], without the bias.
+        The cells of a read have independent Gaussian noise, so the column current of an array
+        is Gaussian with mean x G and variance read_noise^2 * x^2 G^2, drawn separately for pos and neg.
+        '''
+        pos, neg, pos2, neg2, full_scale = self._arrays(conv, code, x)
+        tiles = pos.shape[0]
+        x = F.pad(x, (0, tiles * self.rows - x.shape[1])).view(-1, tiles, self.rows).transpose(0, 1)  # [tiles, P, rows]
+        current = torch.bmm(x, pos) - torch.bmm(x, neg)     # [tiles, P, out]
+        if self.read_noise:
+            x2 = x * x
+            std = (torch.bmm(x2, pos2).sqrt(), torch.bmm(x2, neg2).sqrt())
+            current += self.read_noise * (std[0] * torch.randn_like(current) - std[1] * torch.randn_like(current))
+        if self.adc_bits is not None:
+            levels = 2 ** (self.adc_bits - 1) - 1
+            step = full_scale / levels
+            current = torch.round(current / step).clamp(-levels, levels) * step
+        return current.sum(0)
@@ -11,7 +11,9 @@ class get_model(NoiseModule):
                  normal_feature=3, c_prune_rate=1,
                  iter=[1,1,1], noise=0, quantize='full',
                  num_feat=1024, num_fc=1,
-                 distancing='l2', r0=0.2, r1=0.4, hard_mode='batch'):
+                 distancing='l2', r0=0.2, r1=0.4, hard_mode='batch', hardweight=None,
+                 grouping='dense', precompute=False, mem_budget=None, stream_block=None,
+                 ensemble=1, ensemble_reduce='concat', noise_mode='weight', procedural=None, hardware=False):
         super(get_model, self).__init__()
         in_channel = 3 + normal_feature
 
@@ -32,22 +34,31 @@ class get_model(NoiseModule):
                 mlp = [int(layer_channel[l]) for i in range(layer)]
                 sa = NewGraphSetAbstraction(npoint=ngroup_list[l], radius=radius_list[l], nsample=nsample_list[l],
                                     in_channel=in_channel_list[l], mlp=mlp, group_all=False,
-                                    noise=noise, quantize=quantize, distancing=distancing, mode=hard_mode)
+                                    noise=noise, quantize=quantize, distancing=distancing, mode=hard_mode,
+                                    hardweight=hardweight, grouping=grouping, precompute=precompute, mem_budget=mem_budget,
+                                    ensemble=ensemble, noise_mode=noise_mode, procedural=procedural, hardware=hardware)
                 self.sa.append(sa)
         mlp_last = [int(self.feature_size / c_prune_rate) for i in range(iter[-1])]
         sa = NewGraphSetAbstraction(npoint=ngroup_list[-1], radius=radius_list[-1], nsample=nsample_list[-1],
                                     # in_channel=in_channel_list[-1], mlp=mlp_last, group_all=True,
                                     in_channel=in_channel_list[l + 1], mlp=mlp_last, group_all=True,
-                                    noise=noise, quantize=quantize, distancing=distancing, mode=hard_mode)
+                                    noise=noise, quantize=quantize, distancing=distancing, mode=hard_mode,
+                                    hardweight=hardweight, grouping=grouping, precompute=precompute, mem_budget=mem_budget,
+                                    stream_block=stream_block, ensemble=ensemble,
+                                    noise_mode=noise_mode, procedural=procedural, hardware=hardware)
         self.sa.append(sa)
 
         Linear = NoiseLinear
         self.fc = nn.ModuleList()
         self.bn, self.drop = nn.ModuleList(), nn.ModuleList()
         fc_channels = [int(c / c_prune_rate) for c in [self.feature_size, 512, 256]]
+        # E independently drawn SA stacks, their pooled features are concatenated or averaged for the fc layers
+        self.ensemble, self.ensemble_reduce = ensemble, ensemble_reduce
+        if ensemble_reduce == 'concat':
+            fc_channels[0] *= ensemble
         if num_fc > 1:
             for i, c in enumerate(fc_channels[:-1]):
-                fc = Linear(fc_channels[i], fc_channels[i + 1], noise=noise)
+                fc = Linear(fc_channels[i], fc_channels[i + 1], noise=noise, noise_mode=noise_mode)
                 self.fc.append(fc)
                 self.bn.append(nn.BatchNorm1d(fc_channels[i + 1]))
                 self.drop.append(nn.Dropout(0.4))
@@ -60,6 +71,16 @@ class get_model(NoiseModule):
         self.c_prune_rate = c_prune_rate
 
     def forward(self, xyz):
+        points = self.sa_features(xyz)
+        x = self.head(points.view(xyz.shape[0], -1))
+        return x, points
+
+    def sa_features(self, xyz):
+        """
+        Random features of the SA stack, the input of the fc layers.
+        Return:
+            points: pooled SA features, [B, num_feat, 1], [B, E*num_feat, 1] for a concatenated ensemble
+        """
         B, _, _ = xyz.shape
         if self.normal_feature > 0:
             points = xyz[:, 3:, :]
@@ -71,13 +92,35 @@ class get_model(NoiseModule):
         with torch.no_grad():
             for sa in self.sa:
                 xyz, points = sa(xyz, points)
+        if self.ensemble > 1 and self.ensemble_reduce == 'mean':
+            points = points.view(B, self.ensemble, -1, 1).mean(1)
+        return points
 
-            x = points.view(B, int(self.feature_size / self.c_prune_rate))
+    def hidden(self, x):
         if len(self.fc) > 1:
             for fc, bn, drop in zip(self.fc[:-1], self.bn, self.drop):
                 x = drop(F.relu(bn(fc(x))))
-        x = self.fc[-1](x)
-        x = F.log_softmax(x, -1)
+        return x
+
+    def head(self, x):
+        """
+        Trainable part of the model.
+        Input:
+            x: flattened SA features, [B, num_feat]
+        Return:
+            log class probabilities, [B, num_class]
+        """
+        return F.log_softmax(self.fc[-1](self.hidden(x)), -1)
+
+    def extract_features(self, xyz):
+        """
+        Everything before the readout layer self.fc[-1].
+        Return:
+            x: readout input, [B, D]
+            points: pooled SA features, [B, num_feat, 1]
+        """
+        points = self.sa_features(xyz)
+        x = self.hidden(points.view(xyz.shape[0], -1))
         return x, points
 
 
@@ -10,7 +10,10 @@ class get_model(nn.Module):
                  feat1=128, num_feat=1024, num_fc=1,
                 #  r0=0.15, r1=0.3,
                  r0=0.1, r1=0.3, quant_bit=6,
-                 hardweight=None, hard_mode=None):
+                 hardweight=None, hard_mode=None, grouping='dense',
+                 precompute=False, share_dist=False, mem_budget=None,
+                 stream_block=None, ensemble=1, ensemble_reduce='concat', noise_mode='weight',
+                 procedural=None, hardware=False):
         super(get_model, self).__init__()
         if normal_channel:
             additional_channel = 3
@@ -19,22 +22,53 @@ class get_model(nn.Module):
         self.normal_channel = normal_channel
         layer_c = [int(c / c_prune_rate) for c in [feat1, 256, num_feat]]
         self.sa1 = NewGraphSetAbstraction(npoint=512, radius=r0, nsample=32, in_channel=6+additional_channel,
-                                          mlp=[layer_c[0]], group_all=False, noise=noise, mode=hard_mode)
+                                          mlp=[layer_c[0]], group_all=False, noise=noise, mode=hard_mode,
+                                          grouping=grouping, precompute=precompute, return_knn=share_dist,
+                                          mem_budget=mem_budget, ensemble=ensemble,
+                                          noise_mode=noise_mode, hardweight=hardweight, procedural=procedural,
+                                          hardware=hardware)
         self.sa2 = NewGraphSetAbstraction(npoint=128, radius=r1, nsample=64, in_channel=layer_c[0]+ 3,
-                                          mlp=[layer_c[1]], group_all=False, noise=noise, mode=hard_mode)
+                                          mlp=[layer_c[1]], group_all=False, noise=noise, mode=hard_mode,
+                                          grouping=grouping, precompute=precompute, return_knn=share_dist,
+                                          mem_budget=mem_budget, ensemble=ensemble,
+                                          noise_mode=noise_mode, hardweight=hardweight, procedural=procedural,
+                                          hardware=hardware)
         self.sa3 = NewGraphSetAbstraction(npoint=None, radius=None, nsample=None, in_channel=layer_c[1] + 3,
-                                          mlp=[layer_c[2]], group_all=True, noise=noise, mode=hard_mode)
+                                          mlp=[layer_c[2]], group_all=True, noise=noise, mode=hard_mode,
+                                          hardweight=hardweight, stream_block=stream_block, ensemble=ensemble,
+                                          noise_mode=noise_mode, procedural=procedural, hardware=hardware)
         self.fp3 = FeaturePropagation(in_channel=layer_c[2] + layer_c[1], mlp=[layer_c[1]],
-                                      noise=noise, mode=hard_mode)
+                                      noise=noise, mode=hard_mode, mem_budget=mem_budget,
+                                      hardweight=hardweight, ensemble=ensemble, noise_mode=noise_mode,
+                                      procedural=procedural, hardware=hardware)
         self.fp2 = FeaturePropagation(in_channel=layer_c[1] + layer_c[0], mlp=[layer_c[0]], 
-                                      noise=noise, mode=hard_mode)
+                                      noise=noise, mode=hard_mode, mem_budget=mem_budget,
+                                      hardweight=hardweight, ensemble=ensemble, noise_mode=noise_mode,
+                                      procedural=procedural, hardware=hardware)
         self.fp1 = FeaturePropagation(in_channel=layer_c[0]+16+6+additional_channel, mlp=[layer_c[0]],
-                                      noise=noise, mode=hard_mode)
+                                      noise=noise, mode=hard_mode, mem_budget=mem_budget,
+                                      hardweight=hardweight, ensemble=ensemble, noise_mode=noise_mode,
+                                      procedural=procedural, hardware=hardware)
         self.bn1 = nn.BatchNorm1d(layer_c[0])
         self.drop1 = nn.Dropout(0.5)
-        self.conv2 = nn.Conv1d(layer_c[0], num_classes, 1)  # [feat1, 50]
+        # E independently drawn SA/FP stacks, their per-point features are concatenated or averaged for conv2
+        self.ensemble, self.ensemble_reduce = ensemble, ensemble_reduce
+        readout_c = layer_c[0] * ensemble if ensemble_reduce == 'concat' else layer_c[0]
+        self.conv2 = nn.Conv1d(readout_c, num_classes, 1)  # [feat1, 50]
+        # reuse the SA distance matrices for the 3-NN of fp2 and fp1
+        self.share_dist = share_dist
 
     def forward(self, xyz, cls_label):
+        l0_points, l3_points = self.extract_features(xyz, cls_label)
+        return self.head(l0_points), l3_points
+
+    def extract_features(self, xyz, cls_label):
+        """
+        SA and FP layers, everything before the readout conv2.
+        Return:
+            l0_points: per-point features, [B, feat1, N], [B, E*feat1, N] for a concatenated ensemble
+            l3_points: global feature, [B, num_feat, 1], [B, E*num_feat, 1] with an ensemble
+        """
         # Set Abstraction layers
         B,C,N = xyz.shape
         if self.normal_channel:
@@ -45,22 +79,38 @@ class get_model(nn.Module):
             l0_xyz = xyz
 
         # with torch.no_grad():
-        l1_xyz, l1_points = self.sa1(l0_xyz, l0_points)
-        l2_xyz, l2_points = self.sa2(l1_xyz, l1_points)
+        if self.share_dist:
+            l1_xyz, l1_points, l1_knn = self.sa1(l0_xyz, l0_points)
+            l2_xyz, l2_points, l2_knn = self.sa2(l1_xyz, l1_points)
+        else:
+            l1_xyz, l1_points = self.sa1(l0_xyz, l0_points)
+            l2_xyz, l2_points = self.sa2(l1_xyz, l1_points)
+            l1_knn, l2_knn = None, None
         l3_xyz, l3_points = self.sa3(l2_xyz, l2_points)
         # Feature Propagation layers
         l2_points = self.fp3(l2_xyz, l3_xyz, l2_points, l3_points)
-        l1_points = self.fp2(l1_xyz, l2_xyz, l1_points, l2_points)
+        l1_points = self.fp2(l1_xyz, l2_xyz, l1_points, l2_points, knn=l2_knn)
         cls_label_one_hot = cls_label.view(B,16,1).repeat(1,1,N)
-        l0_points = self.fp1(l0_xyz, l1_xyz, torch.cat([cls_label_one_hot, l0_xyz, l0_points],1), l1_points)
+        l0_points = self.fp1(l0_xyz, l1_xyz, torch.cat([cls_label_one_hot, l0_xyz, l0_points],1), l1_points, knn=l1_knn)
+        if self.ensemble > 1 and self.ensemble_reduce == 'mean':
+            l0_points = l0_points.view(B, self.ensemble, -1, N).mean(1)
+        return l0_points, l3_points
 
+    def head(self, l0_points):
+        """
+        Trainable readout.
+        Input:
+            l0_points: per-point features, [B, feat1, N]
+        Return:
+            log part probabilities, [B, N, num_classes]
+        """
         # FC layers
         # feat =  F.relu(self.bn1(self.conv1(l0_points)))
         # x = self.drop1(feat)
         x = self.conv2(l0_points)
         x = F.log_softmax(x, dim=1)
         x = x.permute(0, 2, 1)
-        return x, l3_points
+        return x
 
 
 class get_loss(nn.Module):
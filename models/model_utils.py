@@ -4,7 +4,9 @@ import torch.nn.functional as F
 import torch.distributions as D
 from torch.distributions.mixture_same_family import MixtureSameFamily
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import copy
 import os
 import sys
 sys.path.append('./models')
@@ -132,58 +134,304 @@ def index_points(points, idx):
     return new_points
 
 
-def farthest_point_sample(xyz, npoint, distance_type='l2'):
+def fps_kernel(xyz, npoint: int, farthest, l1: bool = False):
     """
+    FPS iterations without boolean indexing.
+
     Input:
         xyz: pointcloud data, [B, N, 3]
         npoint: number of samples
+        farthest: index of the first centroid, [B]
+        l1: use L1 instead of squared L2 distance
     Return:
         centroids: sampled pointcloud index, [B, npoint]
     """
-    # torch.manual_seed(1)
+    B, N, C = xyz.shape
+    centroids = torch.zeros(B, npoint, dtype=torch.long, device=xyz.device)
+    distance = torch.full((B, N), 1e10, dtype=xyz.dtype, device=xyz.device)
+    for i in range(npoint):
+        centroids[:, i] = farthest
+        centroid = torch.gather(xyz, 1, farthest.view(B, 1, 1).expand(B, 1, C))
+        if l1:
+            dist = torch.sum(torch.abs(xyz - centroid), -1)
+        else:
+            dist = torch.sum((xyz - centroid) ** 2, -1)
+        distance = torch.minimum(distance, dist)
+        farthest = torch.argmax(distance, -1)
+    return centroids
+
+
+_fps_pools = {}
+_fps_threads = 1
 
+
+def set_fps_threads(num_threads):
+    """
+    Default number of CPU threads of farthest_point_sample, 1 runs the batch in the calling
+    thread. Every thread also runs intra-op threads, so more threads than cores divided by
+    torch.get_num_threads() oversubscribe the CPU.
+    """
+    global _fps_threads
+    _fps_threads = max(1, int(num_threads))
+
+
+def farthest_point_sample(xyz, npoint, distance_type='l2', num_threads=None, init=None):
+    """
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        num_threads: on CPU, split the batch over this many threads
+                     (defaults to the set_fps_threads value, 1)
+        init: index of the first centroid, [B]; drawn at random if None
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    # torch.manual_seed(1)
     device = xyz.device
     B, N, C = xyz.shape
-    centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
-    distance = torch.ones(B, N).to(device) * 1e10
-    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
-    batch_indices = torch.arange(B, dtype=torch.long).to(device)
+    if init is None:
+        farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
+    else:
+        farthest = init.to(device)
+    l1 = distance_type == 'l1'
+
+    num_threads = num_threads or _fps_threads
+    if device.type != 'cpu' or num_threads < 2 or B < 2:
+        return fps_kernel(xyz, npoint, farthest, l1)
+
+    # torch ops release the GIL, so batch chunks run in parallel
+    if num_threads not in _fps_pools:
+        _fps_pools[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+    chunks = zip(xyz.chunk(num_threads), farthest.chunk(num_threads))
+    futures = [_fps_pools[num_threads].submit(fps_kernel, x, npoint, f, l1) for x, f in chunks]
+    return torch.cat([future.result() for future in futures], 0)
+
+
+def fps_query_kernel(xyz, npoint: int, radius: float, nsample: int, farthest, l1: bool, block: int):
+    """
+    fps_kernel that also runs the ball query of every block of centroids on their FPS distances.
+
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+        group_idx: grouped points index, [B, npoint, nsample]
+    """
+    B, N, C = xyz.shape
+    centroids = torch.zeros(B, npoint, dtype=torch.long, device=xyz.device)
+    group_idx = torch.zeros(B, npoint, nsample, dtype=torch.long, device=xyz.device)
+    distance = torch.full((B, N), 1e10, dtype=xyz.dtype, device=xyz.device)
+    point_indices = torch.arange(N, dtype=torch.long, device=xyz.device)
+    rows = []
     for i in range(npoint):
         centroids[:, i] = farthest
-        centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
-        # calculating distance
-        if distance_type == 'l2':
-            dist = torch.sum((xyz - centroid) ** 2, -1)
-        elif distance_type == 'l1':
+        centroid = torch.gather(xyz, 1, farthest.view(B, 1, 1).expand(B, 1, C))
+        if l1:
             dist = torch.sum(torch.abs(xyz - centroid), -1)
-        mask = dist < distance
-        distance[mask] = dist[mask]
-        farthest = torch.max(distance, -1)[1]
-    return centroids
+        else:
+            dist = torch.sum((xyz - centroid) ** 2, -1)
+        rows.append(dist)
+        if len(rows) == block or i == npoint - 1:
+            block_dist = torch.stack(rows, 1)    # [B, len(rows), N]
+            group_idx[:, i + 1 - len(rows):i + 1] = torch.where(block_dist > radius ** 2, N, point_indices).topk(
+                nsample, dim=-1, largest=False, sorted=True)[0]
+            rows = []
+        distance = torch.minimum(distance, dist)
+        farthest = torch.argmax(distance, -1)
+
+    group_first = group_idx[:, :, 0].view(B, npoint, 1).repeat([1, 1, nsample])
+    mask = group_idx == N
+    group_idx[mask] = group_first[mask]
+    return centroids, group_idx
 
 
+def farthest_point_sample_and_query(xyz, npoint, radius, nsample, distance_type='l2', num_threads=None, init=None,
+                                    block=None):
+    """
+    Farthest point sampling that runs the ball query on the distances FPS computes
+    for every centroid anyway, so no [B, npoint, N] distance matrix is built: the rows
+    of block centroids are collected and queried together. Draws the same random start
+    as farthest_point_sample, returns the same centroids and splits the batch over
+    threads the same way.
+    The query reads the FPS distance sum((xyz - centroid) ** 2) and not the expansion of
+    square_distance, which rounds differently, so a point within an ulp of the radius can
+    be decided otherwise than by query_ball_point; it equals query_ball_point given dist
+    of the FPS formula.
 
-def query_ball_point(radius, nsample, xyz, new_xyz, distance_type='l2'):
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        radius: local region radius
+        nsample: max sample number in local region
+        num_threads: on CPU, split the batch over this many threads
+                     (defaults to the set_fps_threads value, 1)
+        init: index of the first centroid, [B]; drawn at random if None
+        block: centroids per where/topk; by default as many as keep the [B, block, N]
+               distances at 2 ** 20 elements, larger blocks leave the cache
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+        group_idx: grouped points index, [B, npoint, nsample]
+    """
+    device = xyz.device
+    B, N, C = xyz.shape
+    if init is None:
+        farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
+    else:
+        farthest = init.to(device)
+    l1 = distance_type == 'l1'
+
+    num_threads = num_threads or _fps_threads
+    if device.type != 'cpu' or num_threads < 2 or B < 2:
+        return fps_query_kernel(xyz, npoint, radius, nsample, farthest, l1, block or max(1, 2 ** 20 // (B * N)))
+
+    if num_threads not in _fps_pools:
+        _fps_pools[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+    chunks = list(zip(xyz.chunk(num_threads), farthest.chunk(num_threads)))
+    futures = [_fps_pools[num_threads].submit(fps_query_kernel, x, npoint, radius, nsample, f, l1,
+                                              block or max(1, 2 ** 20 // (len(x) * N))) for x, f in chunks]
+    results = [future.result() for future in futures]
+    return torch.cat([r[0] for r in results], 0), torch.cat([r[1] for r in results], 0)
+
+
+def chunk_bounds(mem_budget, row_bytes, rows):
+    """
+    Split rows into chunks of at most mem_budget bytes, one chunk if mem_budget is None.
+    Chunks keep at least two rows: a single-row matmul runs a matrix-vector kernel
+    that rounds differently, and chunked results must match the unchunked ones.
+    Return:
+        bounds: [(start, end), ...]
+    """
+    if mem_budget is None:
+        return [(0, rows)]
+    starts = list(range(0, rows, max(2, int(mem_budget // row_bytes))))
+    if len(starts) > 1 and rows - starts[-1] == 1:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [rows]))
+
+
+def query_ball_point(radius, nsample, xyz, new_xyz, distance_type='l2', dist=None, mem_budget=None):
     """
     Input:
         radius: local region radius
         nsample: max sample number in local region
         xyz: all points, [B, N, 3]
         new_xyz: query points, [B, S, 3]
+        dist: precomputed distance between new_xyz and xyz, [B, S, N]
+        mem_budget: bytes for the [B, S, N] intermediates; queries are processed in
+                    chunks that fit, which gives the same group_idx
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
     device = xyz.device
     B, N, C = xyz.shape
     _, S, _ = new_xyz.shape
-    group_idx = torch.arange(N, dtype=torch.long).to(device).view(1, 1, N).repeat([B, S, 1])
-    if distance_type == 'l2':
+    # distance and long index per (query, point)
+    bounds = chunk_bounds(mem_budget, B * N * (xyz.element_size() + 8), S)
+    if len(bounds) > 1:
+        return torch.cat([query_ball_point(radius, nsample, xyz, new_xyz[:, s:e], distance_type=distance_type,
+                                           dist=None if dist is None else dist[:, s:e])
+                          for s, e in bounds], 1)
+    if dist is None and distance_type == 'l2':
         dist = square_distance(new_xyz, xyz)
-    elif distance_type == 'l1':
+    elif dist is None and distance_type == 'l1':
         dist = l1_distance(new_xyz, xyz)
-    group_idx[dist > radius ** 2] = N
+    group_idx = torch.where(dist > radius ** 2, N, torch.arange(N, dtype=torch.long, device=device).view(1, 1, N))
+
+    # the nsample smallest indices are the first in-radius ones, no full sort over N needed
+    group_idx = group_idx.topk(nsample, dim=-1, largest=False, sorted=True)[0]
+
+    group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
+    mask = group_idx == N
+    group_idx[mask] = group_first[mask]
+    return group_idx
+
+
+def query_ball_point_grid(radius, nsample, xyz, new_xyz, distance_type='l2', mem_budget=None, max_fraction=0.08,
+                          max_radius=0.15, min_points=2048):
+    """
+    Ball query on a uniform voxel grid. Points are bucketed into cells as large as
+    the search extent, so only the 27 cells around each query have to be tested.
+    The result has the layout of query_ball_point (first nsample in-radius indices in
+    ascending order, padded with the first neighbour) and is the same where the
+    distances are exact. The [B, S, M] candidate distances come from a matmul of another
+    shape than the dense [B, S, N] one, which BLAS may round differently by an ulp, so a
+    point whose distance is within rounding of the radius can be decided the other way.
+    The candidates of every query are padded to the longest list M, and each slot costs
+    several times a column of the dense [B, S, N] query. On uniform points in the unit
+    cube the grid is 1.2x faster at a radius of 0.15 and loses from about 0.18, and with
+    1024 points it already loses at 0.1 to the bucketing, so for a search extent above
+    max_radius or fewer than min_points points the dense query of mem_budget runs without
+    building the grid; it also runs when M exceeds max_fraction * N (dense clusters),
+    which is first estimated from the bounding box.
+
+    Input:
+        radius: local region radius
+        nsample: max sample number in local region
+        xyz: all points, [B, N, 3]
+        new_xyz: query points, [B, S, 3]
+    Return:
+        group_idx: grouped points index, [B, S, nsample]
+    """
+    device = xyz.device
+    B, N, C = xyz.shape
+    _, S, _ = new_xyz.shape
+    # query_ball_point compares both distances against radius ** 2
+    extent = radius if distance_type == 'l2' else radius ** 2
+    if extent > max_radius or N < min_points:
+        return query_ball_point(radius, nsample, xyz, new_xyz, distance_type=distance_type, mem_budget=mem_budget)
+    # small margin so that float rounding never pushes an in-radius point two cells away
+    cell = extent * (1 + 1e-5)
+
+    origin = xyz.min(dim=1, keepdim=True)[0]
+    # the 27 cells cover this fraction of a uniform cloud; over the break-even the dense
+    # query runs before the grid is built
+    span = (xyz.max(dim=1)[0] - origin.squeeze(1)).clamp(min=cell)   # [B, 3]
+    if (3 * cell / span).clamp(max=1).prod(-1).min() > max_fraction:
+        return query_ball_point(radius, nsample, xyz, new_xyz, distance_type=distance_type, mem_budget=mem_budget)
+    point_cell = torch.floor((xyz - origin) / cell).long()   # [B, N, 3]
+    grid_size = point_cell.max(dim=1)[0].max(dim=0)[0] + 1     # [3]
+    # shift by 2 so that clamped queries and their -1 neighbours stay non-negative
+    dims = grid_size + 4
+
+    def cell_key(batch, c):
+        c = c + 2
+        return ((batch * dims[0] + c[..., 0]) * dims[1] + c[..., 1]) * dims[2] + c[..., 2]
+
+    batch_indices = torch.arange(B, dtype=torch.long, device=device)
+    point_key = cell_key(batch_indices.view(B, 1), point_cell).view(-1)
+    sorted_key, order = torch.sort(point_key, stable=True)    # buckets keep ascending point order
+
+    query_cell = torch.floor((new_xyz - origin) / cell).long()
+    query_cell = torch.max(torch.min(query_cell, grid_size.view(1, 1, 3)), torch.full_like(query_cell, -1))
+    offsets = torch.stack(torch.meshgrid(*[torch.arange(-1, 2, device=device)] * 3, indexing='ij'), -1).view(27, 3)
+    neighbour_key = cell_key(batch_indices.view(B, 1, 1), query_cell.view(B, S, 1, 3) + offsets)   # [B, S, 27]
+    start = torch.searchsorted(sorted_key, neighbour_key)
+    count = torch.searchsorted(sorted_key, neighbour_key, right=True) - start
+
+    # enumerate the concatenated buckets of every query as a padded candidate list
+    cum_count = torch.cumsum(count, dim=-1)
+    total = cum_count[:, :, -1:]
+    M = max(int(total.max()), 1)
+    if M > max_fraction * N:
+        return query_ball_point(radius, nsample, xyz, new_xyz, distance_type=distance_type, mem_budget=mem_budget)
+    slot = torch.arange(M, device=device).view(1, 1, M).expand(B, S, M)
+    bucket = torch.searchsorted(cum_count, slot.contiguous(), right=True).clamp(max=26)
+    bucket_start = torch.gather(start, 2, bucket)
+    bucket_offset = slot - torch.gather(cum_count - count, 2, bucket)
+    valid = slot < total
+    sorted_pos = torch.where(valid, bucket_start + bucket_offset, torch.zeros_like(slot))
+    candidate = order[sorted_pos] % N   # [B, S, M]
+
+    candidate_xyz = index_points(xyz, candidate)
+    if distance_type == 'l2':
+        dist = -2 * torch.matmul(candidate_xyz, new_xyz.view(B, S, C, 1)).squeeze(-1)
+        dist += torch.sum(new_xyz ** 2, -1).view(B, S, 1)
+        dist += torch.sum(candidate_xyz ** 2, -1)
+    elif distance_type == 'l1':
+        dist = torch.sum(torch.abs(candidate_xyz - new_xyz.view(B, S, 1, C)), -1)
+    candidate[(dist > radius ** 2) | ~valid] = N
 
-    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
+    if M < nsample:
+        candidate = torch.cat([candidate, torch.full((B, S, nsample - M), N, dtype=torch.long, device=device)], -1)
+    group_idx = candidate.topk(nsample, dim=-1, largest=False, sorted=True)[0]
 
     group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
     mask = group_idx == N
@@ -191,7 +439,46 @@ def query_ball_point(radius, nsample, xyz, new_xyz, distance_type='l2'):
     return group_idx
 
 
-def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False, distance_type='l2'):
+def ball_query(radius, nsample, xyz, new_xyz, distance_type='l2', grouping='dense', mem_budget=None):
+    """
+    Dispatch the ball query to the selected neighbour search backend.
+    grouping: 'dense' builds the full [B, S, N] distance matrix,
+              'grid' searches the voxel grid (query_ball_point_grid) for small radii on
+              large clouds and falls back to 'dense' elsewhere.
+    sample_and_group additionally accepts 'fused', which queries inside FPS
+    (farthest_point_sample_and_query).
+    """
+    if grouping == 'dense':
+        return query_ball_point(radius, nsample, xyz, new_xyz, distance_type=distance_type, mem_budget=mem_budget)
+    elif grouping == 'grid':
+        return query_ball_point_grid(radius, nsample, xyz, new_xyz, distance_type=distance_type, mem_budget=mem_budget)
+    else:
+        raise NotImplementedError
+
+
+def sample_and_query(npoint, radius, nsample, xyz, distance_type='l2', grouping='dense', init=None, mem_budget=None):
+    """
+    Input:
+        npoint: number of centroids
+        xyz: input points position data, [B, N, 3]
+        init: index of the first FPS centroid, [B]; drawn at random if None
+        mem_budget: bytes for the dense ball query, see query_ball_point
+    Return:
+        fps_idx: sampled points index, [B, npoint]
+        idx: grouped points index, [B, npoint, nsample]
+    """
+    if grouping == 'fused':
+        # the ball query is collected while FPS runs
+        return farthest_point_sample_and_query(xyz, npoint, radius, nsample, distance_type=distance_type, init=init)
+    fps_idx = farthest_point_sample(xyz, npoint, distance_type=distance_type, init=init) # [B, npoint, C]   seems to be [B, npoints]
+    new_xyz = index_points(xyz, fps_idx)     # [B, npoint, C]
+    idx = ball_query(radius, nsample, xyz, new_xyz, distance_type=distance_type, grouping=grouping,
+                     mem_budget=mem_budget)   # [B, npoint, nsample]  for each centroid, there are nsample neighbors
+    return fps_idx, idx
+
+
+def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False, distance_type='l2', grouping='dense',
+                     fps_idx=None, idx=None):
     """
     Input:
         npoint: number of centroids
@@ -199,15 +486,17 @@ def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False, dist
         nsample:
         xyz: input points position data, [B, N, 3]
         points: input points data, [B, N, D]
+        fps_idx, idx: precomputed sampling and grouping indices (e.g. from a
+                      neighbourhood cache); computed with sample_and_query if None
     Return:
         new_xyz: sampled points position data, [B, npoint, nsample, 3]
         new_points: sampled points data, [B, npoint, nsample, 3+D]
     """
     B, N, C = xyz.shape
     S = npoint
-    fps_idx = farthest_point_sample(xyz, npoint, distance_type=distance_type) # [B, npoint, C]   seems to be [B, npoints]
+    if fps_idx is None:
+        fps_idx, idx = sample_and_query(npoint, radius, nsample, xyz, distance_type=distance_type, grouping=grouping)
     new_xyz = index_points(xyz, fps_idx)     # [B, npoint, C]
-    idx = query_ball_point(radius, nsample, xyz, new_xyz, distance_type=distance_type)   # [B, npoint, nsample]  for each centroid, there are nsample neighbors
     grouped_xyz = index_points(xyz, idx) # [B, npoint, nsample, C]
     grouped_xyz_norm = grouped_xyz - new_xyz.view(B, S, 1, C)
 
@@ -242,12 +531,33 @@ def sample_and_group_all(xyz, points):
     return new_xyz, new_points
 
 
+def ensemble_cat(tensors, widths, ensemble):
+    """
+    Concatenate the features of an ensemble member by member, the input layout of a conv with groups=ensemble.
+    Input:
+        tensors: features stacked member by member, [..., E*D_i], or shared by all members, [..., D_i]
+        widths: per-member widths D_i
+    Return:
+        [..., E*sum(D_i)], member e holds its block of every tensor in turn
+    """
+    parts = []
+    for t, d in zip(tensors, widths):
+        if d == 0:
+            continue
+        t = t.reshape(*t.shape[:-1], -1, d)     # [..., E or 1, D_i]
+        parts.append(t.expand(*t.shape[:-2], ensemble, d))
+    out = torch.cat(parts, -1)
+    return out.reshape(*out.shape[:-2], -1)
+
+
 class NewGraphSetAbstraction(NoiseModule):
     def __init__(self, npoint, radius,
                  nsample, in_channel, mlp,
                  group_all, noise=0, quantize='full',
                  distancing='l2', act=F.relu, hardweight=None,
-                 mode=None, quant_bit=6):
+                 mode=None, quant_bit=6, grouping='dense', precompute=False,
+                 return_knn=False, mem_budget=None, stream_block=None, ensemble=1, noise_mode='weight',
+                 procedural=None, hardware=False):
         super(NewGraphSetAbstraction, self).__init__()
         self.npoint = npoint    # number of centroids
         self.radius = radius
@@ -259,14 +569,18 @@ class NewGraphSetAbstraction(NoiseModule):
         self.scaling = nn.Parameter(torch.ones(1) * 0.005)
         self.scaling.requires_grad = True
 
+        # ensemble members are stacked along the channels and run as one grouped conv
+        self.ensemble = ensemble
+        self.in_channel = in_channel
         last_channel = in_channel
         for out_channel in mlp[:2]:
             if quantize == 'full':
-                self.mlp_convs.append(NoiseConv(last_channel, out_channel, 1,
+                self.mlp_convs.append(NoiseConv(ensemble * last_channel, ensemble * out_channel, 1,
                                                 noise=noise, hard_weight=hardweight, mode=mode,
-                                                quant=quant_bit))
+                                                quant=quant_bit, groups=ensemble, noise_mode=noise_mode,
+                                                vmm_budget=mem_budget, procedural=procedural, hardware=hardware))
 
-            self.mlp_bns.append(nn.BatchNorm2d(out_channel))
+            self.mlp_bns.append(nn.BatchNorm2d(ensemble * out_channel))
             last_channel = out_channel
         self.group_all = group_all
 
@@ -276,33 +590,65 @@ class NewGraphSetAbstraction(NoiseModule):
 
         self.noise = noise
         self.distance_type= distancing
+        self.grouping = grouping
+        # optional utility.neighbor_cache.NeighborhoodCache, see NeighborhoodCache.attach
+        self.nbr_cache, self.nbr_cache_layer = None, None
+        # run the 1x1 conv on the N source points and gather the results (software path only)
+        self.precompute = precompute
+        # also return the 3-NN of every input point among the centroids for the matching FeaturePropagation
+        self.return_knn = return_knn
+        # bytes for the ball query intermediates, None builds them in one go
+        self.mem_budget = mem_budget
+        # group_all only: pool blocks of this many points without keeping the pre-pool activations
+        self.stream_block = stream_block
 
     def forward(self, xyz, points):
         """
         Input:
             xyz: input points position data, [B, C, N]
-            points: input points data, [B, D, N]
+            points: input points data, [B, D, N]; with an ensemble [B, E*D, N] stacked member by member,
+                    or [B, D, N] shared by all members
         Return:
             new_xyz: sampled points position data, [B, C, S]
-            new_points_concat: sample points feature data, [B, D', S]
+            new_points_concat: sample points feature data, [B, D', S], [B, E*D', S] with an ensemble
+            knn: only if return_knn, 3-NN (dists, idx) of xyz among new_xyz, [B, N, 3] each, see
+                 query_and_knn; None unless the ball query is the dense l2 one
         """
         xyz = xyz.permute(0, 2, 1)
         if points is not None:
             points = points.permute(0, 2, 1)
 
+        bn = self.mlp_bns[0]
+        conv = self.mlp_convs[0]
+        knn = None
+        if self.group_all and self.stream_block and not self.needs_grad(xyz, points):
+            new_xyz, new_points = self.streamed_group_all(conv, bn, xyz, points)
+            new_points = self.act(new_points)
+            return new_xyz.permute(0, 2, 1), new_points
         if self.group_all:
             new_xyz, new_points = sample_and_group_all(xyz, points)
         else:
-            new_xyz, new_points = sample_and_group(self.npoint, self.radius, self.nsample, xyz, points, distance_type=self.distance_type)
-
-        # new_xyz: sampled points position data, [B, npoint, C]
-        # new_points: sampled points data, [B, npoint, nsample, C+D]
-        new_points = new_points.permute(0, 3, 2, 1) # [B, C+D, nsample,npoint]
-
-
-        bn = self.mlp_bns[0]
-        conv = self.mlp_convs[0]
-        new_points = bn(conv(new_points * self.scaling))
+            if self.nbr_cache is not None and self.nbr_cache.enabled:
+                fps_idx, idx = self.nbr_cache.lookup(self.nbr_cache_layer, xyz, self.npoint, self.nsample, self.query)
+            elif self.return_knn and self.grouping == 'dense' and self.distance_type == 'l2':
+                fps_idx, idx, knn = self.query_and_knn(xyz)
+            else:
+                fps_idx, idx = self.query(xyz)
+
+        if not self.group_all and self.precompute and not conv.hardware and not conv.noise \
+                and conv.procedural is None:
+            new_xyz = index_points(xyz, fps_idx)
+            new_points = self.precomputed_conv(conv, xyz, points, new_xyz, idx)
+        else:
+            if not self.group_all:
+                new_xyz, new_points = sample_and_group(self.npoint, self.radius, self.nsample, xyz, points,
+                                                       fps_idx=fps_idx, idx=idx)
+            # new_xyz: sampled points position data, [B, npoint, C]
+            # new_points: sampled points data, [B, npoint, nsample, C+D]
+            new_points = self.member_input(new_points, xyz.shape[-1])
+            new_points = new_points.permute(0, 3, 2, 1) # [B, C+D, nsample,npoint]
+            new_points = conv(self.scale(new_points))
+        new_points = bn(new_points)
         # new_points = conv(new_points) * self.scaling
         # new_points = bn(conv(new_points))
 
@@ -312,38 +658,229 @@ class NewGraphSetAbstraction(NoiseModule):
         new_points = self.act(new_points)
 
         new_xyz = new_xyz.permute(0, 2, 1)
+        if self.return_knn:
+            return new_xyz, new_points, knn
         return new_xyz, new_points
 
+    def scale(self, x):
+        # folded into the conv weights by fold_for_inference
+        return x if self.scaling is None else x * self.scaling
+
+    def member_input(self, features, C):
+        """[xyz, features] of every ensemble member, [..., C + E*D] or [..., C + D] -> [..., E*(C+D)]"""
+        if self.ensemble == 1:
+            return features
+        return ensemble_cat(features.split([C, features.shape[-1] - C], -1), [C, self.in_channel - C], self.ensemble)
+
+    def needs_grad(self, xyz, points):
+        if not torch.is_grad_enabled():
+            return False
+        inputs = [xyz] if points is None else [xyz, points]
+        return any(t.requires_grad for t in inputs) or any(p.requires_grad for p in self.parameters())
+
+    def streamed_group_all(self, conv, bn, xyz, points):
+        """
+        group_all conv, bn and max pool over blocks of stream_block points. Only the
+        running max and min of every channel are kept, never the [B, D', N, 1] activations.
+        bn is a per-channel affine map, so its max over the points is taken at the max of
+        the conv output where the scale is positive and at the min where it is negative.
+        In training mode the batch statistics are accumulated over the blocks as well.
+        A bn folded into the conv (nn.Identity, see fold_for_inference) keeps only the max.
+        No autograd graph is built, forward() only streams when no gradient is needed.
+        Input:
+            xyz: input points position data, [B, N, C]
+            points: input points data, [B, N, D]
+        Return:
+            new_xyz: sampled points position data, [B, 1, C]
+            new_points: pooled features before the activation, [B, D', 1]
+        """
+        B, N, C = xyz.shape
+        new_xyz = torch.zeros(B, 1, C).to(xyz.device)
+        features = xyz if points is None else torch.cat([xyz, points], dim=-1)
+        features = self.member_input(features, C)
+
+        new_max, new_min, total, total_sq = None, None, 0, 0
+        folded = isinstance(bn, nn.Identity)
+        bn_training = not folded and (bn.training or (bn.running_mean is None and bn.running_var is None))
+        for start in range(0, N, self.stream_block):
+            block = features[:, start:start + self.stream_block].permute(0, 2, 1).unsqueeze(-1)  # [B, C+D, n, 1]
+            block = conv(self.scale(block)).squeeze(-1)    # [B, D', n]
+            block_max, block_min = block.max(2)[0], block.min(2)[0]
+            new_max = block_max if new_max is None else torch.maximum(new_max, block_max)
+            new_min = block_min if new_min is None else torch.minimum(new_min, block_min)
+            if bn_training:
+                block = block.to(torch.float64)
+                total = total + block.sum((0, 2))
+                total_sq = total_sq + (block ** 2).sum((0, 2))
+
+        if folded:
+            return new_xyz, new_max.unsqueeze(-1)
+        if bn_training:
+            count = B * N
+            mean = total / count
+            var = (total_sq / count - mean ** 2).clamp(min=0)
+            if bn.training and bn.track_running_stats:
+                bn.num_batches_tracked.add_(1)
+                factor = bn.momentum if bn.momentum is not None else 1.0 / float(bn.num_batches_tracked)
+                bn.running_mean.mul_(1 - factor).add_(factor * mean.to(bn.running_mean.dtype))
+                bn.running_var.mul_(1 - factor).add_(factor * (var * count / max(count - 1, 1)).to(bn.running_var.dtype))
+            mean, var = mean.to(new_max.dtype), var.to(new_max.dtype)
+        else:
+            mean, var = bn.running_mean, bn.running_var
+
+        scale = torch.rsqrt(var + bn.eps)
+        if bn.affine:
+            scale = scale * bn.weight
+        new_points = (torch.where(scale >= 0, new_max, new_min) - mean) * scale
+        if bn.affine:
+            new_points = new_points + bn.bias
+        return new_xyz, new_points.unsqueeze(-1)
+
+    def precomputed_conv(self, conv, xyz, points, new_xyz, idx):
+        """
+        The 1x1 conv is linear, so W [xyz_j - c; f_j] = (W_xyz xyz_j + W_f f_j) - W_xyz c.
+        The first term is computed once per source point and gathered, the
+        second once per centroid, and the grouped input is never built.
+        Input:
+            xyz: input points position data, [B, N, C]
+            points: input points data, [B, N, D]
+            new_xyz: sampled points position data, [B, npoint, C]
+            idx: grouped points index, [B, npoint, nsample]
+        Return:
+            new_points: conv output, [B, D', nsample, npoint]
+        """
+        C = xyz.shape[-1]
+        features = xyz if points is None else torch.cat([xyz, points], dim=-1)
+        if self.ensemble == 1:
+            weight = self.scale(conv.conv.weight.view(conv.out_channels, -1))
+            projected = torch.matmul(features, weight.t())  # [B, N, D']
+            centre = torch.matmul(new_xyz, weight[:, :C].t()) - conv.conv.bias  # [B, npoint, D']
+        else:
+            # one [D', C+D] block per member, member e reads [xyz, its features]
+            E = self.ensemble
+            weight = self.scale(conv.conv.weight.view(E, conv.out_channels // E, -1))
+            features = self.member_input(features, C)
+            features = features.view(*features.shape[:2], E, -1).transpose(1, 2)     # [B, E, N, C+D]
+            projected = torch.matmul(features, weight.transpose(1, 2)).transpose(1, 2).flatten(2)   # [B, N, E*D']
+            centre = torch.matmul(new_xyz.unsqueeze(1), weight[:, :, :C].transpose(1, 2))  # [B, E, npoint, D']
+            centre = centre.transpose(1, 2).flatten(2) - conv.conv.bias    # [B, npoint, E*D']
+        new_points = index_points(projected, idx) - centre.unsqueeze(2)    # [B, npoint, nsample, D']
+        return new_points.permute(0, 3, 2, 1)
+
+    def query(self, xyz, init=None):
+        """
+        FPS and ball query of this layer.
+        Input:
+            xyz: input points position data, [B, N, C]
+            init: index of the first FPS centroid, [B]
+        Return:
+            fps_idx: [B, npoint], idx: [B, npoint, nsample]
+        """
+        return sample_and_query(self.npoint, self.radius, self.nsample, xyz,
+                                distance_type=self.distance_type, grouping=self.grouping, init=init,
+                                mem_budget=self.mem_budget)
+
+    def query_and_knn(self, xyz):
+        """
+        FPS and dense l2 ball query of this layer, and the 3-NN of every input point among the
+        centroids from the same [B, npoint, N] distances, a chunk of the batch at a time within
+        self.mem_budget bytes. FeaturePropagation would compute square_distance(xyz, new_xyz),
+        whose additions run in another order than the transposed square_distance(new_xyz, xyz),
+        so the 3-NN distances differ by float32 rounding: the segmentation outputs are within
+        about 5e-7 of the separate path, not bit-identical, see bench_grouping --bench share.
+        Input:
+            xyz: input points position data, [B, N, C]
+        Return:
+            fps_idx: [B, npoint], idx: [B, npoint, nsample],
+            knn: 3-NN (dists, idx) of xyz among the centroids, [B, N, 3] each
+        """
+        B, N, _ = xyz.shape
+        fps_idx = farthest_point_sample(xyz, self.npoint, distance_type=self.distance_type)
+        new_xyz = index_points(xyz, fps_idx)
+        idx, dists, nn_idx = [], [], []
+        # the distances and the long indices of the ball query per sample
+        for s, e in chunk_bounds(self.mem_budget, self.npoint * N * (xyz.element_size() + 8), B):
+            dist = square_distance(new_xyz[s:e], xyz[s:e])    # [b, npoint, N]
+            idx.append(query_ball_point(self.radius, self.nsample, xyz[s:e], new_xyz[s:e], dist=dist))
+            d, i = dist.topk(3, dim=1, largest=False, sorted=True)   # [b, 3, N]
+            dists.append(d.transpose(1, 2))
+            nn_idx.append(i.transpose(1, 2))
+        return fps_idx, torch.cat(idx, 0), (torch.cat(dists, 0), torch.cat(nn_idx, 0))
+
+
+def three_interpolate(xyz1, xyz2, points2, knn=None, mem_budget=None):
+    """
+    Inverse distance weighted interpolation from the 3 nearest points of xyz2.
+    Input:
+        xyz1: points to interpolate at, [B, N, C]
+        xyz2: known points, [B, S, C]
+        points2: features of the known points, [B, S, D]
+        knn: precomputed 3-NN (dists, idx) of xyz1 among xyz2, [B, N, 3] each
+        mem_budget: bytes for the [B, N, S] distances and [B, N, 3, D] gathered features;
+                    xyz1 is processed in chunks that fit, which gives the same result
+    Return:
+        interpolated_points: [B, N, D]
+    """
+    B, N, C = xyz1.shape
+    _, S, D = points2.shape
+    bounds = chunk_bounds(mem_budget, B * (S + 3 * D) * points2.element_size(), N)
+    if len(bounds) > 1:
+        return torch.cat([three_interpolate(xyz1[:, s:e], xyz2, points2,
+                                            knn=None if knn is None else (knn[0][:, s:e], knn[1][:, s:e]))
+                          for s, e in bounds], 1)
+
+    if knn is None:
+        dists = square_distance(xyz1, xyz2)
+        dists, idx = dists.topk(3, dim=-1, largest=False, sorted=True)  # [B, N, 3]
+    else:
+        dists, idx = knn
+
+    '''point1中的每个点找到三个与其距离最近的点, 然后用这三个点进行插值'''
+    dist_recip = 1.0 / (dists + 1e-8) # reciprocal of distance
+    norm = torch.sum(dist_recip, dim=2, keepdim=True)
+    weight = dist_recip / norm      # normalize the receprocal of distance
+    return torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
+
 
 class FeaturePropagation(NoiseModule):
     def __init__(self, in_channel,
                  mlp,
                  noise=0, quantize='full', 
                  hardweight=None,
-                 mode=None, quant_bit=6):
+                 mode=None, quant_bit=6, mem_budget=None, ensemble=1, noise_mode='weight', procedural=None,
+                 hardware=False):
         super(FeaturePropagation, self).__init__()
         self.mlp_convs = nn.ModuleList()
         self.mlp_bns = nn.ModuleList()
+        # ensemble members are stacked along the channels and run as one grouped conv
+        self.ensemble = ensemble
+        self.in_channel = in_channel
         last_channel = in_channel
         for out_channel in mlp:
-            self.mlp_convs.append(NoiseConv1d(last_channel, out_channel, 1,
+            self.mlp_convs.append(NoiseConv1d(ensemble * last_channel, ensemble * out_channel, 1,
                                               noise=noise, hard_weight=hardweight, mode=mode,
-                                              quant=quant_bit))
-            self.mlp_bns.append(nn.BatchNorm1d(out_channel))
+                                              quant=quant_bit, groups=ensemble, noise_mode=noise_mode,
+                                              vmm_budget=mem_budget, procedural=procedural, hardware=hardware))
+            self.mlp_bns.append(nn.BatchNorm1d(ensemble * out_channel))
             last_channel = out_channel
 
         self.noise = noise
         self.scaling = nn.Parameter(torch.ones(1) * 0.005)
+        # bytes for the 3-NN intermediates, None builds them in one go
+        self.mem_budget = mem_budget
 
-    def forward(self, xyz1, xyz2, points1, points2):
+    def forward(self, xyz1, xyz2, points1, points2, knn=None):
         """
         Input:
             xyz1: input points position data, [B, C, N]  # N is the number of output points
             xyz2: sampled input points position data, [B, C, S] # S is the number of input centroids 
             points1: input points data, [B, D, N]
             points2: input points data, [B, D, S]
+            knn: 3-NN (dists, idx) of xyz1 among xyz2, [B, N, 3] each; computed if None
+            with an ensemble points2 is stacked member by member, [B, E*D, S], and points1
+            either stacked as well or shared by all members
         Return:
-            new_points: upsampled points data, [B, D', N] 
+            new_points: upsampled points data, [B, D', N], [B, E*D', N] with an ensemble
         """
         xyz1 = xyz1.permute(0, 2, 1)
         xyz2 = xyz2.permute(0, 2, 1)
@@ -355,31 +892,31 @@ class FeaturePropagation(NoiseModule):
         if S == 1:
             interpolated_points = points2.repeat(1, N, 1)
         else:
-            dists = square_distance(xyz1, xyz2)
-            dists, idx = dists.sort(dim=-1)
-            dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
-
-            '''point1中的每个点找到三个与其距离最近的点, 然后用这三个点进行插值'''
-            dist_recip = 1.0 / (dists + 1e-8) # reciprocal of distance
-            norm = torch.sum(dist_recip, dim=2, keepdim=True)
-            weight = dist_recip / norm      # normalize the receprocal of distance
-            interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
+            interpolated_points = three_interpolate(xyz1, xyz2, points2, knn=knn, mem_budget=self.mem_budget)
 
         if points1 is not None:
             points1 = points1.permute(0, 2, 1)
-            new_points = torch.cat([points1, interpolated_points], dim=-1)
+            if self.ensemble == 1:
+                new_points = torch.cat([points1, interpolated_points], dim=-1)
+            else:
+                D2 = interpolated_points.shape[-1] // self.ensemble
+                new_points = ensemble_cat([points1, interpolated_points], [self.in_channel - D2, D2], self.ensemble)
         else:
             new_points = interpolated_points
 
         new_points = new_points.permute(0, 2, 1)
         for i, conv in enumerate(self.mlp_convs):
             bn = self.mlp_bns[i]
-            new_points = F.relu(bn(conv(new_points * self.scaling)))
+            new_points = F.relu(bn(conv(self.scale(new_points))))
         return new_points
 
+    def scale(self, x):
+        # folded into the conv weights by fold_for_inference
+        return x if self.scaling is None else x * self.scaling
+
 
 class PointNetFeaturePropagation(nn.Module):
-    def __init__(self, in_channel, mlp):
+    def __init__(self, in_channel, mlp, mem_budget=None):
         super(PointNetFeaturePropagation, self).__init__()
         self.mlp_convs = nn.ModuleList()
         self.mlp_bns = nn.ModuleList()
@@ -388,14 +925,16 @@ class PointNetFeaturePropagation(nn.Module):
             self.mlp_convs.append(nn.Conv1d(last_channel, out_channel, 1))
             self.mlp_bns.append(nn.BatchNorm1d(out_channel))
             last_channel = out_channel
+        self.mem_budget = mem_budget
 
-    def forward(self, xyz1, xyz2, points1, points2):
+    def forward(self, xyz1, xyz2, points1, points2, knn=None):
         """
         Input:
             xyz1: input points position data, [B, C, N]
             xyz2: sampled input points position data, [B, C, S]
             points1: input points data, [B, D, N]
             points2: input points data, [B, D, S]
+            knn: 3-NN (dists, idx) of xyz1 among xyz2, [B, N, 3] each; computed if None
         Return:
             new_points: upsampled points data, [B, D', N]
         """
@@ -409,14 +948,7 @@ class PointNetFeaturePropagation(nn.Module):
         if S == 1:
             interpolated_points = points2.repeat(1, N, 1)
         else:
-            dists = square_distance(xyz1, xyz2)
-            dists, idx = dists.sort(dim=-1)
-            dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
-
-            dist_recip = 1.0 / (dists + 1e-8)
-            norm = torch.sum(dist_recip, dim=2, keepdim=True)
-            weight = dist_recip / norm
-            interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
+            interpolated_points = three_interpolate(xyz1, xyz2, points2, knn=knn, mem_budget=self.mem_budget)
 
         if points1 is not None:
             points1 = points1.permute(0, 2, 1)
@@ -431,6 +963,87 @@ class PointNetFeaturePropagation(nn.Module):
         return new_points
 
 
+def shared_copy(model):
+    """deep copy of a model that shares its neighbourhood caches and crossbar backends"""
+    memo = {}
+    for module in model.modules():
+        for name in ['nbr_cache', 'hard_weight']:
+            obj = getattr(module, name, None)
+            if obj is not None:
+                memo[id(obj)] = obj
+    return copy.deepcopy(model, memo)
+
+
+@torch.no_grad()
+def fold_bn(layer, bn, scaling=1):
+    """
+    bn(layer(x * scaling)) of an eval-mode bn as one nn.Conv/nn.Linear layer, changed in place:
+    weight scaling * s * W and bias s * (b - running_mean) + beta, s = gamma / sqrt(running_var + eps)
+    per output channel.
+    """
+    s = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        s = s * bn.weight
+    bias = torch.zeros_like(bn.running_mean) if layer.bias is None else layer.bias
+    bias = (bias - bn.running_mean) * s
+    if bn.affine:
+        bias = bias + bn.bias
+    weight = layer.weight * (scaling * s).view(-1, *[1] * (layer.weight.dim() - 1))
+    layer.weight.data = weight.to(layer.weight.dtype)
+    if layer.bias is None:
+        layer.bias = nn.Parameter(bias.to(layer.weight.dtype), requires_grad=layer.weight.requires_grad)
+    else:
+        layer.bias.data = bias.to(layer.bias.dtype)
+    return layer
+
+
+def fold_for_inference(model, inplace=True):
+    """
+    Fold the scaling, conv biases and BNs of every NewGraphSetAbstraction/FeaturePropagation into
+    its conv weights and biases, and the BNs of the hidden fc layers of the cls models into those
+    layers. An eval forward then runs one conv per layer, not the scaling, conv and BN passes over
+    the largest activations; the outputs are the same up to rounding. The readout fc has an
+    activation and max pool before it, it stays as it is.
+
+    A layer is folded only if all of its convs are software convs with stored weights, as they
+    share its scaling; hardware-mode and procedural layers are left unfolded. The relative weight
+    noise of the noise modes scales with the folded rows, so noisy layers fold as well.
+
+    The folded model is for eval and serving: its BNs are nn.Identity and its scaling None, and its
+    conv weights are no longer the conductance differences of cond_dict. Its state_dict loads into
+    a model of the same arguments that has been folded too.
+    Input:
+        inplace: False folds a copy, see shared_copy, and leaves the model trainable
+    Return:
+        the folded model in eval mode
+    """
+    if not inplace:
+        model = shared_copy(model)
+    model.eval()
+    # the models import noise_layers by another module name, so the layers are found by attribute
+    for layer in model.modules():
+        if not hasattr(layer, 'mlp_convs') or getattr(layer, 'scaling', None) is None:
+            continue
+        if any(conv.hardware or getattr(conv, 'procedural', None) is not None
+               for conv in layer.mlp_convs):
+            continue
+        if not all(isinstance(bn, nn.modules.batchnorm._BatchNorm) and bn.track_running_stats
+                   for bn in layer.mlp_bns):
+            continue
+        for i, conv in enumerate(layer.mlp_convs):
+            fold_bn(conv.conv, layer.mlp_bns[i], layer.scaling)
+            layer.mlp_bns[i] = nn.Identity()
+        layer.scaling = None
+
+    fc, bns = getattr(model, 'fc', None), getattr(model, 'bn', None)
+    if isinstance(fc, nn.ModuleList) and isinstance(bns, nn.ModuleList):
+        for i, bn in enumerate(bns):
+            if isinstance(bn, nn.BatchNorm1d) and bn.track_running_stats:
+                fold_bn(fc[i].linear, bn)
+                bns[i] = nn.Identity()
+    return model
+
+
 def get_activation(activation):
     if activation == 'relu':
         return F.relu
@@ -6,6 +6,21 @@ import torch.nn.functional as F
 # import backend
 
 
+class ProceduralConv(torch.autograd.Function):
+    '''
+    x [B, in, L] -> [B, out, L] through the procedural weight of a layer. The backward
+    regenerates the weight tiles for W^T grad instead of saving them, and saves nothing of x.
+    '''
+    @staticmethod
+    def forward(ctx, x, layer):
+        ctx.layer = layer
+        return layer.procedural_matmul(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return ctx.layer.procedural_matmul(grad.contiguous(), transpose=True), None
+
+
 class NoiseModule(nn.Module):
     def __init__(self):
         super(NoiseModule, self).__init__()
@@ -21,11 +36,427 @@ class NoiseModule(nn.Module):
         new_w = weight * noise * torch.randn_like(weight)
         return new_w.to(weight.device)
 
+    def pointwise(self, conv, x, weight=None):
+        '''
+        1x1 conv with the parameters of conv, or with weight and no bias. A grouped one runs as
+        a batched matmul over the groups; CPU grouped convs are several times slower than
+        running the groups one after another.
+        '''
+        bias = conv.bias if weight is None else None
+        weight = conv.weight if weight is None else weight
+        if conv.groups == 1:
+            return (F.conv2d if x.dim() == 4 else F.conv1d)(x, weight, bias)
+        B, G = x.shape[0], conv.groups
+        weight = weight.view(G, conv.out_channels // G, -1)
+        out = torch.matmul(weight, x.reshape(B, G, weight.shape[-1], -1))   # [B, G, out / G, L]
+        out = out.view(B, conv.out_channels, *x.shape[2:])
+        if bias is not None:
+            out += bias.view(-1, *[1] * (x.dim() - 2))
+        return out
+
+    def reparam_noise(self, x, weight, op, detach_input=True):
+        '''
+        Output noise of the weight noise W * noise * eps with a fresh eps for every sample and
+        point, drawn directly: every output is an independent Gaussian with variance
+        noise^2 * (W^2)(x^2), so op(x^2, W^2) and one randn replace the per-point noisy weights.
+        Input:
+            op: the layer's linear map as a function of (input, weight), without bias
+            detach_input: stop the gradient into x as well as into the weight, as the convs'
+                noised_forward does; NoiseLinear's loop passes it through the noisy weights
+        '''
+        weight = weight.detach()
+        if detach_input:
+            x = x.detach()
+        var = op(x * x, weight * weight).clamp(min=0)
+        # the sqrt has an infinite derivative at 0, e.g. after a relu: take it of 1 there and mask the
+        # result, the forward is var.sqrt() exactly and the gradient of a zero variance is 0
+        positive = var > 0
+        std = torch.where(positive, var, torch.ones_like(var)).sqrt() * positive
+        return std * self.noise * torch.randn_like(std)
+
+    def channel_wise_codes(self, x):
+        '''
+        Integer codes in [0, quant_levels] of the channel-wise input quantization, [B, C, ...],
+        with the per-point step scaling and minimum b, [B, 1, ...], x = codes * scaling + b.
+        The codes are uint8, one byte per element; bit_plane unpacks them one bit at a time.
+        '''
+        x = x.detach()
+        channel_max = torch.max(x, dim=1, keepdim=True)[0]
+        channel_min = torch.min(x, dim=1, keepdim=True)[0]
+        scaling = ((channel_max - channel_min) / self.quant_levels).to(torch.float64)
+        # the float64 quotient is formed a chunk of samples at a time within self.vmm_budget bytes
+        codes = torch.empty_like(x, dtype=torch.uint8)
+        chunk = max(1, self.vmm_budget // (x[0].numel() * 8))
+        for start in range(0, x.shape[0], chunk):
+            end = start + chunk
+            codes[start:end] = torch.round((x[start:end] - channel_min[start:end]) / scaling[start:end])
+        return codes, scaling, channel_min.to(torch.float64)
+
+    def static_codes(self, x):
+        '''
+        Codes of the frozen calibration ranges, see start_calibration. The steps of the input
+        channels are written as scaling * gain with gain <= 1, so the bit planes (times gain) stay
+        within the binary input range of the crossbar. No reductions over x and no state writes.
+        Return:
+            codes [B, C, ...], scaling [1], b [1, C or 1, ...], gain [C] or None
+        '''
+        step, zero = self.quant_step.to(torch.float64), self.quant_zero.to(torch.float64)
+        scaling = step.max().view(1)
+        gain = (step / scaling).flatten() if step.numel() > 1 else None
+        codes = torch.round((x.detach() - zero) / step).clamp(0, self.quant_levels).to(torch.uint8)
+        return codes, scaling, zero, gain
+
+    def input_codes(self, x):
+        '''(codes, scaling, b, gain) of the static ranges once frozen, else of the per-point ranges'''
+        if self.quant_step is not None:
+            return self.static_codes(x)
+        if self.calibrating is not None:
+            self.observe(x)
+        return (*self.channel_wise_codes(x), None)
+
+    def start_calibration(self, granularity='layer'):
+        '''
+        Collect the input range of the hardware modes over the following forwards, per layer or per
+        input channel, in place of the per-point ranges. freeze_calibration turns it into a static
+        step and zero point, the fixed range of a DAC front-end.
+        '''
+        assert granularity in ['layer', 'channel'], 'granularity must be layer or channel!'
+        self.calibrating = granularity
+        self.quant_step, self.quant_zero = None, None
+        self.calib_min, self.calib_max = None, None
+
+    def observe(self, x):
+        x = x.detach().to(torch.float64)
+        dims = [d for d in range(x.dim()) if d != 1 or self.calibrating == 'layer']
+        x_min, x_max = torch.amin(x, dim=dims, keepdim=True), torch.amax(x, dim=dims, keepdim=True)
+        if self.calib_min is not None:
+            x_min, x_max = torch.minimum(x_min, self.calib_min), torch.maximum(x_max, self.calib_max)
+        self.calib_min, self.calib_max = x_min, x_max
+
+    def freeze_calibration(self):
+        assert self.calib_min is not None, 'no batch was seen since start_calibration'
+        self.quant_step = ((self.calib_max - self.calib_min) / self.quant_levels).clamp(min=1e-12).float()
+        self.quant_zero = self.calib_min.float()
+        self.calibrating, self.calib_min, self.calib_max = None, None, None
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the calibration buffers are None until frozen, take their shape from the checkpoint
+        for name in ['quant_step', 'quant_zero']:
+            if prefix + name in state_dict and name in self._buffers:
+                self._buffers[name] = torch.empty_like(state_dict[prefix + name])
+        super(NoiseModule, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def zero_offset(self, b, weight):
+        '''
+        weight [out, C] applied to the zero point b, broadcastable to the output: b is per point,
+        [B, 1, ...], or per input channel, [1, C, ...].
+        '''
+        weight = weight.to(torch.float64)
+        if b.shape[1] == 1:
+            return b * weight.sum(1).view(1, -1, *[1] * (b.dim() - 2))
+        return torch.matmul(b.movedim(1, -1), weight.t()).movedim(-1, 1)
+
+    def gained_weight(self, weight, gain):
+        '''[out, in / groups, ...] conv weight times the per input channel gain'''
+        if gain is None:
+            return weight
+        G = self.conv.groups
+        gain = gain.view(G, 1, -1).to(weight)
+        return (weight.reshape(G, weight.shape[0] // G, -1) * gain).view_as(weight)
+
+    def procedural_forward(self, x):
+        '''
+        1x1 conv with the weights of self.procedural, see models.procedural.ProceduralWeight.
+        The weight noise is drawn as in reparam_noise, from the regenerated squared weights.
+        '''
+        B, C = x.shape[:2]
+        out = ProceduralConv.apply(x.reshape(B, C, -1), self)
+        if self.noise:
+            x2 = x.detach().reshape(B, C, -1) ** 2
+            std = self.procedural_matmul(x2, square=True).clamp(min=0).sqrt()
+            out = out + std * self.noise * torch.randn_like(std)
+        out = out.view(B, -1, *x.shape[2:])
+        if self.conv.bias is not None:
+            out = out + self.conv.bias.view(-1, *[1] * (x.dim() - 2))
+        return out
+
+    def procedural_matmul(self, x, transpose=False, square=False):
+        '''
+        [B, in, L] -> [B, out, L] through the procedural weight, or [B, out, L] -> [B, in, L]
+        through its transpose, with one tile of output channels of the weight alive at a time.
+        '''
+        conv, weights = self.conv, self.procedural
+        G = conv.groups
+        n_out, n_in = conv.out_channels // G, conv.in_channels // G
+        tiles = weights.tiles(n_out)
+        B, L = x.shape[0], x.shape[-1]
+        x = x.view(B, G, -1, L)
+        out = x.new_zeros(B, G, n_in if transpose else n_out, L)
+        for g in range(G):
+            for t, (start, end) in enumerate(tiles):
+                w = weights.tile(self.procedural_code, g * len(tiles) + t, (end - start, n_in), x.device, x.dtype)
+                if square:
+                    w = w * w
+                if transpose:
+                    out[:, g] += torch.matmul(w.t(), x[:, g, start:end])
+                else:
+                    out[:, g, start:end] = torch.matmul(w, x[:, g])
+        return out.view(B, -1, L)
+
+    def block_sparse_weight(self):
+        '''
+        self.conv.weight in blocks of self.sparse_block = (rows, cols) of every group's
+        [out / G, in / G] matrix, its all-zero blocks dropped. Every row of blocks keeps k blocks,
+        k the most nonzero blocks of any row, the short rows padded with zero blocks, as one
+        [rows, k * cols] matrix. Rebuilt when the weight changes.
+        Return:
+            weight [G * row blocks, rows, k * cols], and the input channels [G * row blocks, k * cols]
+            they read; the columns past the edge of a group have zero weight and read its first channel
+        '''
+        weight = self.conv.weight
+        key = (weight.data_ptr(), weight._version, weight.dtype, self.sparse_block)
+        if getattr(self, 'block_sparse_key', None) == key:
+            return self.block_sparse_cache
+        G = self.conv.groups
+        n_out, n_in = self.conv.out_channels // G, self.conv.in_channels // G
+        # a block larger than the matrix covers all of it, as in utils.block_mask
+        rows, cols = min(self.sparse_block[0], n_out), min(self.sparse_block[1], n_in)
+        R, C = -(-n_out // rows), -(-n_in // cols)
+        w = F.pad(weight.detach().reshape(G, n_out, n_in), (0, C * cols - n_in, 0, R * rows - n_out))
+        blocks = w.view(G, R, rows, C, cols).transpose(2, 3)               # [G, R, C, rows, cols]
+        nonzero = blocks.flatten(3).ne(0).any(-1)                            # [G, R, C]
+        k = max(int(nonzero.sum(-1).max()), 1)
+        # the nonzero blocks of a row first, in column order
+        idx = torch.sort((~nonzero).to(torch.uint8), dim=-1, stable=True)[1][..., :k]
+        packed = blocks.gather(2, idx[..., None, None].expand(-1, -1, -1, rows, cols))
+        packed = packed.transpose(2, 3).reshape(G * R, rows, k * cols)
+        channels = idx.unsqueeze(-1) * cols + torch.arange(cols, device=idx.device)
+        offset = torch.arange(G, device=idx.device).view(G, 1, 1, 1) * n_in
+        channels = (torch.where(channels < n_in, channels, 0) + offset).view(G * R, k * cols)
+        self.block_sparse_key = key
+        self.block_sparse_cache = packed.contiguous(), channels
+        return self.block_sparse_cache
+
+    def block_sparse_forward(self, x):
+        '''
+        1x1 conv with the weight of block_sparse_weight: every row of blocks is one matmul of its
+        [rows, k * cols] weight with the k * cols input channels it reads. Per sample, the
+        channels of all rows are gathered for a chunk of points that fits in self.vmm_budget
+        bytes, and at most 4 MB, and the rows run as one bmm. A weight that takes gradients runs dense.
+        Every gathered channel is read by only rows outputs, so on CPU the block-sparse conv is
+        faster than the dense one only for blocks that span all outputs of a group, i.e. zero
+        input channels, and 1.2x at 50% sparsity; 128 of 256 rows are 0.9x and 8x8 blocks 2-5x
+        slower, see bench_grouping --bench blocksparse. With no column block dropped it runs dense.
+        '''
+        conv = self.conv
+        if conv.weight.requires_grad and torch.is_grad_enabled():
+            return self.pointwise(conv, x)
+        weight, channels = self.block_sparse_weight()
+        G = conv.groups
+        n_out, n_in = conv.out_channels // G, conv.in_channels // G
+        n_rows, rows, width = weight.shape
+        if width >= n_in:
+            # no column block dropped
+            return self.pointwise(conv, x)
+        B, L = x.shape[0], x[0, 0].numel()
+        x_in = x.reshape(B, -1, L)
+        channels = channels.flatten()
+        out = x.new_empty(B, n_rows, rows, L)
+        # gathered inputs of at most 4 MB stay in the cache, larger chunks measured up to 2x slower
+        chunk = max(1, min(self.vmm_budget, 2 ** 22) // (n_rows * width * x.element_size()))
+        for b in range(B):
+            for start in range(0, L, chunk):
+                end = min(start + chunk, L)
+                x_g = x_in[b, :, start:end].index_select(0, channels).view(n_rows, width, end - start)
+                if end - start == L:
+                    torch.bmm(weight, x_g, out=out[b])
+                else:
+                    out[b, ..., start:end] = torch.bmm(weight, x_g)
+        out = out.view(B, G, -1, L)[:, :, :n_out].reshape(B, conv.out_channels, *x.shape[2:])
+        if conv.bias is not None:
+            out += conv.bias.view(-1, *[1] * (x.dim() - 2))
+        return out
+
+    def bit_plane(self, x_int, b, dtype=torch.float64):
+        '''bit b of the codes from channel_wise_codes as 0/1 in dtype, [B, C, ...]'''
+        return torch.bitwise_and(torch.bitwise_right_shift(x_int, b), 1).to(dtype)
+
+    def plane_dtype(self, weight, max_input=1):
+        '''
+        float32 if a conv of integer inputs in [0, max_input] with weight is exact in float32, else
+        float64. All weights are multiples of the grid q, the smallest lowest set bit among them, so
+        every partial sum of an integer input is a multiple of q bounded by max_input times the
+        largest row sum of |weight|; it is exact when that bound is at most 2^24 q. This holds for
+        weights on a coarse grid (conductance levels), not for arbitrary float32 weights, whose
+        convs stay in float64. max_input is 1 for bit planes and quant_levels for the codes.
+        '''
+        weight = weight.detach().float().reshape(weight.shape[0], -1)
+        nonzero = weight[weight != 0]
+        if nonzero.numel() == 0:
+            return torch.float32
+        mantissa, exponent = torch.frexp(nonzero)
+        mantissa = (mantissa.abs() * 2 ** 24).to(torch.int64)
+        q = (torch.bitwise_and(mantissa, -mantissa).double() * torch.exp2(exponent.double() - 24)).min()
+        exact = weight.double().abs().sum(1).max() * max_input <= q * 2 ** 24
+        return torch.float32 if exact else torch.float64
+
+    def integer_inference(self, x_int, scaling, b, gain=None):
+        '''
+        Hardware inference with static weights. The bit planes x_b of the codes are read with
+        the same weights, so sum_b 2^b conv(x_b) = conv(x_int) and one conv on the codes gives
+        the per-bit result. The conv runs in float32 when plane_dtype proves it exact for codes
+        up to quant_levels, else in float64 like the per-bit path; both agree to float64
+        rounding, far below the float32 output. The quantization minimum b adds its conv and
+        the bias. All of it runs a chunk of samples at a time within self.vmm_budget bytes, so
+        the uint8 codes and the output are the only full-size tensors.
+        Input:
+            x_int, scaling, b, gain: codes and ranges from input_codes, [B, C, ...]
+        '''
+        weight = self.conv.weight.detach()
+        dtype = self.plane_dtype(weight, self.quant_levels) if gain is None else torch.float64
+        conv_weight = self.gained_weight(weight.to(torch.float64), gain).to(dtype)
+        dense = self.dense_weight(weight, self.conv.groups)
+        bias = None if self.conv.bias is None else \
+            self.conv.bias.detach().to(torch.float64).view(1, -1, *[1] * (x_int.dim() - 2))
+        B = x_int.shape[0]
+        out = None
+        chunk = max(1, self.vmm_budget // (x_int[0].numel() * 8))
+        for start in range(0, B, chunk):
+            end = start + chunk
+            scaling_c, b_c = [t[start:end] if t.shape[0] == B else t for t in (scaling, b)]
+            out_c = self.pointwise(self.conv, x_int[start:end].to(dtype), conv_weight).to(torch.float64)
+            out_c *= scaling_c
+            out_c += self.zero_offset(b_c, dense)
+            if bias is not None:
+                out_c += bias
+            if out is None:
+                out = out_c.new_empty(B, *out_c.shape[1:])
+            out[start:end] = out_c
+        return out
+
+    def read_weights(self, P):
+        '''
+        P weight realisations of the crossbar from self.hard_weight, [P, out, in], and their
+        biases, [P, out]. Backends with a sample(conv, code, P) method draw them in one go.
+        '''
+        if hasattr(self.hard_weight, 'sample'):
+            return self.hard_weight.sample(self.conv, self.code, P)
+        weights, biases = [], []
+        for _ in range(P):
+            weight = self.hard_weight(self.conv, self.code)
+            weight, bias = weight if type(weight) is tuple else (weight, self.conv.bias)
+            weights.append(weight.reshape(weight.shape[0], -1))
+            biases.append(bias)
+        return torch.stack(weights), torch.stack(biases)
+
+    def read_outputs(self, x):
+        '''
+        One crossbar read per input vector, each with its own weight realisation.
+        Backends with a read(conv, code, x) method (GaussianReadNoise, CrossbarEngine) return
+        the outputs of all reads at once. The others are read one vector at a time as in the
+        reference loop: drawing P realisations for one bmm needs as many random numbers and
+        measured slower than the loop, see bench_grouping --bench vmm.
+        Input:
+            x: input vectors, [P, in]
+        Return:
+            [P, out]
+        '''
+        if hasattr(self.hard_weight, 'read'):
+            return self.hard_weight.read(self.conv, self.code, x)
+        out = x.new_empty(x.shape[0], self.conv.out_channels)
+        for i in range(x.shape[0]):
+            weight, _ = self.read_weights(1)
+            out[i] = torch.mv(weight[0].to(x), x[i])
+        return out
+
+    def vmm_inference(self, x_int, scaling, b, gain=None):
+        '''
+        Vectorized vmm mode. As in the per-vector reference loop of bench_grouping, every bit plane
+        of every input vector is one crossbar read with its own weight realisation, and the
+        offset of the quantization minimum uses one more read. The reads run P vectors at a
+        time through read_outputs, P is set so that their inputs and outputs fit in
+        self.vmm_budget bytes (or P reads, for backends that report their read_bytes(conv, code)
+        per vector).
+        Input:
+            x_int, scaling, b, gain: codes and ranges from input_codes, [B, C, ...]; the bit planes
+            are read times gain
+        Return:
+            [B, out, ...], float64
+        '''
+        B, C = x_int.shape[:2]
+        spatial = x_int.shape[2:]
+        out_channels = self.conv.out_channels
+        rows = x_int.detach().movedim(1, -1).reshape(-1, C)    # [V, C], one row per input vector
+        if hasattr(self.hard_weight, 'read_bytes'):
+            row_bytes = self.hard_weight.read_bytes(self.conv, self.code)
+        else:
+            row_bytes = (out_channels + C) * 8
+        P = max(1, self.vmm_budget // row_bytes)
+
+        gain = 1 if gain is None else gain.to(torch.float64)
+        out = torch.zeros(rows.shape[0], out_channels, dtype=torch.float64, device=rows.device)
+        for bit in range(self.quant_bit):
+            for start in range(0, rows.shape[0], P):
+                out[start:start + P] += self.read_outputs(self.bit_plane(rows[start:start + P], bit) * gain) * self.quant_base[bit]
+        out = out.view(B, *spatial, out_channels).movedim(-1, 1) * scaling
+
+        weight, bias = self.read_weights(1)
+        shape = (1, -1, *[1] * len(spatial))
+        out += self.zero_offset(b, weight[0]) + bias[0].to(out).view(shape)
+        return out
+
+    def dense_weight(self, weight, groups=1):
+        '''[out, in / groups, 1(, 1)] conv weight as the [out, in] matrix, block diagonal for grouped convs'''
+        weight = weight.reshape(weight.shape[0], -1)
+        if groups == 1:
+            return weight
+        return torch.block_diag(*weight.chunk(groups, 0))
+
+
+class GaussianReadNoise(object):
+    '''
+    Software crossbar for hard_mode='vmm': every read returns the conv weight with fresh
+    multiplicative Gaussian noise, W + W * noise * eps, and the noise-free bias.
+    read() draws the outputs of the reads directly instead of their weights.
+
+    Usage:
+        hardweight = GaussianReadNoise(0.05)
+        NoiseConv(in_channels, out_channels, hard_weight=hardweight, mode='vmm')
+    '''
+    def __init__(self, noise):
+        self.noise = noise
+
+    def register(self, layer, bias=True):
+        return None
+
+    def __call__(self, conv, code):
+        weight = conv.weight.detach()
+        return weight + weight * self.noise * torch.randn_like(weight), conv.bias.detach()
+
+    def sample(self, conv, code, P):
+        weight = conv.weight.detach().reshape(conv.out_channels, -1)
+        weights = weight + weight * self.noise * torch.randn(P, *weight.shape, dtype=weight.dtype, device=weight.device)
+        return weights, conv.bias.detach().expand(P, -1)
+
+    def read(self, conv, code, x):
+        '''
+        Outputs of one read per row of x, [P, in] -> [P, out]. The rows of a noisy weight are
+        independent, so every output is an independent Gaussian with mean Wx and variance
+        noise^2 * (W^2)(x^2), the same reparameterisation as NoiseModule.reparam_noise.
+        '''
+        weight = conv.weight.detach().reshape(conv.out_channels, -1).to(x)
+        std = torch.matmul(x * x, (weight * weight).t()).sqrt()
+        return torch.matmul(x, weight.t()) + std * self.noise * torch.randn_like(std)
+
 
 class NoiseLinear(NoiseModule):
-    def __init__(self, in_features, out_features, sample_noise=False, noise=0, is_train=True, is_hard=False):
+    def __init__(self, in_features, out_features, sample_noise=False, noise=0, is_train=True, is_hard=False,
+                 noise_mode='weight'):
         super(NoiseLinear, self).__init__()
         self.noise = noise
+        # weight: draw a noisy weight per sample, reparam: draw the output noise, see reparam_noise
+        assert noise_mode in ['weight', 'reparam'], 'noise_mode must be weight or reparam!'
+        self.noise_mode = noise_mode
         self.out_features = out_features
         self.linear = nn.Linear(in_features, out_features)
         self.sample_noise = sample_noise
@@ -39,6 +470,8 @@ class NoiseLinear(NoiseModule):
         #     return self.linear(x) + self.noised_foward(x)
         # else:
         #     return self.linear(x) + self.noised_inference(x)
+        elif self.noise_mode == 'reparam':
+            return self.linear(x) + self.reparam_noise(x, self.linear.weight, F.linear, detach_input=False)
         else:
             return self.linear(x) + self.noised_forward(x)
 
@@ -80,45 +513,77 @@ class NoiseLinear(NoiseModule):
 class NoiseConv(NoiseModule):
     def __init__(self, in_channels, out_channels,
                  kernel_size=1, sample_noise=False, noise=0,
-                 hard_weight=None, mode='batch', quant=6):
+                 hard_weight=None, mode='batch', quant=6, groups=1, noise_mode='weight',
+                 vmm_budget=None, procedural=None, hardware=False):
         super(NoiseConv, self).__init__()
         self.noise = noise
-        self.conv = nn.Conv2d(in_channels, out_channels, kernel_size)
+        # weight: draw noisy weights per point, reparam: draw the output noise, see reparam_noise
+        assert noise_mode in ['weight', 'reparam'], 'noise_mode must be weight or reparam!'
+        self.noise_mode = noise_mode
+        # groups > 1 runs independent weight blocks side by side, e.g. the members of an ensemble
+        self.conv = nn.Conv2d(in_channels, out_channels, kernel_size, groups=groups,
+                              device='meta' if procedural is not None else None)
+        # procedural weights are regenerated in forward, only the bias is a parameter
+        self.procedural = procedural
+        if procedural is not None:
+            assert hard_weight is None and not hardware and kernel_size == 1, 'procedural weights are software 1x1 convs'
+            assert not noise or noise_mode == 'reparam', 'procedural weights draw their noise with noise_mode reparam'
+            bound = (in_channels // groups) ** -0.5
+            self.conv.weight = None
+            self.conv.bias = nn.Parameter(torch.empty(out_channels).uniform_(-bound, bound))
+            self.procedural_code = procedural.register(self.conv)
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.sample_noise = sample_noise
         self.hard_weight = hard_weight
+        # run the integer simulation of mode: batch on the ideal weights, vmm on reads of hard_weight
+        self.hardware = hardware or hard_weight is not None
 
         # quant
         self.quant_bit = quant
         self.quant_levels = 2 ** quant - 1
-        self.quant_base = 2 ** torch.arange(quant).cuda()
+        self.register_buffer('quant_base', 2 ** torch.arange(quant), persistent=False)
         self.scaling, self.b = 1, 1
 
+        # static input ranges of the hardware modes, see start_calibration
+        self.register_buffer('quant_step', None)
+        self.register_buffer('quant_zero', None)
+        self.calibrating = None
+
         assert mode in ['vmm', 'batch', None], 'mode must be vmm or batch or None!'
+        # a read-noise or crossbar backend is only called by the vmm reads, batch mode would skip it
+        assert hard_weight is None or mode == 'vmm', 'a hard_weight backend needs mode vmm'
+        assert not self.hardware or mode is not None, 'hardware needs mode vmm or batch'
         self.mode = mode
 
         if mode == 'vmm':
+            assert groups == 1, 'vmm mode does not support grouped convs'
             self.code = self.hard_weight.register(layer=self.conv, bias=True)
         else:
             self.code = None
+        # bytes for the weight realisations of one vmm bmm, or the gathered inputs of one block-sparse bmm
+        self.vmm_budget = vmm_budget or 2 ** 24
+        # (rows, cols) blocks of a noise free software conv run block sparse, see set_block_sparse
+        self.sparse_block = None
 
     def forward(self, x):
-        if self.hard_weight is None:
-            if not self.noise:
-                return self.conv(x)
+        if self.procedural is not None:
+            return self.procedural_forward(x)
+        elif not self.hardware:
+            if not self.noise and self.sparse_block is not None:
+                return self.block_sparse_forward(x)
+            elif not self.noise:
+                return self.pointwise(self.conv, x)
+            elif self.noise_mode == 'reparam':
+                return self.pointwise(self.conv, x) + self.reparam_noise(
+                    x, self.conv.weight, lambda x2, w2: self.pointwise(self.conv, x2, w2))
             else:
-                return self.conv(x) + self.noised_forward(x)
+                return self.pointwise(self.conv, x) + self.noised_forward(x)
+        elif self.mode == 'vmm':
+            return self.vmm_inference(*self.input_codes(x)).to(torch.float)
         else:
-            # ori_x = x
-            x = self.channel_wise_quantize(x)
-
-                # for b in range(x.shape[-1]):
-                    # out_b = self.hardware_inference(x[:, :, :, :, b])
-                    # out_b = F.conv2d(x[:, :, :, :, b], self.conv.weight.to(torch.float64), stride=1, padding=0)
-                    # out.append(out_b) 
-            out = self.hardware_inference(x)
-            return out.to(torch.float)
+            # static weights (batch), one conv on the integer codes instead of one per bit plane
+            return self.integer_inference(*self.input_codes(x)).to(torch.float)
 
     def quantize(self, x, quant_bits=6):
         # quantize the input x into 6 bits binary numbers
@@ -138,23 +603,6 @@ class NoiseConv(NoiseModule):
         x_binary = x_binary.to(torch.float)
         return x_binary
 
-    def channel_wise_quantize(self, x):
-        # quantize the input x into 6 bits binary numbers channel-wisely
-        x = x.detach() # (batch_size, channels, nsamples, npoints)
-        # scaling
-        # a = torch.max(torch.abs(x), dim=1, keepdim=True)[0]
-        channel_max = torch.max(x, dim=1, keepdim=True)[0]
-        channel_min = torch.min(x, dim=1, keepdim=True)[0]
-        self.scaling = (channel_max - channel_min) / self.quant_levels
-        self.scaling = self.scaling.to(torch.float64)
-        self.b = channel_min.to(torch.float64)
-
-        # cast to integers
-        x_int = torch.round((x - channel_min) / self.scaling).to(torch.int64)
-        x_binary = x_int.unsqueeze(-1).bitwise_and(self.quant_base).ne(0).byte()
-        x_binary = x_binary.to(torch.float64)
-        return x_binary
-
     def dequantize(self, x, quant):
         x = x.detach()
         x = x * (2 ** quant)
@@ -172,52 +620,30 @@ class NoiseConv(NoiseModule):
         out -= (self.quant_levels - 0) * self.scaling * conv_b
         return out
 
-    def hardware_inference(self, x):
+    def hardware_inference(self, x, scaling, b, gain=None):
+        '''
+        Batch mode with one conv for every bit plane of the codes, the reference of integer_inference.
+        The planes are unpacked from the uint8 codes one at a time and their outputs summed as
+        they come, so only one plane and one output are alive besides the codes.
+        Input:
+            x, scaling, b, gain: codes and ranges from input_codes, [B, C, nsamples, npoints]
+        '''
         x = x.detach()
 
-        batch_size, in_features, nsamples, npoints, quant_bit = x.size()
-        x_bits = []
-        #TODO: only support quantization now.
-        # to support for no quantization situation.
-        for b in range(quant_bit):
-            x_bit = x[:, :, :, :, b]
-            if self.mode == 'batch':
-                x_bit = F.conv2d(x[:, :, :, :, b], self.conv.weight.to(torch.float64), stride=1, padding=0)
-                weight, bias = self.conv.weight, self.conv.bias
-            if self.mode == 'vmm':
-                # x = x.reshape(-1, in_features, 1, 1)
-                x_new = []
-                for i in range(x_bit.shape[0]):
-                    x_sample = []
-                    for j in range(x_bit.shape[2]):
-                        x_group = []
-                        for z in range(x_bit.shape[3]):
-                            # xi = x_bit[i, :, j-1:j+1, z-1:z+1].unsqueeze(0).unsqueeze(-1).unsqueeze(-1)   # for 3x3 conv
-                            xi = x_bit[i, :, j, z].unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-                            weight = self.hard_weight(self.conv, self.code)
-                            if type(weight) is tuple:
-                                weight, bias = weight
-                            else:
-                                bias = self.conv.bias
-                            weight, bias = weight.to(x.device).to(x.dtype), bias.to(x.device).to(x.dtype)
-                            if (self.conv.weight - weight).mean() > 2:
-                                print(f'large error {(self.conv.weight - weight).mean()} at {i, j, z}')
-                            # move the bias out
-                            xi = F.conv2d(xi, weight, stride=1, padding=0)
-                            x_group.append(xi)
-                        x_group = torch.cat(x_group, 3) # [1, out_feat, 1, npoints]
-                        x_sample.append(x_group)
-                    x_sample = torch.cat(x_sample, 2) # [1, out-feat, nsamples, npoints]
-                    x_new.append(x_sample)
-
-                x_bit = torch.cat(x_new, 0) # [batch, out_feat, nsamples, npoints]
-            x_bits.append(x_bit)
-
-        # dequant
-        out_bits = [x_bits[i] * self.quant_base[i] for i in range(len(x_bits))]
-        out_sum = sum(out_bits)
-        out_w = out_sum * self.scaling 
-        out_w += F.conv2d(self.b * torch.ones_like(x[:, :, :, :, 0]), weight.to(torch.float64), bias=bias.to(torch.float64))
+        dtype = self.plane_dtype(self.conv.weight) if gain is None else torch.float64
+        weight, bias = self.conv.weight, self.conv.bias
+        out_sum = 0
+        for bit in range(self.quant_bit):
+            x_bit = self.bit_plane(x, bit, dtype)
+            if gain is not None:
+                x_bit = x_bit * gain.to(dtype).view(1, -1, *[1] * (x.dim() - 2))
+            x_bit = F.conv2d(x_bit, weight.to(dtype), stride=1, padding=0, groups=self.conv.groups).to(torch.float64)
+            # dequant
+            out_sum = out_sum + x_bit * self.quant_base[bit]
+
+        out_w = out_sum * scaling 
+        out_w += F.conv2d(b * torch.ones_like(x, dtype=torch.float64), weight.to(torch.float64), bias=bias.to(torch.float64),
+                          groups=self.conv.groups)
         return out_w
 
     def noised_inference(self, x):
@@ -246,14 +672,14 @@ class NoiseConv(NoiseModule):
         # nsamples: number of points in the neigbor of each centroid.
         batch_size, in_features, nsamples, npoints = x.size()
         # x = x.reshape(1, in_features, 1, -1)
-        x = x.reshape(-1, in_features, 1, 1)
+        x = x.permute(0, 2, 3, 1).reshape(-1, in_features, 1, 1)    # one row per point
 
         origin_weight = self.conv.weight
         x_new = torch.zeros(x.shape[0], self.out_channels, 1, 1)
 
         for i in range(x.shape[0]):
             noise_weight= self.gen_noise(origin_weight, self.noise).detach()#.suqeeze()# .detach()
-            noise_weight = noise_weight.squeeze()
+            noise_weight = self.dense_weight(noise_weight, self.conv.groups)
             # noise_conv = noise_weight
             # del noise_weight
             x_i = x[i, :, :, :].squeeze(-1)#.unsqueeze(-1)
@@ -261,99 +687,107 @@ class NoiseConv(NoiseModule):
             x_new[i, :, :, :] = x_i.unsqueeze(-1)    # (batch_size, out_features)
             del noise_weight, x_i
 
-        x_new = x_new.reshape(batch_size, self.out_channels, nsamples, npoints)
+        x_new = x_new.reshape(batch_size, nsamples, npoints, self.out_channels).permute(0, 3, 1, 2)
         return x_new.to(x.device).detach()
 
 
 class NoiseConv1d(NoiseModule):
     def __init__(self, in_channels, out_channels,
                  kernel_size=1, sample_noise=False, noise=0,
-                 hard_weight=None, mode='batch', quant=6):
+                 hard_weight=None, mode='batch', quant=6, groups=1, noise_mode='weight',
+                 vmm_budget=None, procedural=None, hardware=False):
         super(NoiseConv1d, self).__init__()
         self.noise = noise
-        self.conv = nn.Conv1d(in_channels, out_channels, kernel_size)
+        # weight: draw noisy weights per point, reparam: draw the output noise, see reparam_noise
+        assert noise_mode in ['weight', 'reparam'], 'noise_mode must be weight or reparam!'
+        self.noise_mode = noise_mode
+        # groups > 1 runs independent weight blocks side by side, e.g. the members of an ensemble
+        self.conv = nn.Conv1d(in_channels, out_channels, kernel_size, groups=groups,
+                              device='meta' if procedural is not None else None)
+        # procedural weights are regenerated in forward, only the bias is a parameter
+        self.procedural = procedural
+        if procedural is not None:
+            assert hard_weight is None and not hardware and kernel_size == 1, 'procedural weights are software 1x1 convs'
+            assert not noise or noise_mode == 'reparam', 'procedural weights draw their noise with noise_mode reparam'
+            bound = (in_channels // groups) ** -0.5
+            self.conv.weight = None
+            self.conv.bias = nn.Parameter(torch.empty(out_channels).uniform_(-bound, bound))
+            self.procedural_code = procedural.register(self.conv)
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.sample_noise = sample_noise
         self.hard_weight = hard_weight
+        # run the integer simulation of mode: batch on the ideal weights, vmm on reads of hard_weight
+        self.hardware = hardware or hard_weight is not None
 
         # quant
         self.quant_bit = quant
         self.quant_levels = 2 ** quant - 1
-        self.quant_base = 2 ** torch.arange(quant).cuda()
+        self.register_buffer('quant_base', 2 ** torch.arange(quant), persistent=False)
         self.scaling, self.b = 0, 0
 
+        # static input ranges of the hardware modes, see start_calibration
+        self.register_buffer('quant_step', None)
+        self.register_buffer('quant_zero', None)
+        self.calibrating = None
+
         assert mode in ['vmm', 'sample', 'batch', None], 'mode must be vmm or batch or sample or None!'
+        # a read-noise or crossbar backend is only called by the vmm reads, batch mode would skip it
+        assert hard_weight is None or mode == 'vmm', 'a hard_weight backend needs mode vmm'
+        assert not self.hardware or mode is not None, 'hardware needs mode vmm or batch'
         self.mode = mode
 
         if mode == 'vmm':
+            assert groups == 1, 'vmm mode does not support grouped convs'
             self.code = self.hard_weight.register(layer=self.conv, bias=True)
         else:
             self.code = None
+        # bytes for the weight realisations of one vmm bmm, or the gathered inputs of one block-sparse bmm
+        self.vmm_budget = vmm_budget or 2 ** 24
+        # (rows, cols) blocks of a noise free software conv run block sparse, see set_block_sparse
+        self.sparse_block = None
 
     def forward(self, x):
-        if self.hard_weight is None:
-            if not self.noise:
-                return self.conv(x)
+        if self.procedural is not None:
+            return self.procedural_forward(x)
+        elif not self.hardware:
+            if not self.noise and self.sparse_block is not None:
+                return self.block_sparse_forward(x)
+            elif not self.noise:
+                return self.pointwise(self.conv, x)
+            elif self.noise_mode == 'reparam':
+                return self.pointwise(self.conv, x) + self.reparam_noise(
+                    x, self.conv.weight, lambda x2, w2: self.pointwise(self.conv, x2, w2))
             else:
-                return self.conv(x) + self.noised_forward(x)
+                return self.pointwise(self.conv, x) + self.noised_forward(x)
+        elif self.mode == 'vmm':
+            return self.vmm_inference(*self.input_codes(x)).to(torch.float)
         else:
-            ori_x = x
-            x = self.channel_wise_quantize(x)
-
-            out = self.hardware_inference(x)
-            return out.to(torch.float)
+            # static weights (batch), one conv on the integer codes instead of one per bit plane
+            return self.integer_inference(*self.input_codes(x)).to(torch.float)
 
-    def channel_wise_quantize(self, x):
-        # quantize the input x into 6 bits binary numbers channel-wisely
-        x = x.detach() # (batch_size, channels, nsamples, npoints)
-        # scaling
-        channel_max = torch.max(x, dim=1, keepdim=True)[0]
-        channel_min = torch.min(x, dim=1, keepdim=True)[0]
-        self.scaling = (channel_max - channel_min) / self.quant_levels
-        self.scaling = self.scaling.to(torch.float64)
-        self.b = channel_min.to(torch.float64)
-
-        # cast to integers
-        x_int = torch.round((x - channel_min) / self.scaling).to(torch.int64)
-        x_binary = x_int.unsqueeze(-1).bitwise_and(self.quant_base).ne(0).byte()
-        x_binary = x_binary.to(torch.float64)
-        return x_binary
-
-    def hardware_inference(self, x):
+    def hardware_inference(self, x, scaling, b, gain=None):
+        '''
+        Per-bit batch inference as in NoiseConv.hardware_inference.
+        Input:
+            x, scaling, b, gain: codes and ranges from input_codes, [B, C, npoints]
+        '''
         x = x.detach()
 
-        batch_size, in_features, npoints, quant_bit = x.size()
-        x_bits = []
-        #TODO: only support quantization now.
-        # to support for no quantization situation.
-        for b in range(quant_bit):
-            x_bit = x[:, :, :, b]
-            if self.mode == 'batch':
-                x_bit = F.conv1d(x[:, :, :, b], self.conv.weight.to(torch.float64), stride=1, padding=0)
-                weight, bias = self.conv.weight, self.conv.bias
-            if self.mode == 'vmm':
-                # x = x.reshape(-1, in_features, 1, 1)
-                x_new = []
-                # batch
-                for i in range(x_bit.shape[0]):
-                    x_sample = []
-                    # spatial
-                    for j in range(x_bit.shape[2]):
-                        xi = x_bit[i, :, j].unsqueeze(0).unsqueeze(-1)
-                        xi = backend.conv(xi, self.conv, self.code, stride=1, padding=0)
-                        x_sample.append(xi)
-                    x_sample = torch.cat(x_sample, 2) # [1, out-feat, nsamples]
-                    x_new.append(x_sample)
-
-                x_bit = torch.cat(x_new, 0) # [batch, out_feat, nsamples, npoints]
-            x_bits.append(x_bit)
-
-        # dequant
-        out_bits = [x_bits[i] * self.quant_base[i] for i in range(len(x_bits))]
-        out_sum = sum(out_bits)
-        out_w = out_sum * self.scaling 
-        out_w += F.conv1d(self.b * torch.ones_like(x[:, :, :, 0]), weight.to(torch.float64), bias=bias.to(torch.float64))
+        dtype = self.plane_dtype(self.conv.weight) if gain is None else torch.float64
+        weight, bias = self.conv.weight, self.conv.bias
+        out_sum = 0
+        for bit in range(self.quant_bit):
+            x_bit = self.bit_plane(x, bit, dtype)
+            if gain is not None:
+                x_bit = x_bit * gain.to(dtype).view(1, -1, *[1] * (x.dim() - 2))
+            x_bit = F.conv1d(x_bit, weight.to(dtype), stride=1, padding=0, groups=self.conv.groups).to(torch.float64)
+            # dequant
+            out_sum = out_sum + x_bit * self.quant_base[bit]
+
+        out_w = out_sum * scaling 
+        out_w += F.conv1d(b * torch.ones_like(x, dtype=torch.float64), weight.to(torch.float64), bias=bias.to(torch.float64),
+                          groups=self.conv.groups)
         return out_w
 
     def noised_forward(self, x):
@@ -369,20 +803,62 @@ class NoiseConv1d(NoiseModule):
         origin_weight = self.conv.weight
 
         if self.mode == 'sample':
-            x = x.reshape(-1, in_features, 1, 1)
+            x = x.permute(0, 2, 1).reshape(-1, in_features, 1, 1)    # one row per point
             x_new = torch.zeros(x.shape[0], self.out_channels, 1, 1)
 
             for i in range(x.shape[0]):
                 noise_weight= self.gen_noise(origin_weight, self.noise).detach()#.suqeeze()# .detach()
-                noise_weight = noise_weight.squeeze()
+                noise_weight = self.dense_weight(noise_weight, self.conv.groups)
                 x_i = x[i, :, :].squeeze(-1)#.unsqueeze(-1)
                 x_i = torch.matmul(noise_weight, x_i)
                 x_new[i, :, :] = x_i.unsqueeze(-1)    # (batch_size, out_features)
                 del noise_weight, x_i
-            x_new = x_new.reshape(batch_size, self.out_channels, npoints)
+            x_new = x_new.reshape(batch_size, npoints, self.out_channels).permute(0, 2, 1)
 
         elif self.mode == 'batch':
             noise_weight= self.gen_noise(origin_weight, self.noise).detach()
-            x_new = F.conv1d(x, noise_weight)
+            x_new = F.conv1d(x, noise_weight, groups=self.conv.groups)
 
         return x_new.to(x.device).detach()
+
+
+def start_calibration(model, granularity='layer'):
+    '''
+    Calibrate the input ranges of every hardware-mode conv of the model: run some batches
+    through it, then call freeze_calibration. See NoiseModule.start_calibration.
+    '''
+    # the models import this file as noise_layers, the scripts as models.noise_layers
+    layers = [m for m in model.modules() if hasattr(m, 'calibrating') and m.hardware]
+    for layer in layers:
+        layer.start_calibration(granularity)
+    return layers
+
+
+def freeze_calibration(model):
+    layers = [m for m in model.modules() if getattr(m, 'calibrating', None) is not None]
+    for layer in layers:
+        layer.freeze_calibration()
+    return layers
+
+
+def set_block_sparse(model, block):
+    '''
+    Run the noise free software 1x1 convs of the model as block-sparse matmuls over (rows, cols)
+    blocks, or dense again with block None. See NoiseModule.block_sparse_forward; it only pays
+    off where a block spans all output channels of a group, the whole zero blocks of
+    utils.block_mask are then zero input channels, so the convs with more outputs per group
+    than block rows, or no more inputs per group than block cols, stay dense.
+    Return:
+        the layers switched
+    '''
+    layers = [m for m in model.modules() if hasattr(m, 'sparse_block') and not m.hardware
+              and m.procedural is None and m.conv.kernel_size in [(1,), (1, 1)]]
+    for layer in layers:
+        layer.sparse_block = None
+    if block is None:
+        return layers
+    layers = [m for m in layers if block[0] >= m.conv.out_channels // m.conv.groups
+              and block[1] < m.conv.in_channels // m.conv.groups]
+    for layer in layers:
+        layer.sparse_block = tuple(block)
+    return layers
@@ -0,0 +1,78 @@
+import torch
+
+
+MASK64 = 2 ** 64 - 1
+
+
+def splitmix64(z):
+    z = (z + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+class ProceduralWeight(object):
+    '''
+    Random conv weights regenerated from a seed instead of stored, the procedural mode of
+    NoiseConv/NoiseConv1d: the layers keep only their bias, no [out, in] weight.
+
+    The weights are drawn as in utils.cond2weight, W = pos - neg with pos, neg ~ N(cond_mean,
+    cond_std) and a fraction sparsity of the cells of each set to zero. Every tile of rows
+    output channels of a layer comes from its own generator, seeded with a hash of
+    (seed, layer, tile) like a counter-based RNG, so the tiles are rebuilt independently and
+    in any order. The forward and backward of a layer regenerate one tile at a time, as the
+    physical array supplies its weights without a copy in memory. Unlike cond2weight the
+    zeros are drawn per cell, Bernoulli(sparsity), not as an exact count, and the draws follow
+    the generator of the device: the CPU and CUDA weights of a seed differ.
+
+    Usage:
+        weights = ProceduralWeight(seed=0, sparsity=0.5, rows=64)
+        model = get_model(..., procedural=weights)
+    '''
+    def __init__(self, seed=0, sparsity=0., rows=64, cond_mean=34.05538, cond_std=5.32269):
+        self.seed = seed
+        self.sparsity = sparsity
+        self.rows = rows
+        self.cond_mean = cond_mean
+        self.cond_std = cond_std
+        self.layers = []        # conv of every registered layer, indexed by its code
+
+    def register(self, layer):
+        self.layers.append(layer)
+        return len(self.layers) - 1
+
+    def key(self, code, tile):
+        '''64-bit generator seed of a tile'''
+        return splitmix64(splitmix64(splitmix64(self.seed) ^ code) ^ tile)
+
+    def tiles(self, out_channels):
+        '''(start, end) output channels of the tiles of a group'''
+        return [(start, min(start + self.rows, out_channels)) for start in range(0, out_channels, self.rows)]
+
+    def tile(self, code, tile, shape, device=None, dtype=torch.float):
+        '''weights of one tile, [rows, in / groups]'''
+        generator = torch.Generator(device=device)
+        generator.manual_seed(self.key(code, tile))
+        pos, neg = torch.randn(2, *shape, generator=generator, device=device) * self.cond_std + self.cond_mean
+        if self.sparsity:
+            keep = torch.rand(2, *shape, generator=generator, device=device) >= self.sparsity
+            pos, neg = pos * keep[0], neg * keep[1]
+        return (pos - neg).to(dtype)
+
+    def weight(self, conv, code, device=None):
+        '''the whole weight of a registered conv, [out, in / groups, 1(, 1)], for checks and export'''
+        G = conv.groups
+        n_out, n_in = conv.out_channels // G, conv.in_channels // G
+        tiles = self.tiles(n_out)
+        weight = [self.tile(code, g * len(tiles) + t, (end - start, n_in), device)
+                  for g in range(G) for t, (start, end) in enumerate(tiles)]
+        return torch.cat(weight).view(conv.out_channels, n_in, *conv.kernel_size)
+
+    def num_weights(self, conv):
+        return conv.out_channels * conv.in_channels // conv.groups
+
+    def summary(self):
+        return 'Procedural weights: seed %d, %d layers, %d weights in tiles of %d rows, sparsity %g' % (
+            self.seed, len(self.layers), sum(self.num_weights(conv) for conv in self.layers), self.rows,
+            self.sparsity)
+
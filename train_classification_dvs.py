@@ -15,8 +15,16 @@ from pathlib import Path
 from tqdm import tqdm
 from data_utils.ModelNetDataLoader import ModelNetDataLoader
 from dvs_dataset import DvsDataset
-from models.model_utils import sparse_weight_gen, model_weight_gen, get_activation
+from models.model_utils import sparse_weight_gen, model_weight_gen, get_activation, fold_for_inference, set_fps_threads
+from models.noise_layers import GaussianReadNoise, start_calibration, freeze_calibration, set_block_sparse
+from models.crossbar import CrossbarEngine
+from models.procedural import ProceduralWeight
 from utility import utils
+from utility.neighbor_cache import IndexedDataset, NeighborhoodCache
+from utility.readout import RidgeReadout, RLSReadout, MultiHeadReadout, extract_features, accuracy, held_out_split
+from utility.feature_store import FeatureStore, fill, extractor_fingerprint
+from utility.noise_eval import MonteCarloEvaluator
+from utility.checkpoint import CheckpointWriter, load_checkpoint
 import matplotlib.pyplot as plt
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -38,6 +46,25 @@ def parse_args():
     parser.add_argument('--use_uniform_sample', action='store_true', default=False, help='use uniform sampiling')
     parser.add_argument('--distance', type=str, default='l2', choices=['l1', 'l2'], help='type of distance for grouping')
     parser.add_argument('--num_fc', type=int, default=1, help='number of FC layer')
+    parser.add_argument('--nbr_cache', action='store_true', default=False, help='cache FPS/ball query indices across epochs, training augmentation is reduced to shifts; turns itself off on datasets that resample points')
+    parser.add_argument('--grouping', type=str, default='dense', choices=['dense', 'grid', 'fused'], help='ball query backend; fused queries on the FPS distances inside FPS, without the [B, npoint, N] distance matrix, 1.2-1.3x on the CPU (bench_grouping --bench fused)')
+    parser.add_argument('--fps_threads', type=int, default=1, help='CPU threads of farthest point sampling, each takes part of the batch; 1 runs it in the main thread')
+    parser.add_argument('--precompute', action='store_true', default=False, help='run the SA conv per point before grouping')
+    parser.add_argument('--mem_budget', type=int, default=None, help='bytes for the grouping/interpolation distance matrices and the vmm weight reads, processed in chunks that fit')
+    parser.add_argument('--stream_block', type=int, default=None, help='pool the group_all SA layer over blocks of this many points when no gradient is needed')
+    parser.add_argument('--ensemble', type=int, default=1, help='independently drawn random extractors run together as grouped convs; on the CPU this only beats running them one after another from about 2048 points, see bench_grouping --bench ensemble')
+    parser.add_argument('--ensemble_reduce', type=str, default='concat', choices=['concat', 'mean'], help='concatenate or average the features of the ensemble members for the readout')
+    parser.add_argument('--solver', type=str, default='sgd', choices=['sgd', 'ridge', 'rls', 'heads'], help='sgd: train the readout with --optimizer, ridge: closed-form fit in one pass, rls: recursive least squares updated per batch, heads: one readout per --head_lr x --head_decay on the same features')
+    parser.add_argument('--ridge_lambda', type=str, default='1e-3,1e-2,1e-1,1,10,100', help='ridge regularisation strengths to compare')
+    parser.add_argument('--ridge_val', type=float, default=0.1, help='fraction of the training samples held out to pick --ridge_lambda, the readout is then refit on all of them')
+    parser.add_argument('--rls_lambda', type=float, default=1., help='rls regularisation of the weights, the bias is not regularised')
+    parser.add_argument('--rls_forget', type=float, default=1., help='rls forgetting factor per batch, 1 keeps all samples; a resumed rls state must have been saved with the same factor')
+    parser.add_argument('--head_lr', type=str, default='1e-3,3e-3,1e-2,3e-2', help='learning rates of the readout heads')
+    parser.add_argument('--head_decay', type=str, default='0,1e-4', help='weight decays of the readout heads')
+    parser.add_argument('--head_val', type=float, default=0.1, help='fraction of the training samples held out to pick the readout head, only that head is tested')
+    parser.add_argument('--feature_store', action='store_true', default=False, help='extract the SA features once and train only the fc readout from an on-disk store')
+    parser.add_argument('--store_views', type=int, default=1, help='augmented views per training sample in the feature store')
+    parser.add_argument('--store_dtype', type=str, default='float16', choices=['float16', 'float32'], help='feature store precision')
 
     # dataset
     parser.add_argument('--dataset', default='dvsgestures', choices=['dvsgestures'], help='dataset name')
@@ -60,6 +87,7 @@ def parse_args():
     parser.add_argument('--sa_iter', type=str, default='1,1,1', help='grouping model recurrent times')
     parser.add_argument('--num_feat', type=int, default=1024)
     parser.add_argument('--noise', type=float, default=0., help='noise level')
+    parser.add_argument('--noise_mode', type=str, default='weight', choices=['weight', 'reparam'], help='weight: a noisy weight per point, reparam: draw the equivalent output noise with two batched convs')
     parser.add_argument('--c_prune_rate', type=float, default=2, help='channel pruning ratio')
     parser.add_argument('--quantize', type=str, default='full', choices=['full', 'binary', 'ternary'], help='binary weight')
     parser.add_argument('--sparsity', type=float, default=0., help='sparsity of mixture normal')
@@ -74,7 +102,22 @@ def parse_args():
     parser.add_argument('--act', type=str, default='relu', choices=['relu', 'square', 'tanh', 'sigmoid', 'mish'], help='activation function')
     # hardware
     parser.add_argument('--tr_upd', type=str, default='True')
-    parser.add_argument('--hard_mode', type=str, default='batch', choices=[None, 'vmm', 'batch'])
+    parser.add_argument('--hard_mode', type=str, default='batch', choices=[None, 'vmm', 'batch'], help='integer hardware mode of the SA/FP convs under --hardware: batch with the ideal weights, vmm with the --read_noise/--crossbar_tile reads')
+    parser.add_argument('--hardware', action='store_true', default=False, help='run the SA/FP convs on the integer hardware path of --hard_mode instead of in software; --read_noise and --crossbar_tile imply it')
+    parser.add_argument('--read_noise', type=float, default=None, help='run the SA/FP convs on the simulated crossbar of --hard_mode, with this relative weight noise per vmm read')
+    parser.add_argument('--crossbar_tile', type=str, default=None, help='rows,cols of the simulated crossbar arrays, e.g. 64,64: run --hard_mode vmm on tiled differential conductance pairs with --read_noise')
+    parser.add_argument('--adc_bits', type=int, default=None, help='ADC resolution of the crossbar partial sums, ideal if not set')
+    parser.add_argument('--calib_batches', type=int, default=0, help='freeze static input ranges of the hardware convs on this many training batches instead of per-point ranges')
+    parser.add_argument('--calib_granularity', type=str, default='layer', choices=['layer', 'channel'], help='one input range per layer or per input channel')
+    parser.add_argument('--mc_noise', type=float, default=None, help='evaluate the trained model under this relative programming noise of the conductances and exit')
+    parser.add_argument('--mc_realisations', type=int, default=16, help='noise realisations of --mc_noise, evaluated together as grouped convs, 1.05-1.1x faster than one test pass per realisation on the CPU')
+    parser.add_argument('--procedural_seed', type=int, default=None, help='regenerate the SA/FP conv weights from this seed in every forward instead of storing them; only the biases are stored, but the forward is about 3x slower on the CPU')
+    parser.add_argument('--procedural_rows', type=int, default=64, help='output channels per regenerated weight tile')
+    parser.add_argument('--ckpt_format', type=str, default='torch', choices=['torch', 'fp16', 'int8'], help='fp16/int8: store the frozen conductances once, rounded to the format, and only the trainable state per save; 3-6x smaller files that load 1.1-2x faster than torch.load on the CPU')
+    parser.add_argument('--mask_block', type=str, default=None, help='rows,cols blocks of the --sparsity masks, e.g. 4,1 or 8,8: zero whole blocks, the same number in every row of blocks, instead of random cells')
+    parser.add_argument('--mask_pairs', type=str, default=None, choices=['shared', 'independent'], help='zero a pos/neg conductance pair together, so W has the zeros, or independently; default shared with --mask_block, else independent')
+    parser.add_argument('--block_sparse', action='store_true', default=False, help='run the noise free software 1x1 convs as block-sparse matmuls over the --mask_block blocks; only the convs whose blocks span all their output channels and more than one column block, e.g. 1024,8; at 50%% sparsity such a conv is about 1.2x faster than dense on the CPU and the cls feature extraction 1.05x, see bench_grouping --bench blocksparse')
+    parser.add_argument('--fold', action='store_true', default=False, help='test every epoch on a copy with the scaling, conv biases and BNs folded into the conv weights, 1.1-1.3x faster on the CPU')
     # trainable
     parser.add_argument('--trainable', action='store_true', default=False)
     return parser.parse_args()
@@ -86,18 +129,29 @@ def inplace_relu(m):
         m.inplace = True
 
 
-def test(model, loader, num_class=40):
+def test(model, loader, num_class=40, nbr_cache=None, store=None):
     mean_correct = []
     class_acc = np.zeros((num_class, 3))
     classifier = model.eval()
+    if nbr_cache is not None:
+        nbr_cache.attach(classifier)
+    if store is None:
+        batches = loader
+    else:
+        batches = ((feature, labels['target']) for feature, labels in store.batches(args.batch_size, shuffle=False))
 
-    for j, (points, target) in tqdm(enumerate(loader), total=len(loader)):
+    for j, (points, target, *index) in tqdm(enumerate(batches), total=len(loader)):
+        if nbr_cache is not None and store is None:
+            nbr_cache.set_batch(index[0])
 
         if not args.use_cpu:
             points, target = points.cuda(), target.cuda()
 
-        points = points.transpose(2, 1)
-        pred, _ = classifier(points)
+        if store is None:
+            points = points.transpose(2, 1)
+            pred, _ = classifier(points)
+        else:
+            pred = classifier.head(points)
         pred_choice = pred.data.max(1)[1]
 
         for cat in np.unique(target.cpu()):
@@ -115,6 +169,131 @@ def test(model, loader, num_class=40):
     return instance_acc, class_acc
 
 
+def store_features(classifier, batch, nbr_cache=None, augment=True):
+    '''flattened SA features of one loader batch for the feature store, with the training augmentation'''
+    points, target, *index = batch
+    points = points.data.numpy()
+    if nbr_cache is not None:
+        nbr_cache.set_batch(index[0])
+    if augment:
+        if nbr_cache is None or nbr_cache.resampling:
+            points = provider.random_point_dropout(points)
+            if args.dataset == 'ModelNet':
+                points[:, :, 0:3] = provider.random_scale_point_cloud(points[:, :, 0:3])
+        points[:, :, 0:3] = provider.shift_point_cloud(points[:, :, 0:3])
+    points = torch.Tensor(points).transpose(2, 1)
+    if not args.use_cpu:
+        points = points.cuda()
+    with torch.no_grad():
+        feature = classifier.sa_features(points)
+    return feature.view(feature.shape[0], -1), {'target': target}
+
+
+def readout_epoch(classifier, store, optimizer, criterion):
+    '''one training epoch of the fc readout on stored features, returns the batch accuracies'''
+    mean_correct = []
+    for feature, labels in tqdm(store.batches(args.batch_size, shuffle=True, drop_last=True),
+                                total=len(store) // args.batch_size, smoothing=0.9):
+        optimizer.zero_grad()
+        target = labels['target']
+        if not args.use_cpu:
+            feature, target = feature.cuda(), target.cuda()
+
+        pred = classifier.head(feature)
+        loss = criterion(pred, target.long(), None)
+        pred_choice = pred.data.max(1)[1]
+
+        correct = pred_choice.eq(target.long().data).cpu().sum()
+        mean_correct.append(correct.item() / float(feature.size()[0]))
+        loss.backward()
+        optimizer.step()
+    return mean_correct
+
+
+def head_batches(classifier, loader, store, nbr_cache, train, indices=None):
+    '''
+    (flattened SA feature, labels) batches from the feature store, or from the loader through the SA stack;
+    indices: the dataset indices of the loader samples, only read from the store
+    '''
+    if store is not None:
+        return store.batches(args.batch_size, shuffle=train, drop_last=train, indices=indices)
+    if nbr_cache is not None:
+        nbr_cache.attach(classifier)
+    return (store_features(classifier, batch, nbr_cache, augment=train) for batch in loader)
+
+
+def heads_epoch(classifier, heads, batches, optimizer, total):
+    '''one training epoch of every readout head on the same batches, returns the train accuracy per head'''
+    correct, count = torch.zeros(len(heads)), 0
+    for feature, labels in tqdm(batches, total=total, smoothing=0.9):
+        optimizer.zero_grad()
+        target = labels['target']
+        if not args.use_cpu:
+            feature, target = feature.cuda(), target.cuda()
+        with torch.no_grad():
+            feature = classifier.hidden(feature)
+
+        pred = heads(feature)
+        loss = heads.loss(pred, target)
+        correct += pred.data.max(2)[1].eq(target.long()).sum(1).cpu()
+        count += feature.shape[0]
+        loss.backward()
+        optimizer.step()
+    return (correct / count).numpy()
+
+
+def test_heads(classifier, heads, batches, total, num_class):
+    '''instance and class accuracy of every readout head, [K, 2]'''
+    pred_choice, targets = [], []
+    with torch.no_grad():
+        for feature, labels in tqdm(batches, total=total):
+            if not args.use_cpu:
+                feature = feature.cuda()
+            pred_choice.append(heads(classifier.hidden(feature)).max(2)[1].cpu())
+            targets.append(labels['target'].cpu())
+    pred_choice, target = torch.cat(pred_choice, 1), torch.cat(targets)
+    return np.array([accuracy(pred, target, num_class) for pred in pred_choice])
+
+def ridge_readout(classifier, train_loader, test_loader, num_class, log_string, train_cache=None, test_cache=None):
+    '''
+    fit the readout classifier.fc[-1] in closed form: pick the regularisation strength on a held out
+    --ridge_val fraction of the training features, refit on all of them and test once.
+    train_loader must not shuffle or drop samples, the held out ones are found by their dataset index.
+    '''
+    readout = classifier.fc[-1].linear
+    device = 'cpu' if args.use_cpu else 'cuda'
+    ridge = RidgeReadout(readout.in_features, num_class, device=device)
+    held_out = held_out_split(len(train_loader.dataset), args.ridge_val)
+    val_feature, val_target = [], []
+    start = 0
+    for feature, target in tqdm(extract_features(classifier, train_loader, not args.use_cpu, train_cache), total=len(train_loader)):
+        mask = held_out[start:start + feature.shape[0]].to(feature.device)
+        start += feature.shape[0]
+        ridge.update(feature[~mask], target[~mask])
+        val_feature.append(feature[mask])
+        val_target.append(target[mask])
+    val_feature, val_target = torch.cat(val_feature), torch.cat(val_target)
+    assert len(val_target) > 0, '--ridge_val holds out no training samples'
+
+    best = (None, -1)
+    for lam in map(float, args.ridge_lambda.split(',')):
+        ridge.load(readout, lam)
+        with torch.no_grad():
+            pred_choice = classifier.fc[-1](val_feature).max(1)[1]
+        instance_acc, class_acc = accuracy(pred_choice, val_target, num_class)
+        log_string('Ridge lambda %g: Validation Instance Accuracy: %f, Class Accuracy: %f' % (lam, instance_acc, class_acc))
+        if instance_acc > best[1]:
+            best = (lam, instance_acc)
+    ridge.update(val_feature, val_target)
+    ridge.load(readout, best[0])
+
+    test_feature, test_target = zip(*tqdm(extract_features(classifier, test_loader, not args.use_cpu, test_cache), total=len(test_loader)))
+    with torch.no_grad():
+        pred_choice = classifier.fc[-1](torch.cat(test_feature)).max(1)[1]
+    instance_acc, class_acc = accuracy(pred_choice, torch.cat(test_target), num_class)
+    return best[0], instance_acc, class_acc
+
+
 def main(args):
     def log_string(str):
         logger.info(str)
@@ -122,6 +301,7 @@ def main(args):
 
     '''HYPER PARAMETER'''
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    set_fps_threads(args.fps_threads)
     # os.environ["CUDA_VISIBLE_DEVICES"] = '0,1'
 
     '''CREATE DIR'''
@@ -165,6 +345,16 @@ def main(args):
         train_dataset = DvsDataset(DATADIR='data/raw_denoise', train=True, use_raw=True, sample=args.event_transform)
         test_dataset = DvsDataset(DATADIR='data/raw_denoise', train=False, use_raw=True, sample=args.event_transform)
 
+    if args.nbr_cache:
+        train_dataset, test_dataset = IndexedDataset(train_dataset), IndexedDataset(test_dataset)
+        train_cache = NeighborhoodCache(str(exp_dir.joinpath('nbr_cache/train')), len(train_dataset))
+        test_cache = NeighborhoodCache(str(exp_dir.joinpath('nbr_cache/test')), len(test_dataset))
+        if not train_cache.resampling:
+            # the cached neighbourhoods only hold for shifted copies of a sample
+            log_string('Warning: --nbr_cache trains without the point dropout and random scaling, only shifts, until the cache turns itself off')
+    else:
+        train_cache, test_cache = None, None
+
     trainDataLoader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=10, drop_last=True)
     testDataLoader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=10)
 
@@ -176,18 +366,50 @@ def main(args):
     shutil.copy('./train_classification_dvs.py', str(exp_dir))
 
 
+    if args.read_noise is not None or args.crossbar_tile is not None:
+        # both backends are read by the vmm simulation only, any other mode would report ideal weights
+        assert args.hard_mode == 'vmm', '--read_noise and --crossbar_tile need --hard_mode vmm'
+    assert args.adc_bits is None or args.crossbar_tile is not None, '--adc_bits needs --crossbar_tile'
+    if args.crossbar_tile is not None:
+        hardweight = CrossbarEngine(tuple(map(int, args.crossbar_tile.split(','))), read_noise=args.read_noise or 0.,
+                                    adc_bits=args.adc_bits)
+    else:
+        hardweight = None if args.read_noise is None else GaussianReadNoise(args.read_noise)
+    # a backend puts the convs on the hardware path as well, see NoiseConv
+    hardware = args.hardware or hardweight is not None
+    assert not hardware or args.hard_mode is not None, '--hardware needs --hard_mode batch or vmm'
+    assert not hardware or args.hard_mode != 'vmm' or hardweight is not None, '--hardware with --hard_mode vmm needs --read_noise or --crossbar_tile'
+    assert args.calib_batches == 0 or hardware, '--calib_batches needs --hardware'
+    # the integer path has no software weight noise, vmm draws its noise from the backend
+    assert not args.noise or not hardware, '--noise is software weight noise, use --read_noise with --hard_mode vmm'
+    procedural = None if args.procedural_seed is None else \
+        ProceduralWeight(args.procedural_seed, args.sparsity, args.procedural_rows)
+
     if args.model == 'model_cls_rand':
         sa_iter = list(map(int, args.sa_iter.split(',')))
         act = get_activation(args.act)
         classifier = model.get_model(num_class, normal_channel=args.use_normals, c_prune_rate=args.c_prune_rate,
                                      iter=sa_iter, noise=args.noise, quantize=args.quantize,
                                      num_feat=args.num_feat, distancing=args.distance, act=act,
-                                     radius=args.radius, radius_multiple=args.radius_mul, hard_mode=args.hard_mode)
+                                     radius=args.radius, radius_multiple=args.radius_mul, hard_mode=args.hard_mode,
+                                     hardweight=hardweight, hardware=args.hardware,
+                                     grouping=args.grouping, precompute=args.precompute, mem_budget=args.mem_budget,
+                                     stream_block=args.stream_block, ensemble=args.ensemble,
+                                     ensemble_reduce=args.ensemble_reduce, noise_mode=args.noise_mode,
+                                     procedural=procedural)
     else:
         classifier = model.get_model(num_class, normal_channel=args.use_normals, c_prune_rate=args.c_prune_rate)
 
     # weight sparsity
-    classifier, cond_dict = utils.replace_model_weight(classifier, args.sparsity)
+    mask_block = None if args.mask_block is None else tuple(map(int, args.mask_block.split(',')))
+    classifier, cond_dict = utils.replace_model_weight(classifier, args.sparsity, mask_block,
+                                                       None if args.mask_pairs is None else args.mask_pairs == 'shared')
+    if procedural is not None:
+        log_string(procedural.summary())
+    if args.block_sparse:
+        assert mask_block is not None, '--block_sparse needs --mask_block'
+        layers = set_block_sparse(classifier, mask_block)
+        log_string('Block-sparse execution of %d convs in %s blocks' % (len(layers), args.mask_block))
 
     if not args.trainable:
         # freeze the conv layers
@@ -213,14 +435,168 @@ def main(args):
         criterion = criterion.cuda()
 
     try:
-        checkpoint = torch.load(str(exp_dir) + '/checkpoints/best_model.pth')
+        checkpoint = load_checkpoint(str(exp_dir) + '/checkpoints/best_model.pth')
         # checkpoint = torch.load('log/classification/2022-07-23_19-32/checkpoints/best_model.pth')
         start_epoch = checkpoint['epoch']
         classifier.load_state_dict(checkpoint['model_state_dict'])
+        cond_dict = checkpoint.get('cond_dict', cond_dict)
         log_string('Use pretrain model')
     except:
         log_string('No existing model, starting training from scratch...')
         start_epoch = 0
+        checkpoint = {}
+
+    writer = CheckpointWriter(args.ckpt_format)
+
+    if isinstance(hardweight, CrossbarEngine):
+        hardweight.load(classifier, cond_dict)
+        log_string(hardweight.summary())
+
+    if args.calib_batches > 0 and not any(name.endswith('quant_step') for name in classifier.state_dict()):
+        # static DAC ranges, a resumed checkpoint already holds them
+        layers = start_calibration(classifier, args.calib_granularity)
+        assert layers, 'no hardware convs to calibrate'
+        for _ in zip(range(args.calib_batches), extract_features(classifier, trainDataLoader, not args.use_cpu, train_cache)):
+            pass
+        freeze_calibration(classifier)
+        log_string('Calibrated the input ranges of %d hardware convs per %s' % (len(layers), args.calib_granularity))
+
+    if args.mc_noise is not None:
+        # accuracy distribution under programming noise, all realisations in one test pass
+        mc = MonteCarloEvaluator(classifier, cond_dict, args.mc_noise, args.mc_realisations, test_cache)
+        instance_acc, class_acc = mc.classification(testDataLoader, num_class)
+        log_string('Programming noise %g, %d realisations: Test Instance Accuracy: %f +- %f (min %f), Class Accuracy: %f +- %f'
+                   % (args.mc_noise, args.mc_realisations, instance_acc.mean(), instance_acc.std(), instance_acc.min(),
+                      class_acc.mean(), class_acc.std()))
+        np.savez(str(exp_dir.joinpath('mc_noise_%g.npz' % args.mc_noise)), instance_acc=instance_acc, class_acc=class_acc)
+        writer.close()
+        return
+
+    if args.solver == 'ridge':
+        # every sample once, in dataset order
+        ridgeDataLoader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, num_workers=10)
+        lam, instance_acc, class_acc = ridge_readout(classifier, ridgeDataLoader, testDataLoader, num_class, log_string,
+                                                     train_cache, test_cache)
+        log_string('Ridge lambda %g: Test Instance Accuracy: %f, Class Accuracy: %f' % (lam, instance_acc, class_acc))
+        savepath = str(checkpoints_dir) + '/best_model.pth'
+        log_string('Saving at %s' % savepath)
+        state = {
+            'epoch': 0,
+            'instance_acc': instance_acc,
+            'class_acc': class_acc,
+            'ridge_lambda': lam,
+            'model_state_dict': classifier.state_dict(),
+            'cond_dict': cond_dict,
+        }
+        writer.save(state, savepath, classifier)
+        writer.close()
+        return
+
+    if args.solver == 'rls':
+        # one streaming pass per run, a saved rls state keeps learning from where it stopped
+        readout = classifier.fc[-1].linear
+        rls = RLSReadout(readout.in_features, num_class, lam=args.rls_lambda, forget=args.rls_forget,
+                         device='cpu' if args.use_cpu else 'cuda')
+        if 'rls_state_dict' in checkpoint:
+            rls.load_state_dict(checkpoint['rls_state_dict'])
+            log_string('Resume rls readout after %d samples' % rls.count)
+        for feature, target in tqdm(extract_features(classifier, trainDataLoader, not args.use_cpu, train_cache), total=len(trainDataLoader)):
+            rls.update(feature, target)
+        rls.load(readout)
+        with torch.no_grad():
+            instance_acc, class_acc = test(classifier.eval(), testDataLoader, num_class=num_class, nbr_cache=test_cache)
+        log_string('RLS readout after %d samples: Test Instance Accuracy: %f, Class Accuracy: %f' % (rls.count, instance_acc, class_acc))
+        savepath = str(checkpoints_dir) + '/best_model.pth'
+        log_string('Saving at %s' % savepath)
+        state = {
+            'epoch': start_epoch + 1,
+            'instance_acc': instance_acc,
+            'class_acc': class_acc,
+            'model_state_dict': classifier.state_dict(),
+            'rls_state_dict': rls.state_dict(),
+            'cond_dict': cond_dict,
+        }
+        writer.save(state, savepath, classifier)
+        writer.close()
+        return
+
+    if args.feature_store:
+        # the SA stack runs once per sample and view, later epochs only train the fc readout
+        classifier = classifier.eval()
+        feature_shape = (classifier.fc[0].linear.in_features,)
+        extractor = extractor_fingerprint(classifier, dataset=args.dataset, num_point=args.num_point, use_normals=args.use_normals,
+                                          event_transform=args.event_transform)
+        train_store = FeatureStore(str(exp_dir.joinpath('feature_store/train')), len(train_dataset), feature_shape,
+                                   views=args.store_views, dtype=args.store_dtype, extractor=extractor, labels={'target': ((), 'int64')})
+        test_store = FeatureStore(str(exp_dir.joinpath('feature_store/test')), len(test_dataset), feature_shape,
+                                  dtype=args.store_dtype, extractor=extractor, labels={'target': ((), 'int64')})
+        for cache in [train_cache, test_cache]:
+            if cache is not None:
+                cache.attach(classifier)
+        storeDataLoader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, num_workers=10)
+        fill(train_store, storeDataLoader, lambda batch: store_features(classifier, batch, train_cache))
+        fill(test_store, testDataLoader, lambda batch: store_features(classifier, batch, test_cache, augment=False))
+        log_string('Feature store: %d x %d training views, %d test samples' % (len(train_store), args.store_views, len(test_store)))
+    else:
+        train_store, test_store = None, None
+
+    if args.solver == 'heads':
+        # one extractor pass per batch trains the whole --head_lr x --head_decay sweep
+        classifier = classifier.eval()
+        # the head is picked on held out training samples, the test set only scores the picked one
+        held_out = held_out_split(len(train_dataset), args.head_val)
+        fit_idx, val_idx = torch.nonzero(~held_out)[:, 0], torch.nonzero(held_out)[:, 0]
+        assert len(val_idx) > 0, '--head_val holds out no training samples'
+        fitDataLoader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_dataset, fit_idx), batch_size=args.batch_size,
+                                                    shuffle=True, num_workers=10, drop_last=True)
+        valDataLoader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_dataset, val_idx), batch_size=args.batch_size,
+                                                    shuffle=False, num_workers=10)
+        heads = MultiHeadReadout(classifier.fc[-1], args.head_lr.split(','), args.head_decay.split(','))
+        if not args.use_cpu:
+            heads = heads.cuda()
+        if checkpoint.get('head_config') == heads.config:
+            heads.load_state_dict(checkpoint['heads_state_dict'])
+            log_string('Resume %d readout heads' % len(heads))
+        optimizer = heads.optimizer(args.optimizer)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=20, gamma=0.7)
+        best_val_acc = -1
+
+        for epoch in range(start_epoch, args.epoch):
+            log_string('Epoch %d (%d/%s):' % (epoch - start_epoch + 1, epoch + 1, args.epoch))
+            heads = heads.train()
+            scheduler.step()
+            train_acc = heads_epoch(classifier, heads, head_batches(classifier, fitDataLoader, train_store, train_cache, True, fit_idx),
+                                    optimizer, len(fitDataLoader))
+            val_acc = test_heads(classifier, heads.eval(), head_batches(classifier, valDataLoader, train_store, train_cache, False, val_idx),
+                                 len(valDataLoader), num_class)
+            for k, (lr, decay) in enumerate(heads.config):
+                log_string('Head %d (lr %g, decay %g): Train Instance Accuracy: %f, Val Instance Accuracy: %f, Class Accuracy: %f'
+                           % (k, lr, decay, train_acc[k], val_acc[k, 0], val_acc[k, 1]))
+
+            k = int(np.argmax(val_acc[:, 0]))
+            log_string('Best head %d (lr %g, decay %g): Val Instance Accuracy: %f' % (k, *heads.config[k], val_acc[k, 0]))
+            if val_acc[k, 0] >= best_val_acc:
+                best_val_acc = val_acc[k, 0]
+                heads.load(classifier.fc[-1], k)
+                instance_acc, class_acc = test(classifier, testDataLoader, num_class=num_class, nbr_cache=test_cache, store=test_store)
+                log_string('Test Instance Accuracy: %f, Class Accuracy: %f' % (instance_acc, class_acc))
+                savepath = str(checkpoints_dir) + '/best_model.pth'
+                log_string('Saving at %s' % savepath)
+                state = {
+                    'epoch': epoch + 1,
+                    'val_acc': best_val_acc,
+                    'instance_acc': instance_acc,
+                    'class_acc': class_acc,
+                    'head_lr': heads.config[k][0],
+                    'head_decay': heads.config[k][1],
+                    'model_state_dict': classifier.state_dict(),
+                    'heads_state_dict': heads.state_dict(),
+                    'head_config': heads.config,
+                    'cond_dict': cond_dict,
+                }
+                writer.save(state, savepath, classifier)
+        writer.close()
+        return
 
     if args.optimizer == 'Adam':
         optimizer = torch.optim.Adam(
@@ -247,36 +623,53 @@ def main(args):
         classifier = classifier.train()
 
         scheduler.step()
-        for batch_id, (points, target) in tqdm(enumerate(trainDataLoader, 0), total=len(trainDataLoader), smoothing=0.9):
-            optimizer.zero_grad()
-
-            points = points.data.numpy()
-            points = provider.random_point_dropout(points)
-            if args.dataset == 'ModelNet':
-                points[:, :, 0:3] = provider.random_scale_point_cloud(points[:, :, 0:3])
-            points[:, :, 0:3] = provider.shift_point_cloud(points[:, :, 0:3])
-            points = torch.Tensor(points)
-            points = points.transpose(2, 1)
-
-            if not args.use_cpu:
-                points, target = points.cuda(), target.cuda()
-
-            pred, trans_feat = classifier(points)
-            loss = criterion(pred, target.long(), trans_feat)
-            pred_choice = pred.data.max(1)[1]
-
-            correct = pred_choice.eq(target.long().data).cpu().sum()
-            mean_correct.append(correct.item() / float(points.size()[0]))
-            loss.backward()
-            optimizer.step()
-            global_step += 1
+        if train_store is not None:
+            mean_correct = readout_epoch(classifier, train_store, optimizer, criterion)
+        else:
+            if train_cache is not None:
+                train_cache.attach(classifier)
+            for batch_id, (points, target, *index) in tqdm(enumerate(trainDataLoader, 0), total=len(trainDataLoader), smoothing=0.9):
+                optimizer.zero_grad()
+
+                points = points.data.numpy()
+                if train_cache is not None and not train_cache.resampling:
+                    # shifting keeps the cached neighbourhoods valid, dropout and scaling do not
+                    train_cache.set_batch(index[0])
+                else:
+                    points = provider.random_point_dropout(points)
+                    if args.dataset == 'ModelNet':
+                        points[:, :, 0:3] = provider.random_scale_point_cloud(points[:, :, 0:3])
+                points[:, :, 0:3] = provider.shift_point_cloud(points[:, :, 0:3])
+                points = torch.Tensor(points)
+                points = points.transpose(2, 1)
+
+                if not args.use_cpu:
+                    points, target = points.cuda(), target.cuda()
+
+                pred, trans_feat = classifier(points)
+                loss = criterion(pred, target.long(), trans_feat)
+                pred_choice = pred.data.max(1)[1]
+
+                correct = pred_choice.eq(target.long().data).cpu().sum()
+                mean_correct.append(correct.item() / float(points.size()[0]))
+                loss.backward()
+                optimizer.step()
+                global_step += 1
 
         train_instance_acc = np.mean(mean_correct)
         log_string('Train Instance Accuracy: %f' % train_instance_acc)
+        if train_cache is not None:
+            log_string(train_cache.summary())
+            train_cache.reset_stats()
 
         with torch.no_grad():
             # _, _ = test(classifier.train(), testDataLoader, num_class)
-            instance_acc, class_acc = test(classifier.eval(), testDataLoader, num_class=num_class)
+            test_model = fold_for_inference(classifier, inplace=False) if args.fold else classifier.eval()
+            instance_acc, class_acc = test(test_model, testDataLoader, num_class=num_class, nbr_cache=test_cache,
+                                             store=test_store)
+            if test_cache is not None:
+                log_string(test_cache.summary())
+                test_cache.reset_stats()
 
             if (instance_acc >= best_instance_acc):
                 best_instance_acc = instance_acc
@@ -299,9 +692,10 @@ def main(args):
                     'optimizer_state_dict': optimizer.state_dict(),
                     'cond_dict': cond_dict,
                 }
-                torch.save(state, savepath)
+                writer.save(state, savepath, classifier)
             global_epoch += 1
 
+    writer.close()
     logger.info('End of training...')
 
 
@@ -10,7 +10,15 @@ import provider
 import numpy as np
 import matplotlib.pyplot as plt
 
+from models.noise_layers import GaussianReadNoise, start_calibration, freeze_calibration, set_block_sparse
+from models.crossbar import CrossbarEngine
+from models.model_utils import fold_for_inference, set_fps_threads
+from models.procedural import ProceduralWeight
 from utility import utils
+from utility.neighbor_cache import IndexedDataset, NeighborhoodCache
+from utility.feature_store import FeatureStore, fill, extractor_fingerprint
+from utility.noise_eval import MonteCarloEvaluator
+from utility.checkpoint import CheckpointWriter, load_checkpoint
 from pathlib import Path
 from tqdm import tqdm
 from data_utils.ShapeNetDataLoader import PartNormalDataset
@@ -43,6 +51,43 @@ def to_categorical(y, num_classes):
     return new_y
 
 
+def store_features(classifier, batch, num_classes, nbr_cache=None, augment=True):
+    '''per-point SA/FP features of one loader batch for the feature store, with the training augmentation'''
+    points, label, target, *index = batch
+    points = points.data.numpy()
+    if nbr_cache is not None:
+        nbr_cache.set_batch(index[0])
+    if augment:
+        if nbr_cache is None or nbr_cache.resampling:
+            points[:, :, 0:3] = provider.random_scale_point_cloud(points[:, :, 0:3])
+        points[:, :, 0:3] = provider.shift_point_cloud(points[:, :, 0:3])
+    points = torch.Tensor(points).float().cuda().transpose(2, 1)
+    with torch.no_grad():
+        l0_points, _ = classifier.extract_features(points, to_categorical(label.long(), num_classes).cuda())
+    return l0_points, {'label': label, 'target': target}
+
+
+def readout_epoch(classifier, store, optimizer, criterion, batch_size, num_part):
+    '''one training epoch of the conv2 readout on stored features, returns the batch accuracies and the summed loss'''
+    mean_correct, epoch_loss = [], 0
+    for feature, labels in tqdm(store.batches(batch_size, shuffle=True, drop_last=True),
+                                total=len(store) // batch_size, smoothing=0.9):
+        optimizer.zero_grad()
+        feature, target = feature.cuda(), labels['target'].cuda()
+        seg_pred = classifier.head(feature)
+        seg_pred = seg_pred.contiguous().view(-1, num_part)
+        target = target.view(-1, 1)[:, 0]
+        pred_choice = seg_pred.data.max(1)[1]
+
+        correct = pred_choice.eq(target.data).cpu().sum()
+        mean_correct.append(correct.item() / float(target.shape[0]))
+        loss = criterion(seg_pred, target, None)
+        loss.backward()
+        optimizer.step()
+        epoch_loss += loss.item()
+    return mean_correct, epoch_loss
+
+
 def parse_args():
     parser = argparse.ArgumentParser('Model')
     parser.add_argument('--model', type=str, default='model_part_seg', help='model name')
@@ -61,13 +106,41 @@ def parse_args():
 
     parser.add_argument('--r0', type=float, default=0.1, help='first grouping layer radius')
     parser.add_argument('--r1', type=float, default=0.3, help='second grouping layer radius')
+    parser.add_argument('--nbr_cache', action='store_true', default=False, help='cache FPS/ball query indices across epochs, training augmentation is reduced to shifts; turns itself off on datasets that resample points')
+    parser.add_argument('--grouping', type=str, default='dense', choices=['dense', 'grid', 'fused'], help='ball query backend; fused queries on the FPS distances inside FPS, without the [B, npoint, N] distance matrix, 1.2-1.3x on the CPU (bench_grouping --bench fused)')
+    parser.add_argument('--fps_threads', type=int, default=1, help='CPU threads of farthest point sampling, each takes part of the batch; 1 runs it in the main thread')
+    parser.add_argument('--precompute', action='store_true', default=False, help='run the SA conv per point before grouping; 1.14x for the segmentation model at 2048 points on the CPU, see bench_grouping --bench share')
+    parser.add_argument('--mem_budget', type=int, default=None, help='bytes for the grouping/interpolation distance matrices and the vmm weight reads, processed in chunks that fit')
+    parser.add_argument('--stream_block', type=int, default=None, help='pool the group_all SA layer over blocks of this many points when no gradient is needed')
+    parser.add_argument('--ensemble', type=int, default=1, help='independently drawn random extractors run together as grouped convs; on the CPU this only beats running them one after another from about 2048 points, see bench_grouping --bench ensemble')
+    parser.add_argument('--ensemble_reduce', type=str, default='concat', choices=['concat', 'mean'], help='concatenate or average the features of the ensemble members for the readout')
+    parser.add_argument('--share_dist', action='store_true', default=False, help='reuse the SA distance matrices for the FP 3-NN, chunked over the batch within --mem_budget; 1.16x at 8 x 2048 points on the CPU, none at 256, outputs within 5e-7, see bench_grouping --bench share')
+    parser.add_argument('--feature_store', action='store_true', default=False, help='extract the SA/FP features once and train only the conv2 readout from an on-disk store')
+    parser.add_argument('--store_views', type=int, default=1, help='augmented views per training sample in the feature store')
+    parser.add_argument('--store_dtype', type=str, default='float16', choices=['float16', 'float32'], help='feature store precision')
     parser.add_argument('--c_prune_rate', type=float, default=1)    # 3.1   # 3.8 for pn2, 9.5 for pn1
     parser.add_argument('--num_feat', type=int, default=750) 
     parser.add_argument('--feat1', type=int, default=375) # 256
 
     # noise sim
     parser.add_argument('--noise', type=float, default=0., help='weight noise')
-    parser.add_argument('--hard_mode', type=str, default=None, choices=['vmm', 'batch', None])
+    parser.add_argument('--noise_mode', type=str, default='weight', choices=['weight', 'reparam'], help='weight: a noisy weight per point, reparam: draw the equivalent output noise with two batched convs')
+    parser.add_argument('--hard_mode', type=str, default=None, choices=['vmm', 'batch', None], help='integer hardware mode of the SA/FP convs under --hardware: batch with the ideal weights, vmm with the --read_noise/--crossbar_tile reads')
+    parser.add_argument('--hardware', action='store_true', default=False, help='run the SA/FP convs on the integer hardware path of --hard_mode instead of in software; --read_noise and --crossbar_tile imply it')
+    parser.add_argument('--read_noise', type=float, default=None, help='run the SA/FP convs on the simulated crossbar of --hard_mode, with this relative weight noise per vmm read')
+    parser.add_argument('--crossbar_tile', type=str, default=None, help='rows,cols of the simulated crossbar arrays, e.g. 64,64: run --hard_mode vmm on tiled differential conductance pairs with --read_noise')
+    parser.add_argument('--adc_bits', type=int, default=None, help='ADC resolution of the crossbar partial sums, ideal if not set')
+    parser.add_argument('--calib_batches', type=int, default=0, help='freeze static input ranges of the hardware convs on this many training batches instead of per-point ranges')
+    parser.add_argument('--calib_granularity', type=str, default='layer', choices=['layer', 'channel'], help='one input range per layer or per input channel')
+    parser.add_argument('--mc_noise', type=float, default=None, help='evaluate the trained model under this relative programming noise of the conductances and exit')
+    parser.add_argument('--mc_realisations', type=int, default=16, help='noise realisations of --mc_noise, evaluated together as grouped convs, 1.05-1.1x faster than one test pass per realisation on the CPU')
+    parser.add_argument('--procedural_seed', type=int, default=None, help='regenerate the SA/FP conv weights from this seed in every forward instead of storing them; only the biases are stored, but the forward is about 3x slower on the CPU')
+    parser.add_argument('--procedural_rows', type=int, default=64, help='output channels per regenerated weight tile')
+    parser.add_argument('--ckpt_format', type=str, default='torch', choices=['torch', 'fp16', 'int8'], help='fp16/int8: store the frozen conductances once, rounded to the format, and only the trainable state per save; 3-6x smaller files that load 1.1-2x faster than torch.load on the CPU')
+    parser.add_argument('--mask_block', type=str, default=None, help='rows,cols blocks of the --sparsity masks, e.g. 4,1 or 8,8: zero whole blocks, the same number in every row of blocks, instead of random cells')
+    parser.add_argument('--mask_pairs', type=str, default=None, choices=['shared', 'independent'], help='zero a pos/neg conductance pair together, so W has the zeros, or independently; default shared with --mask_block, else independent')
+    parser.add_argument('--block_sparse', action='store_true', default=False, help='run the noise free software 1x1 convs as block-sparse matmuls over the --mask_block blocks; only the convs whose blocks span all their output channels and more than one column block, e.g. 1024,8; at 50%% sparsity such a conv is about 1.2x faster than dense on the CPU and the cls feature extraction 1.05x, see bench_grouping --bench blocksparse')
+    parser.add_argument('--fold', action='store_true', default=False, help='test every epoch on a copy with the scaling, conv biases and BNs folded into the conv weights, 1.1-1.3x faster on the CPU')
     parser.add_argument('--sparsity', type=float, default=0.5, help='sparsity of mixture normal')
     # hardware
     parser.add_argument('--quant_bit', type=int, default=6, help='quantization bit')
@@ -82,6 +155,7 @@ def main(args):
 
     '''HYPER PARAMETER'''
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    set_fps_threads(args.fps_threads)
 
     '''CREATE DIR'''
     timestr = str(datetime.datetime.now().strftime('%Y-%m-%d_%H-%M'))
@@ -114,8 +188,17 @@ def main(args):
     root = 'data/shapenetcore_partanno_segmentation_benchmark_v0_normal/'
 
     TRAIN_DATASET = PartNormalDataset(root=root, npoints=args.npoint, split='trainval', normal_channel=args.normal)
-    trainDataLoader = torch.utils.data.DataLoader(TRAIN_DATASET, batch_size=args.batch_size, shuffle=True, num_workers=10, drop_last=True)
     TEST_DATASET = PartNormalDataset(root=root, npoints=args.npoint, split='test', normal_channel=args.normal)
+    if args.nbr_cache:
+        TRAIN_DATASET, TEST_DATASET = IndexedDataset(TRAIN_DATASET), IndexedDataset(TEST_DATASET)
+        train_cache = NeighborhoodCache(str(exp_dir.joinpath('nbr_cache/train')), len(TRAIN_DATASET))
+        test_cache = NeighborhoodCache(str(exp_dir.joinpath('nbr_cache/test')), len(TEST_DATASET))
+        if not train_cache.resampling:
+            # the cached neighbourhoods only hold for shifted copies of a sample
+            log_string('Warning: --nbr_cache trains without the random scaling, only shifts, until the cache turns itself off')
+    else:
+        train_cache, test_cache = None, None
+    trainDataLoader = torch.utils.data.DataLoader(TRAIN_DATASET, batch_size=args.batch_size, shuffle=True, num_workers=10, drop_last=True)
     testDataLoader = torch.utils.data.DataLoader(TEST_DATASET, batch_size=args.batch_size, shuffle=False, num_workers=10)
     log_string("The number of training data is: %d" % len(TRAIN_DATASET))
     log_string("The number of test data is: %d" % len(TEST_DATASET))
@@ -128,16 +211,47 @@ def main(args):
     shutil.copy('models/%s.py' % args.model, str(exp_dir))
     shutil.copy('models/model_utils.py', str(exp_dir))
 
+    if args.read_noise is not None or args.crossbar_tile is not None:
+        # both backends are read by the vmm simulation only, any other mode would report ideal weights
+        assert args.hard_mode == 'vmm', '--read_noise and --crossbar_tile need --hard_mode vmm'
+    assert args.adc_bits is None or args.crossbar_tile is not None, '--adc_bits needs --crossbar_tile'
+    if args.crossbar_tile is not None:
+        hardweight = CrossbarEngine(tuple(map(int, args.crossbar_tile.split(','))), read_noise=args.read_noise or 0.,
+                                    adc_bits=args.adc_bits)
+    else:
+        hardweight = None if args.read_noise is None else GaussianReadNoise(args.read_noise)
+    # a backend puts the convs on the hardware path as well, see NoiseConv
+    hardware = args.hardware or hardweight is not None
+    assert not hardware or args.hard_mode is not None, '--hardware needs --hard_mode batch or vmm'
+    assert not hardware or args.hard_mode != 'vmm' or hardweight is not None, '--hardware with --hard_mode vmm needs --read_noise or --crossbar_tile'
+    assert args.calib_batches == 0 or hardware, '--calib_batches needs --hardware'
+    # the integer path has no software weight noise, vmm draws its noise from the backend
+    assert not args.noise or not hardware, '--noise is software weight noise, use --read_noise with --hard_mode vmm'
+    procedural = None if args.procedural_seed is None else \
+        ProceduralWeight(args.procedural_seed, args.sparsity, args.procedural_rows)
     classifier = MODEL.get_model(num_part, normal_channel=args.normal,
                                  c_prune_rate=args.c_prune_rate,
                                  noise=args.noise, quant_bit=args.quant_bit,
                                  feat1=args.feat1, num_feat=args.num_feat,
-                                 r0=args.r0, r1=args.r1, hard_mode=args.hard_mode).cuda()
+                                 r0=args.r0, r1=args.r1, hard_mode=args.hard_mode,
+                                 hardweight=hardweight, hardware=args.hardware,
+                                 grouping=args.grouping, precompute=args.precompute, mem_budget=args.mem_budget,
+                                 stream_block=args.stream_block, ensemble=args.ensemble,
+                                 ensemble_reduce=args.ensemble_reduce, noise_mode=args.noise_mode,
+                                 share_dist=args.share_dist, procedural=procedural).cuda()
     criterion = MODEL.get_loss().cuda()
     classifier.apply(inplace_relu)
 
     # weight sparsity
-    classifier, cond_dict = utils.replace_model_weight(classifier, args.sparsity)
+    mask_block = None if args.mask_block is None else tuple(map(int, args.mask_block.split(',')))
+    classifier, cond_dict = utils.replace_model_weight(classifier, args.sparsity, mask_block,
+                                                       None if args.mask_pairs is None else args.mask_pairs == 'shared')
+    if procedural is not None:
+        log_string(procedural.summary())
+    if args.block_sparse:
+        assert mask_block is not None, '--block_sparse needs --mask_block'
+        layers = set_block_sparse(classifier, mask_block)
+        log_string('Block-sparse execution of %d convs in %s blocks' % (len(layers), args.mask_block))
 
     # classifier = torch.compile(classifier)
 
@@ -162,15 +276,43 @@ def main(args):
 
 
     try:
-        checkpoint = torch.load(str(exp_dir) + '/checkpoints/best_model.pth')
+        checkpoint = load_checkpoint(str(exp_dir) + '/checkpoints/best_model.pth')
         start_epoch = checkpoint['epoch']
         classifier.load_state_dict(checkpoint['model_state_dict'])
+        cond_dict = checkpoint.get('cond_dict', cond_dict)
         log_string('Use pretrain model')
     except:
         log_string('No existing model, starting training from scratch...')
         start_epoch = 0
+        checkpoint = {}
         # classifier = classifier.apply(weights_init)
 
+    writer = CheckpointWriter(args.ckpt_format)
+
+    if isinstance(hardweight, CrossbarEngine):
+        hardweight.load(classifier, cond_dict)
+        log_string(hardweight.summary())
+
+    if args.calib_batches > 0 and not any(name.endswith('quant_step') for name in classifier.state_dict()):
+        # static DAC ranges, a resumed checkpoint already holds them
+        layers = start_calibration(classifier, args.calib_granularity)
+        assert layers, 'no hardware convs to calibrate'
+        for _, batch in zip(range(args.calib_batches), trainDataLoader):
+            store_features(classifier.eval(), batch, num_classes, train_cache, augment=False)
+        freeze_calibration(classifier)
+        log_string('Calibrated the input ranges of %d hardware convs per %s' % (len(layers), args.calib_granularity))
+
+    if args.mc_noise is not None:
+        # metric distributions under programming noise, all realisations in one test pass
+        mc = MonteCarloEvaluator(classifier, cond_dict, args.mc_noise, args.mc_realisations, test_cache)
+        mc_metrics = mc.segmentation(testDataLoader, seg_classes, num_classes, num_part)
+        for name, values in mc_metrics.items():
+            log_string('Programming noise %g, %d realisations: %s %f +- %f (min %f)'
+                       % (args.mc_noise, args.mc_realisations, name, values.mean(), values.std(), values.min()))
+        np.savez(str(exp_dir.joinpath('mc_noise_%g.npz' % args.mc_noise)), **mc_metrics)
+        writer.close()
+        return
+
     if not args.trainable:
         # freeze the conv weight in sa and fp layers
         for name, params in classifier.named_parameters():
@@ -178,6 +320,26 @@ def main(args):
                 if ('conv' in name) and ('weight' in name):
                     params.requires_grad = False
 
+    if args.feature_store:
+        # the SA/FP stack runs once per sample and view, later epochs only train conv2
+        classifier = classifier.eval()
+        feature_shape = (classifier.conv2.in_channels, args.npoint)
+        labels = {'label': ((1,), 'int16'), 'target': ((args.npoint,), 'int16')}
+        extractor = extractor_fingerprint(classifier, npoint=args.npoint, normal=args.normal)
+        train_store = FeatureStore(str(exp_dir.joinpath('feature_store/train')), len(TRAIN_DATASET), feature_shape,
+                                   views=args.store_views, dtype=args.store_dtype, extractor=extractor, labels=labels)
+        test_store = FeatureStore(str(exp_dir.joinpath('feature_store/test')), len(TEST_DATASET), feature_shape,
+                                  dtype=args.store_dtype, extractor=extractor, labels=labels)
+        for cache in [train_cache, test_cache]:
+            if cache is not None:
+                cache.attach(classifier)
+        storeDataLoader = torch.utils.data.DataLoader(TRAIN_DATASET, batch_size=args.batch_size, shuffle=False, num_workers=10)
+        fill(train_store, storeDataLoader, lambda batch: store_features(classifier, batch, num_classes, train_cache))
+        fill(test_store, testDataLoader, lambda batch: store_features(classifier, batch, num_classes, test_cache, augment=False))
+        log_string('Feature store: %d x %d training views, %d test samples' % (len(train_store), args.store_views, len(test_store)))
+    else:
+        train_store, test_store = None, None
+
     if args.optimizer == 'Adam':
         optimizer = torch.optim.Adam(
             classifier.parameters(),
@@ -222,31 +384,43 @@ def main(args):
 
         epoch_loss = 0
         '''learning one epoch'''
-        for i, (points, label, target) in tqdm(enumerate(trainDataLoader), total=len(trainDataLoader), smoothing=0.9):
-            optimizer.zero_grad()
+        if train_store is not None:
+            mean_correct, epoch_loss = readout_epoch(classifier, train_store, optimizer, criterion, args.batch_size, num_part)
+        else:
+            if train_cache is not None:
+                train_cache.attach(classifier)
+            for i, (points, label, target, *index) in tqdm(enumerate(trainDataLoader), total=len(trainDataLoader), smoothing=0.9):
+                optimizer.zero_grad()
+
+                points = points.data.numpy()
+                if train_cache is not None and not train_cache.resampling:
+                    # shifting keeps the cached neighbourhoods valid, scaling does not
+                    train_cache.set_batch(index[0])
+                else:
+                    points[:, :, 0:3] = provider.random_scale_point_cloud(points[:, :, 0:3])
+                points[:, :, 0:3] = provider.shift_point_cloud(points[:, :, 0:3])
+                points = torch.Tensor(points)
+                points, label, target = points.float().cuda(), label.long().cuda(), target.long().cuda()
+                points = points.transpose(2, 1)
 
-            points = points.data.numpy()
-            points[:, :, 0:3] = provider.random_scale_point_cloud(points[:, :, 0:3])
-            points[:, :, 0:3] = provider.shift_point_cloud(points[:, :, 0:3])
-            points = torch.Tensor(points)
-            points, label, target = points.float().cuda(), label.long().cuda(), target.long().cuda()
-            points = points.transpose(2, 1)
-
-            seg_pred, trans_feat = classifier(points, to_categorical(label, num_classes))
-            seg_pred = seg_pred.contiguous().view(-1, num_part)
-            target = target.view(-1, 1)[:, 0]
-            pred_choice = seg_pred.data.max(1)[1]
-
-            correct = pred_choice.eq(target.data).cpu().sum()
-            mean_correct.append(correct.item() / (args.batch_size * args.npoint))
-            loss = criterion(seg_pred, target, trans_feat)
-            loss.backward()
-            optimizer.step()
-            epoch_loss += loss.item()
+                seg_pred, trans_feat = classifier(points, to_categorical(label, num_classes))
+                seg_pred = seg_pred.contiguous().view(-1, num_part)
+                target = target.view(-1, 1)[:, 0]
+                pred_choice = seg_pred.data.max(1)[1]
+
+                correct = pred_choice.eq(target.data).cpu().sum()
+                mean_correct.append(correct.item() / (args.batch_size * args.npoint))
+                loss = criterion(seg_pred, target, trans_feat)
+                loss.backward()
+                optimizer.step()
+                epoch_loss += loss.item()
         epoch_loss /= (len(trainDataLoader) * args.batch_size)
 
         train_instance_acc = np.mean(mean_correct)
         log_string('Train loss, is %.5f accuracy is: %.5f' % (epoch_loss, train_instance_acc))
+        if train_cache is not None:
+            log_string(train_cache.summary())
+            train_cache.reset_stats()
 
         with torch.no_grad():
             test_metrics = {}
@@ -261,13 +435,26 @@ def main(args):
                 for label in seg_classes[cat]:
                     seg_label_to_cat[label] = cat
 
-            classifier = classifier.eval()
-
-            for batch_id, (points, label, target) in tqdm(enumerate(testDataLoader), total=len(testDataLoader), smoothing=0.9):
-                cur_batch_size, NUM_POINT, _ = points.size()
-                points, label, target = points.float().cuda(), label.long().cuda(), target.long().cuda()
-                points = points.transpose(2, 1)
-                seg_pred, _ = classifier(points, to_categorical(label, num_classes))
+            test_model = fold_for_inference(classifier, inplace=False) if args.fold else classifier.eval()
+            if test_cache is not None:
+                test_cache.attach(test_model)
+
+            if test_store is None:
+                batches = testDataLoader
+            else:
+                batches = ((feature, labels['label'], labels['target'])
+                           for feature, labels in test_store.batches(args.batch_size, shuffle=False))
+            for batch_id, (points, label, target, *index) in tqdm(enumerate(batches), total=len(testDataLoader), smoothing=0.9):
+                if test_cache is not None and test_store is None:
+                    test_cache.set_batch(index[0])
+                if test_store is None:
+                    cur_batch_size, NUM_POINT, _ = points.size()
+                    points, label, target = points.float().cuda(), label.long().cuda(), target.long().cuda()
+                    points = points.transpose(2, 1)
+                    seg_pred, _ = test_model(points, to_categorical(label, num_classes))
+                else:
+                    cur_batch_size, _, NUM_POINT = points.size()
+                    seg_pred = test_model.head(points.cuda())
                 cur_pred_val = seg_pred.cpu().data.numpy()
                 cur_pred_val_logits = cur_pred_val
                 cur_pred_val = np.zeros((cur_batch_size, NUM_POINT)).astype(np.int32)
@@ -313,6 +500,9 @@ def main(args):
                 log_string('eval mIoU of %s %f' % (cat + ' ' * (14 - len(cat)), shape_ious[cat]))
             test_metrics['class_avg_iou'] = mean_shape_ious
             test_metrics['inctance_avg_iou'] = np.mean(all_shape_ious)
+            if test_cache is not None:
+                log_string(test_cache.summary())
+                test_cache.reset_stats()
 
         log_string('Epoch %d test Accuracy: %f  Class avg mIOU: %f   Inctance avg mIOU: %f' % (
             epoch + 1, test_metrics['accuracy'], test_metrics['class_avg_iou'], test_metrics['inctance_avg_iou']))
@@ -331,7 +521,7 @@ def main(args):
                 'optimizer_state_dict': optimizer.state_dict(),
                 'cond_dict': cond_dict,
             }
-            torch.save(state, savepath)
+            writer.save(state, savepath, classifier)
             log_string('Saving model....')
 
         if test_metrics['accuracy'] > best_acc:
@@ -347,6 +537,7 @@ def main(args):
 
     for cat in sorted(best_shape_ious.keys()):
         log_string('Best eval mIoU of %s %f' % (cat + ' ' * (14 - len(cat)), shape_ious[cat]))
+    writer.close()
 
 if __name__ == '__main__':
     args = parse_args()
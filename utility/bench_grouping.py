@@ -0,0 +1,948 @@
+'''
+Micro-benchmarks for the sampling and grouping functions in models/model_utils.py.
+Every benchmark first checks that the optimized path gives the same indices as the
+reference implementation, then reports the average wall time of both.
+
+Run from the repository root, e.g.
+    python -m utility.bench_grouping --bench select --device cpu
+    python -m utility.bench_grouping --bench grid --radius 0.05 --num_points 4096,16384
+    python -m utility.bench_grouping --bench share --num_points 2048 --batch_size 256
+    python -m utility.bench_grouping --bench chunk --mem_budget 67108864
+    python -m utility.bench_grouping --bench stream --batch_size 64 --num_feat 8192
+    python -m utility.bench_grouping --bench ensemble --ensemble 4 --num_points 1024
+    python -m utility.bench_grouping --bench bitplane --batch_size 8
+    python -m utility.bench_grouping --bench vmm --npoint 16 --read_noise 0.05
+    python -m utility.bench_grouping --bench crossbar --npoint 128 --read_noise 0.05
+    python -m utility.bench_grouping --bench calib --batch_size 8
+    python -m utility.bench_grouping --bench mc --realisations 8 --num_points 1024
+    python -m utility.bench_grouping --bench procedural --num_feat 8192 --npoint 128
+    python -m utility.bench_grouping --bench ckpt --num_feat 4096
+    python -m utility.bench_grouping --bench blocksparse --device cpu --block 8,8 --num_feat 1024
+    python -m utility.bench_grouping --bench fold --num_points 1024,4096
+'''
+import argparse
+import io
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import torch
+import torch.nn.functional as F
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'models'))
+from models.model_utils import square_distance, query_ball_point, farthest_point_sample, \
+    farthest_point_sample_and_query, query_ball_point_grid, index_points, three_interpolate, PointNetFeaturePropagation, \
+    NewGraphSetAbstraction, FeaturePropagation, fold_for_inference, shared_copy
+import model_cls_rand
+from noise_layers import NoiseConv, NoiseConv1d, GaussianReadNoise, set_block_sparse
+from crossbar import CrossbarEngine
+from procedural import ProceduralWeight
+from utility import utils
+from utility.noise_eval import MonteCarloEvaluator
+from utility.checkpoint import CheckpointWriter, load_checkpoint, snap_conductances
+from utility.readout import RidgeReadout
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('bench_grouping')
+    parser.add_argument('--bench', type=str, default='select', choices=['select', 'grid', 'fused', 'fps', 'share', 'chunk', 'stream', 'ensemble', 'bitplane', 'vmm', 'crossbar', 'calib', 'mc', 'procedural', 'ckpt', 'blocksparse', 'fold'], help='benchmark to run')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_points', type=str, default='1024,2048,4096,16384', help='values of N')
+    parser.add_argument('--npoint', type=int, default=512, help='number of centroids S')
+    parser.add_argument('--nsample', type=int, default=32)
+    parser.add_argument('--radius', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--fps_threads', type=int, default=4, help='FPS threads of the fps benchmark')
+    parser.add_argument('--mem_budget', type=int, default=64 * 2 ** 20, help='bytes for the chunked benchmark')
+    parser.add_argument('--num_feat', type=int, default=4096, help='group_all output channels for the streaming benchmark')
+    parser.add_argument('--stream_block', type=int, default=16)
+    parser.add_argument('--ensemble', type=int, default=4, help='members of the ensemble benchmark')
+    parser.add_argument('--read_noise', type=float, default=0.05, help='crossbar read noise of the vmm benchmark')
+    parser.add_argument('--tile', type=str, default='64,64', help='array size of the crossbar benchmark')
+    parser.add_argument('--realisations', type=int, default=8, help='programming noise realisations of the mc benchmark')
+    parser.add_argument('--prog_noise', type=float, default=0.05, help='relative programming noise of the mc benchmark')
+    parser.add_argument('--rows', type=int, default=64, help='output channels per tile of the procedural benchmark')
+    parser.add_argument('--block', type=str, default='8,8', help='rows,cols of the structured masks of the blocksparse benchmark')
+    parser.add_argument('--seeds', type=int, default=3, help='weight draws of the blocksparse accuracy')
+    parser.add_argument('--c_prune_rate', type=float, default=3.2, help='channel pruning of the share benchmark, 3.2 as in run_seg.sh')
+    return parser.parse_args()
+
+
+def timed(fn, repeat, device):
+    fn()    # warm up
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    t = time()
+    for _ in range(repeat):
+        out = fn()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return out, (time() - t) / repeat
+
+
+def query_ball_point_sort(radius, nsample, xyz, new_xyz):
+    '''reference ball query with a full sort over N'''
+    B, N, C = xyz.shape
+    _, S, _ = new_xyz.shape
+    group_idx = torch.arange(N, dtype=torch.long).to(xyz.device).view(1, 1, N).repeat([B, S, 1])
+    dist = square_distance(new_xyz, xyz)
+    group_idx[dist > radius ** 2] = N
+    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
+    group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
+    mask = group_idx == N
+    group_idx[mask] = group_first[mask]
+    return group_idx
+
+
+def three_nn_sort(xyz1, xyz2):
+    '''reference 3-NN selection of FeaturePropagation with a full sort over S'''
+    dists, idx = square_distance(xyz1, xyz2).sort(dim=-1)
+    return dists[:, :, :3], idx[:, :, :3]
+
+
+def three_nn_topk(xyz1, xyz2):
+    return square_distance(xyz1, xyz2).topk(3, dim=-1, largest=False, sorted=True)
+
+
+def bench_select(args):
+    print('N\tball_sort\tball_topk\tspeedup\t3nn_sort\t3nn_topk\tspeedup')
+    for N in map(int, args.num_points.split(',')):
+        xyz = torch.rand(args.batch_size, N, 3, device=args.device)
+        new_xyz = xyz[:, torch.randperm(N, device=args.device)[:args.npoint]]
+
+        ref, t_ref = timed(lambda: query_ball_point_sort(args.radius, args.nsample, xyz, new_xyz), args.repeat, args.device)
+        out, t_out = timed(lambda: query_ball_point(args.radius, args.nsample, xyz, new_xyz), args.repeat, args.device)
+        assert torch.equal(ref, out), 'ball query indices differ at N=%d' % N
+
+        # FeaturePropagation interpolates all N points from the S centroids
+        (d_ref, i_ref), t_nn_ref = timed(lambda: three_nn_sort(xyz, new_xyz), args.repeat, args.device)
+        (d_out, i_out), t_nn_out = timed(lambda: three_nn_topk(xyz, new_xyz), args.repeat, args.device)
+        # exactly tied centroids may come out in a different order, so compare the distances they select
+        d_sel = torch.gather(square_distance(xyz, new_xyz), 2, i_out)
+        assert torch.equal(d_ref, d_out) and torch.equal(d_ref, d_sel), '3-NN selection differs at N=%d' % N
+
+        print('%d\t%.4fs\t\t%.4fs\t\t%.2fx\t%.4fs\t\t%.4fs\t\t%.2fx' % (
+            N, t_ref, t_out, t_ref / t_out, t_nn_ref, t_nn_out, t_nn_ref / t_nn_out))
+
+
+def assert_same_ball(ref, out, radius, xyz, new_xyz, distance_type, message):
+    '''
+    group_idx of two ball queries agree up to points within float32 rounding of the radius,
+    which a [B, S, N] and a [B, S, M] matmul may decide differently
+    '''
+    for b, s in (ref != out).any(-1).nonzero().tolist():
+        diff = new_xyz[b, s].double() - xyz[b].double()
+        dist = (diff ** 2).sum(-1) if distance_type == 'l2' else diff.abs().sum(-1)
+        # the l2 expansion -2ab + |a|^2 + |b|^2 rounds on the scale of the squared norms
+        scale = (xyz[b].double() ** 2).sum(-1).max() if distance_type == 'l2' else radius ** 2
+        border = ((dist - radius ** 2).abs() <= 1e-5 * scale).nonzero().flatten()
+        rows = [row[~torch.isin(row, border)] for row in (ref[b, s].unique_consecutive(), out[b, s].unique_consecutive())]
+        n = min(len(rows[0]), len(rows[1]))
+        assert torch.equal(rows[0][:n], rows[1][:n]), message
+
+
+def bench_grid(args):
+    '''
+    Voxel-grid ball query against the dense one, for l2 and l1, on random points and on a
+    1/64 lattice where many points lie exactly on the radius; then the time of both.
+    '''
+    for distance_type, radius in [('l2', args.radius), ('l1', args.radius * 2)]:
+        for lattice in [False, True]:
+            xyz = torch.rand(args.batch_size, 2048, 3, device=args.device)
+            if lattice:
+                xyz = torch.floor(xyz * 64) / 64
+            new_xyz = xyz[:, torch.randperm(2048, device=args.device)[:args.npoint]]
+            ref = query_ball_point(radius, args.nsample, xyz, new_xyz, distance_type=distance_type)
+            out = query_ball_point_grid(radius, args.nsample, xyz, new_xyz, distance_type=distance_type,
+                                        max_fraction=1, max_radius=1, min_points=0)
+            message = 'grid %s query differs%s' % (distance_type, ' on the lattice' if lattice else '')
+            if lattice:
+                # exact distances, no rounding at the radius
+                assert torch.equal(ref, out), message
+            else:
+                # the candidate matmul has another shape than the dense one and may round a
+                # distance within an ulp of the radius the other way
+                assert_same_ball(ref, out, radius, xyz, new_xyz, distance_type, message)
+                print('grid %s query on random points: %d of %d queries bit-identical'
+                      % (distance_type, (ref == out).all(-1).sum(), ref.shape[0] * ref.shape[1]))
+    print('grid ball query matches the dense one for l2 and l1, exactly on the lattice')
+
+    # sizes and radii where the grid runs; below 2048 points and from 0.15 (max_radius and
+    # the max_fraction estimate) it returns the dense query, e.g. at 0.18, the SA radius of
+    # train_classification_dvs.py
+    print('N\tradius\tdense\t\tgrid\t\tspeedup')
+    for N in [N for N in map(int, args.num_points.split(',')) if N >= 2048]:
+        for radius in [0.05, 0.1, 0.12]:
+            xyz = torch.rand(args.batch_size, N, 3, device=args.device)
+            new_xyz = xyz[:, torch.randperm(N, device=args.device)[:args.npoint]]
+            ref, t_ref = timed(lambda: query_ball_point(radius, args.nsample, xyz, new_xyz), args.repeat, args.device)
+            out, t_out = timed(lambda: query_ball_point_grid(radius, args.nsample, xyz, new_xyz), args.repeat, args.device)
+            assert_same_ball(ref, out, radius, xyz, new_xyz, 'l2', 'grid ball query differs at N=%d' % N)
+            print('%d\t%.2f\t%.4fs\t\t%.4fs\t\t%.2fx' % (N, radius, t_ref, t_out, t_ref / t_out))
+
+
+def sample_then_query(xyz, npoint, radius, nsample, distance_type):
+    fps_idx = farthest_point_sample(xyz, npoint, distance_type=distance_type)
+    new_xyz = index_points(xyz, fps_idx)
+    return fps_idx, query_ball_point(radius, nsample, xyz, new_xyz, distance_type=distance_type)
+
+
+def shell_cloud(batch_size, radius, device, bases=128, shell=7):
+    '''
+    Random float points, each with shell points at a distance within a relative 1e-5 of
+    radius, where the rounding of the distance decides the ball query, [B, bases * (shell + 1), 3]
+    '''
+    base = torch.rand(batch_size, bases, 1, 3, device=device)
+    direction = F.normalize(torch.randn(batch_size, bases, shell, 3, device=device), dim=-1)
+    scale = radius * (1 + 1e-5 * torch.randn(batch_size, bases, shell, 1, device=device))
+    return torch.cat([base, base + direction * scale], 2).view(batch_size, -1, 3)
+
+
+def fps_distance(src, dst, distance_type):
+    '''[B, S, N] distances of the FPS formula, elementwise, sum((xyz - centroid) ** 2)'''
+    diff = dst.unsqueeze(1) - src.unsqueeze(2)
+    return torch.sum(diff ** 2 if distance_type == 'l2' else torch.abs(diff), -1)
+
+
+def check_fused(args):
+    '''
+    The fused path against FPS followed by query_ball_point on distances of the FPS formula,
+    bit for bit, on points of a 1/64 lattice and on random points around the radius; on the
+    lattice, where the distances are exact, also against the square_distance query
+    '''
+    for distance_type, radius in [('l2', args.radius), ('l1', args.radius * 2)]:
+        for lattice in [True, False]:
+            if lattice:
+                xyz = torch.randint(0, 64, (args.batch_size, 1024, 3), device=args.device).float() / 64
+            else:
+                # the query compares the l1 distance itself against radius ** 2
+                xyz = shell_cloud(args.batch_size, radius if distance_type == 'l2' else radius ** 2, args.device)
+            torch.manual_seed(1)
+            fps_ref = farthest_point_sample(xyz, args.npoint, distance_type=distance_type)
+            new_xyz = index_points(xyz, fps_ref)
+            idx_ref = query_ball_point(radius, args.nsample, xyz, new_xyz, distance_type=distance_type,
+                                       dist=fps_distance(new_xyz, xyz, distance_type))
+            torch.manual_seed(1)
+            fps_out, idx_out = farthest_point_sample_and_query(xyz, args.npoint, radius, args.nsample, distance_type)
+            message = 'fused %s path differs%s' % (distance_type, ' on the lattice' if lattice else ' around the radius')
+            assert torch.equal(fps_ref, fps_out) and torch.equal(idx_ref, idx_out), message
+            if lattice:
+                assert torch.equal(idx_out, query_ball_point(radius, args.nsample, xyz, new_xyz, distance_type=distance_type)), message
+            torch.manual_seed(1)
+            fps_out, idx_out = farthest_point_sample_and_query(xyz, args.npoint, radius, args.nsample, distance_type,
+                                                               num_threads=args.fps_threads, block=7)
+            assert torch.equal(fps_ref, fps_out) and torch.equal(idx_ref, idx_out), message + ' on threads'
+    print('fused FPS + ball query matches the two-step path on the FPS distances')
+
+
+def bench_fused(args):
+    check_fused(args)
+    print('N	two_step	fused		speedup')
+    for N in map(int, args.num_points.split(',')):
+        xyz = torch.rand(args.batch_size, N, 3, device=args.device)
+        _, t_ref = timed(lambda: sample_then_query(xyz, args.npoint, args.radius, args.nsample, 'l2'), args.repeat, args.device)
+        _, t_out = timed(lambda: farthest_point_sample_and_query(xyz, args.npoint, args.radius, args.nsample), args.repeat, args.device)
+        print('%d\t%.4fs\t\t%.4fs\t\t%.2fx' % (N, t_ref, t_out, t_ref / t_out))
+
+
+def farthest_point_sample_mask(xyz, npoint, distance_type='l2'):
+    '''reference FPS with boolean-mask updates in a Python loop'''
+    device = xyz.device
+    B, N, C = xyz.shape
+    centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
+    distance = torch.ones(B, N).to(device) * 1e10
+    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
+    batch_indices = torch.arange(B, dtype=torch.long).to(device)
+    for i in range(npoint):
+        centroids[:, i] = farthest
+        centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
+        if distance_type == 'l2':
+            dist = torch.sum((xyz - centroid) ** 2, -1)
+        elif distance_type == 'l1':
+            dist = torch.sum(torch.abs(xyz - centroid), -1)
+        mask = dist < distance
+        distance[mask] = dist[mask]
+        farthest = torch.max(distance, -1)[1]
+    return centroids
+
+
+def bench_fps(args):
+    for distance_type in ['l2', 'l1']:
+        xyz = torch.rand(args.batch_size, 1024, 3, device=args.device)
+        torch.manual_seed(1)
+        ref = farthest_point_sample_mask(xyz, args.npoint, distance_type)
+        torch.manual_seed(1)
+        out = farthest_point_sample(xyz, args.npoint, distance_type)
+        assert torch.equal(ref, out), 'FPS %s indices differ' % distance_type
+    print('FPS kernel matches the reference')
+
+    print('single sample latency')
+    print('N\tmask\t\tkernel\t\tspeedup')
+    for N in map(int, args.num_points.split(',')):
+        xyz = torch.rand(1, N, 3, device=args.device)
+        _, t_ref = timed(lambda: farthest_point_sample_mask(xyz, args.npoint), args.repeat, args.device)
+        _, t_out = timed(lambda: farthest_point_sample(xyz, args.npoint), args.repeat, args.device)
+        print('%d\t%.4fs\t\t%.4fs\t\t%.2fx' % (N, t_ref, t_out, t_ref / t_out))
+
+    print('batch 128 throughput, N=1024, %d intra-op threads' % torch.get_num_threads())
+    xyz = torch.rand(128, 1024, 3, device=args.device)
+    _, t_ref = timed(lambda: farthest_point_sample_mask(xyz, args.npoint), args.repeat, args.device)
+    print('mask %.1f samples/s' % (128 / t_ref))
+    for threads in sorted({1, args.fps_threads}):
+        _, t_out = timed(lambda: farthest_point_sample(xyz, args.npoint, num_threads=threads), args.repeat, args.device)
+        print('kernel, %d FPS threads %.1f samples/s, %.2fx' % (threads, 128 / t_out, t_ref / t_out))
+
+
+def peak_rss(fn):
+    '''
+    Run fn in a forked child and return its (tensor, time) result with the child's peak resident
+    memory in MB, or None if the child died, e.g. killed for running out of memory. The child
+    starts with the resident memory of this process, which the peak includes.
+    '''
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+
+    def child():
+        out, t = fn()
+        # as numpy, a torch tensor would be shared through a file descriptor of the exited child
+        queue.put(((out.numpy(), t), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10))
+    process = ctx.Process(target=child)
+    process.start()
+    while True:
+        try:
+            (out, t), peak = queue.get(timeout=1)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                return None
+    process.join()
+    return (torch.from_numpy(out), t), peak
+
+
+def bench_share(args):
+    '''
+    forward time and peak memory of the part segmentation model of run_seg.sh with separate SA/FP
+    distances, with --share_dist and with --precompute, all with --mem_budget for the distance
+    matrices; peak RSS on CPU, peak allocated on CUDA
+    '''
+    from models.model_part_seg import get_model
+    variants = [('separate', {}), ('shared', {'share_dist': True}), ('precompute', {'precompute': True})]
+    models = [get_model(50, c_prune_rate=args.c_prune_rate, feat1=375, num_feat=750, mem_budget=args.mem_budget,
+                        **kw).to(args.device).eval()
+              for _, kw in variants]
+    for model in models[1:]:
+        model.load_state_dict(models[0].state_dict())
+
+    def forward(model, xyz, cls_label):
+        torch.manual_seed(1)    # same FPS start for every model
+        with torch.no_grad():
+            return model(xyz, cls_label)[0]
+
+    cuda = args.device.startswith('cuda')
+    print('N\tbatch\tmodel\t\ttime\t\tspeedup\tpeak\t\tmax |diff|')
+    for N in map(int, args.num_points.split(',')):
+        torch.manual_seed(0)
+        xyz = torch.rand(args.batch_size, 3, N, device=args.device)
+        cls_label = F.one_hot(torch.randint(0, 16, (args.batch_size,)), 16).float().to(args.device)
+        ref = None
+        for (name, _), model in zip(variants, models):
+            run = lambda: timed(lambda: forward(model, xyz, cls_label), args.repeat, args.device)
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats()
+                (out, t), peak = run(), torch.cuda.max_memory_allocated() / 2 ** 20
+            else:
+                result = peak_rss(run)
+                if result is None:
+                    print('%d\t%d\t%s\tkilled, out of memory' % (N, args.batch_size, name.ljust(10)))
+                    continue
+                (out, t), peak = result
+            if ref is None:
+                ref, t_ref = out, t
+            # both reorder the float sums, so only compare numerically
+            print('%d\t%d\t%s\t%.3fs\t\t%.2fx\t%.0fMB\t\t%.2e' % (
+                N, args.batch_size, name.ljust(10), t, t_ref / t, peak, (out - ref).abs().max().item()))
+
+
+def check_chunk(args):
+    '''chunked and unchunked ball query and 3-NN interpolation give identical outputs'''
+    xyz = torch.rand(args.batch_size, 2048, 3, device=args.device)
+    new_xyz = xyz[:, torch.randperm(2048, device=args.device)[:args.npoint]]
+    points2 = torch.rand(args.batch_size, args.npoint, 64, device=args.device)
+    fp = PointNetFeaturePropagation(64, [32]).to(args.device).eval()
+    with torch.no_grad():
+        fp_ref = fp(xyz.transpose(1, 2), new_xyz.transpose(1, 2), None, points2.transpose(1, 2))
+    # from the smallest chunks up to a budget that needs no chunking
+    for mem_budget in [1, 2 ** 16, 2 ** 20, 2 ** 24, 2 ** 40]:
+        for distance_type, radius in [('l2', args.radius), ('l1', args.radius * 2)]:
+            ref = query_ball_point(radius, args.nsample, xyz, new_xyz, distance_type=distance_type)
+            out = query_ball_point(radius, args.nsample, xyz, new_xyz, distance_type=distance_type, mem_budget=mem_budget)
+            assert torch.equal(ref, out), 'chunked %s ball query differs at budget %d' % (distance_type, mem_budget)
+        ref = three_interpolate(xyz, new_xyz, points2)
+        out = three_interpolate(xyz, new_xyz, points2, mem_budget=mem_budget)
+        assert torch.equal(ref, out), 'chunked interpolation differs at budget %d' % mem_budget
+        fp.mem_budget = mem_budget
+        with torch.no_grad():
+            out = fp(xyz.transpose(1, 2), new_xyz.transpose(1, 2), None, points2.transpose(1, 2))
+        assert torch.equal(fp_ref, out), 'chunked feature propagation differs at budget %d' % mem_budget
+    print('chunked ball query and interpolation match the unchunked path')
+
+
+def bench_chunk(args):
+    check_chunk(args)
+    cuda = args.device.startswith('cuda')
+    print('budget %.0fMB, peak memory on CUDA only' % (args.mem_budget / 2 ** 20))
+    print('N\tball full\tball chunked\tpeak full\tpeak chunked\tinterp full\tinterp chunked\tpeak full\tpeak chunked')
+    for N in map(int, args.num_points.split(',')):
+        xyz = torch.rand(args.batch_size, N, 3, device=args.device)
+        new_xyz = xyz[:, torch.randperm(N, device=args.device)[:args.npoint]]
+        points2 = torch.rand(args.batch_size, args.npoint, 128, device=args.device)
+        row = []
+        for fn in [lambda budget: query_ball_point(args.radius, args.nsample, xyz, new_xyz, mem_budget=budget),
+                   lambda budget: three_interpolate(xyz, new_xyz, points2, mem_budget=budget)]:
+            times, peaks = [], []
+            for budget in [None, args.mem_budget]:
+                if cuda:
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats()
+                _, t = timed(lambda: fn(budget), args.repeat, args.device)
+                times.append(t)
+                peaks.append(torch.cuda.max_memory_allocated() / 2 ** 20 if cuda else float('nan'))
+            row += times + peaks
+        print('%d\t%.4fs\t\t%.4fs\t\t%.0fMB\t\t%.0fMB\t\t%.4fs\t\t%.4fs\t\t%.0fMB\t\t%.0fMB' % (N, *row))
+
+
+def bench_stream(args):
+    '''group_all SA layer with and without streaming, in eval and train mode'''
+    sa = NewGraphSetAbstraction(None, None, None, 256 + 3, [args.num_feat], True).to(args.device)
+    with torch.no_grad():
+        sa.mlp_bns[0].weight.uniform_(-1, 1)    # negative scales take the min path
+    xyz = torch.rand(args.batch_size, 3, args.npoint, device=args.device)
+    points = torch.randn(args.batch_size, 256, args.npoint, device=args.device)
+    cuda = args.device.startswith('cuda')
+    print('mode\tfull\t\tstreamed\tpeak full\tpeak streamed\tmax |diff|')
+    for train in [False, True]:
+        sa.train(train)
+        outs, times, peaks, stats = [], [], [], []
+        for stream_block in [None, args.stream_block]:
+            sa.stream_block = stream_block
+            sa.mlp_bns[0].reset_running_stats()
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats()
+            with torch.no_grad():
+                out, t = timed(lambda: sa(xyz, points)[1], args.repeat, args.device)
+            outs.append(out)
+            times.append(t)
+            peaks.append(torch.cuda.max_memory_allocated() / 2 ** 20 if cuda else float('nan'))
+            stats.append(sa.mlp_bns[0].running_var.clone())
+        assert torch.allclose(outs[0], outs[1], atol=1e-5) and torch.allclose(stats[0], stats[1], rtol=1e-5), \
+            'streamed group_all differs in %s mode' % ('train' if train else 'eval')
+        print('%s\t%.4fs\t\t%.4fs\t\t%.0fMB\t\t%.0fMB\t\t%.2e' % (
+            'train' if train else 'eval', times[0], times[1], peaks[0], peaks[1], (outs[0] - outs[1]).abs().max().item()))
+
+
+def bench_ensemble(args):
+    '''SA stack of model_cls_rand as one grouped ensemble against its members run one after another'''
+    E = args.ensemble
+    make = lambda ensemble: model_cls_rand.get_model(10, normal_channel=False, c_prune_rate=2, hard_mode=None,
+                                                     ensemble=ensemble).to(args.device).eval()
+    ensemble, members = make(E), [make(1) for _ in range(E)]
+    # member e gets block e of every stacked conv/bn tensor
+    state = ensemble.state_dict()
+    for e, member in enumerate(members):
+        member_state = member.state_dict()
+        for k, v in member_state.items():
+            if k.startswith('sa.'):
+                stacked = v.dim() and state[k].shape[0] == E * v.shape[0]
+                member_state[k] = state[k][e * v.shape[0]:(e + 1) * v.shape[0]] if stacked else state[k]
+        member.load_state_dict(member_state)
+
+    def seeded(model, xyz):
+        torch.manual_seed(1)    # same FPS start for every run
+        return model.sa_features(xyz)
+
+    print('N\tensemble x%d\tsequential\tspeedup\tmax |diff|' % E)
+    for N in map(int, args.num_points.split(',')):
+        xyz = torch.rand(args.batch_size, 3, N, device=args.device)
+        with torch.no_grad():
+            out, t_ens = timed(lambda: seeded(ensemble, xyz), args.repeat, args.device)
+            ref, t_seq = timed(lambda: torch.cat([seeded(m, xyz) for m in members], 1), args.repeat, args.device)
+        assert torch.allclose(out, ref, atol=1e-5), 'ensemble differs from its members for N=%d' % N
+        print('%d\t%.4fs\t\t%.4fs\t\t%.2fx\t%.2e' % (N, t_ens, t_seq, t_seq / t_ens, (out - ref).abs().max().item()))
+
+
+def bench_bitplane(args):
+    '''hardware batch mode: one conv per input bit plane against one conv on the integer codes'''
+    B, S, K = args.batch_size, args.npoint, args.nsample
+    layers = [('sa conv', NoiseConv(131, 128, hardware=True, mode='batch'), (B, 131, K, S)),
+              ('fp conv1d', NoiseConv1d(384, 256, hardware=True, mode='batch'), (B, 384, 4 * S))]
+    print('layer\t\tper-bit\t\tinteger\t\tspeedup\tmax rel diff')
+    for name, layer, shape in layers:
+        layer = layer.to(args.device)
+        layer.quant_base = layer.quant_base.to(args.device)
+        utils.replace_model_weight(layer, 0.)
+        x = torch.randn(*shape, device=args.device)
+        with torch.no_grad():
+            ref, t_bit = timed(lambda: layer.hardware_inference(*layer.channel_wise_codes(x)), args.repeat, args.device)
+            out, t_int = timed(lambda: layer.integer_inference(*layer.channel_wise_codes(x)), args.repeat, args.device)
+        assert torch.equal(out.float(), ref.float()), 'integer path differs for the %s' % name
+        print('%s\t%.4fs\t\t%.4fs\t\t%.1fx\t%.1e' % (name, t_bit, t_int, t_bit / t_int,
+                                                  ((out - ref).abs().max() / ref.abs().max()).item()))
+
+
+class SampledReadNoise(object):
+    '''GaussianReadNoise without read(), so vmm_inference reads one vector at a time'''
+    def __init__(self, noise):
+        self.backend = GaussianReadNoise(noise)
+
+    def register(self, layer, bias=True):
+        return self.backend.register(layer, bias)
+
+    def __call__(self, conv, code):
+        return self.backend(conv, code)
+
+    def sample(self, conv, code, P):
+        return self.backend.sample(conv, code, P)
+
+
+def vmm_loop(layer, x, scaling, b):
+    '''
+    Reference of NoiseConv.vmm_inference: one crossbar read with its own weight realisation
+    for every bit plane of every input vector, and the offset of the quantization minimum
+    with the weights of the last read.
+    '''
+    out_sum = 0
+    for bit in range(layer.quant_bit):
+        x_bit = layer.bit_plane(x, bit, torch.float64)
+        x_new = []
+        for i in range(x_bit.shape[0]):
+            x_sample = []
+            for j in range(x_bit.shape[2]):
+                x_group = []
+                for z in range(x_bit.shape[3]):
+                    xi = x_bit[i, :, j, z].unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
+                    weight = layer.hard_weight(layer.conv, layer.code)
+                    if type(weight) is tuple:
+                        weight, bias = weight
+                    else:
+                        bias = layer.conv.bias
+                    weight, bias = weight.to(x.device).to(x_bit.dtype), bias.to(x.device).to(x_bit.dtype)
+                    x_group.append(F.conv2d(xi, weight))
+                x_sample.append(torch.cat(x_group, 3))    # [1, out, 1, npoints]
+            x_new.append(torch.cat(x_sample, 2))    # [1, out, nsamples, npoints]
+        out_sum = out_sum + torch.cat(x_new, 0) * layer.quant_base[bit]
+    return out_sum * scaling + F.conv2d(b * torch.ones_like(x, dtype=torch.float64), weight, bias=bias)
+
+
+def bench_vmm(args):
+    '''vmm mode: per-vector crossbar reads of vmm_loop against vmm_inference'''
+    shape = (1, 131, args.nsample, args.npoint)
+    layer = NoiseConv(131, 128, hard_weight=GaussianReadNoise(0.), mode='vmm', vmm_budget=args.mem_budget).to(args.device)
+    layer.quant_base = layer.quant_base.to(args.device)
+    utils.replace_model_weight(layer, 0.)
+    x = torch.rand(*shape, device=args.device)
+    with torch.no_grad():
+        codes = layer.channel_wise_codes(x)
+        ref = vmm_loop(layer, *codes)
+        out = layer.vmm_inference(*codes)
+        assert torch.allclose(out, ref, atol=1e-9), 'vmm_inference differs from the loop without read noise'
+        print('%d vectors, max diff without read noise %.1e' % (ref[0, 0].numel() * shape[0], (out - ref).abs().max().item()))
+        layer.hard_weight = SampledReadNoise(0.)
+        assert torch.allclose(layer.vmm_inference(*codes), ref, atol=1e-9), 'per-vector reads differ from the loop'
+
+        print('path		time		speedup')
+        _, t_loop = timed(lambda: vmm_loop(layer, *codes), 1, args.device)
+        print('loop		%.4fs' % t_loop)
+        for name, backend in [('vector', SampledReadNoise(args.read_noise)), ('read', GaussianReadNoise(args.read_noise))]:
+            layer.hard_weight = backend
+            _, t = timed(lambda: layer.vmm_inference(*codes), args.repeat, args.device)
+            print('%s		%.4fs		%.1fx' % (name, t, t_loop / t))
+
+
+def bench_crossbar(args):
+    '''tiled crossbar engine on the SA-sized layer: exactness, ADC error per resolution and the read time'''
+    shape = (args.batch_size, 131, args.nsample, args.npoint)
+    tile = tuple(map(int, args.tile.split(',')))
+    layer = NoiseConv(131, 128, hard_weight=CrossbarEngine(tile), mode='vmm', vmm_budget=args.mem_budget).to(args.device)
+    layer.quant_base = layer.quant_base.to(args.device)
+    _, cond_dict = utils.replace_model_weight(layer, 0.5)
+    layer.hard_weight.load(layer, cond_dict)
+    x = torch.rand(*shape, device=args.device)
+    with torch.no_grad():
+        codes = layer.channel_wise_codes(x)
+        ref = layer.integer_inference(*layer.channel_wise_codes(x))
+        out = layer.vmm_inference(*codes)
+        assert torch.allclose(out, ref, atol=1e-6 * ref.abs().max().item()), 'ideal crossbar differs from the conv'
+        print('%s, %d vectors x %d bits, ideal max rel diff %.1e' % (
+            layer.hard_weight.summary(), codes[0].numel() // 131, layer.quant_bit, ((out - ref).abs().max() / ref.abs().max()).item()))
+
+        print('adc bits\tread noise\trel rms error\ttime')
+        for adc_bits in [None, 10, 8, 6, 4]:
+            for noise in [0., args.read_noise]:
+                layer.hard_weight.adc_bits, layer.hard_weight.read_noise = adc_bits, noise
+                out, t = timed(lambda: layer.vmm_inference(*codes), args.repeat, args.device)
+                err = ((out - ref).pow(2).mean() / ref.pow(2).mean()).sqrt().item()
+                print('%s\t\t%g\t\t%.2e\t%.4fs' % (adc_bits or 'ideal', noise, err, t))
+
+
+def bench_calib(args):
+    '''batch mode with per-point input ranges against static calibrated ones, per layer and per channel'''
+    shape = (args.batch_size, 131, args.nsample, args.npoint)
+    layer = NoiseConv(131, 128, hardware=True, mode='batch').to(args.device)
+    layer.quant_base = layer.quant_base.to(args.device)
+    utils.replace_model_weight(layer, 0.5)
+    gain = torch.linspace(0.2, 2, 131, device=args.device).view(1, -1, 1, 1)    # channels of different range
+    batches = [torch.randn(*shape, device=args.device) * gain for _ in range(4)]
+    x = torch.randn(*shape, device=args.device) * gain
+    print('ranges\t\tcodes\t\tforward\t\trel rms error')
+    with torch.no_grad():
+        ref = layer.pointwise(layer.conv, x)
+        for granularity in [None, 'layer', 'channel']:
+            if granularity is not None:
+                layer.start_calibration(granularity)
+                for batch in batches:
+                    layer(batch)
+                layer.freeze_calibration()
+            _, t_codes = timed(lambda: layer.input_codes(x), args.repeat, args.device)
+            out, t = timed(lambda: layer(x), args.repeat, args.device)
+            err = ((out - ref).norm() / ref.norm()).item()
+            print('%s\t\t%.4fs\t\t%.4fs\t\t%.2e' % (granularity or 'per point', t_codes, t, err))
+
+        # the static path writes no state, so threads can share the layer
+        inputs = [torch.randn(*shape, device=args.device) * gain for _ in range(8)]
+        with ThreadPoolExecutor(4) as pool:
+            outs = list(pool.map(layer, inputs))
+        assert all(torch.equal(out, layer(x)) for out, x in zip(outs, inputs)), 'threads changed the outputs'
+        print('4 threads on one calibrated layer give the sequential outputs')
+
+
+def bench_mc(args):
+    '''programming-noise realisations of the cls model as grouped convs against one test pass per realisation'''
+    R, N = args.realisations, int(args.num_points.split(',')[0])
+    model = model_cls_rand.get_model(10, normal_channel=False, c_prune_rate=2, hard_mode=None).to(args.device).eval()
+    model, cond_dict = utils.replace_model_weight(model, 0.5)
+    loader = [(torch.rand(args.batch_size, N, 3), torch.randint(0, 10, (args.batch_size,))) for _ in range(4)]
+
+    def seeded(model, xyz):
+        torch.manual_seed(1)    # same FPS start for every run
+        return model.sa_features(xyz)
+
+    with torch.no_grad():
+        # noise free, every realisation is the model itself
+        mc = MonteCarloEvaluator(model, cond_dict, 0., R)
+        mc.draw()
+        xyz = loader[0][0].to(args.device).transpose(2, 1)
+        out, ref = mc.per_realisation(seeded(mc.model, xyz)), seeded(model, xyz).repeat_interleave(R, 0)
+        assert torch.allclose(out, ref, atol=1e-5), 'noise-free realisations differ from the model'
+        print('%d noise-free realisations, max |diff| %.2e' % (R, (out - ref).abs().max().item()))
+
+        # noisy, realisation r is the model programmed with the r-th drawn weights
+        mc = MonteCarloEvaluator(model, cond_dict, args.prog_noise, R)
+        mc.draw()
+        out = mc.per_realisation(seeded(mc.model, xyz)).view(xyz.shape[0], R, -1)
+        drawn, programmed = dict(mc.model.named_parameters()), shared_copy(model)
+        params, diff = dict(programmed.named_parameters()), 0.
+        for r in range(R):
+            for name, (pos, _) in mc.cond.items():
+                params[name].copy_(drawn[name].view(R, *pos.shape)[r])
+            ref = seeded(programmed, xyz).view(xyz.shape[0], -1)
+            assert torch.allclose(out[:, r], ref, atol=1e-5), 'realisation %d differs from its programmed model' % r
+            diff = max(diff, (out[:, r] - ref).abs().max().item())
+        print('%d noisy realisations, max |diff| to the programmed model %.2e' % (R, diff))
+
+        def sequential():
+            params = dict(programmed.named_parameters())
+            for name, (pos, neg) in mc.cond.items():
+                params[name].copy_(pos + torch.randn_like(pos) * args.prog_noise * pos
+                                   - (neg + torch.randn_like(neg) * args.prog_noise * neg))
+            return [programmed(points.to(args.device).transpose(2, 1))[0].max(1)[1] for points, _ in loader]
+
+        mc = MonteCarloEvaluator(model, cond_dict, args.prog_noise, R)
+        (instance_acc, _), t_mc = timed(lambda: mc.classification(loader, 10), args.repeat, args.device)
+        _, t_seq = timed(lambda: [sequential() for _ in range(R)], args.repeat, args.device)
+    print('realisations\tgrouped\t\tsequential\tspeedup')
+    print('%d\t\t%.4fs\t\t%.4fs\t\t%.2fx' % (R, t_mc, t_seq, t_seq / t_mc))
+    print('accuracy over realisations (random labels) %.3f +- %.3f' % (instance_acc.mean(), instance_acc.std()))
+
+
+def bench_procedural(args):
+    '''conv with procedural weights against the stored weights it regenerates, time and peak memory'''
+    weights = ProceduralWeight(seed=0, sparsity=0.5, rows=args.rows)
+    # the SA conv2d and the FP conv1d, both against their materialised weights
+    for cls, shape in [(NoiseConv1d, (args.batch_size, 259, args.npoint)),
+                       (NoiseConv, (args.batch_size, 259, args.nsample, args.npoint))]:
+        layer = cls(259, args.num_feat, procedural=weights, mode=None).to(args.device)
+        stored = cls(259, args.num_feat, mode=None).to(args.device)
+        with torch.no_grad():
+            stored.conv.weight.copy_(weights.weight(layer.conv, layer.procedural_code, args.device))
+            stored.conv.bias.copy_(layer.conv.bias)
+        x = torch.randn(*shape, device=args.device, requires_grad=True)
+
+        out, ref = layer(x), stored(x)
+        grad, grad_ref = torch.autograd.grad(out.sum(), x)[0], torch.autograd.grad(ref.sum(), x)[0]
+        scale = ref.abs().max().item()
+        assert torch.allclose(out, ref, atol=1e-5 * scale), 'procedural %s differs from its stored weights' % cls.__name__
+        assert torch.allclose(grad, grad_ref, atol=1e-5 * grad_ref.abs().max().item()), \
+            'procedural %s backward differs' % cls.__name__
+        print('%s max rel diff forward %.1e, backward %.1e' % (
+            cls.__name__, (out - ref).abs().max().item() / scale,
+            ((grad - grad_ref).abs().max() / grad_ref.abs().max()).item()))
+
+    print('weights\t\tparams\t\tforward\t\tpeak memory')
+    for name, conv in [('stored', stored), ('procedural', layer)]:
+        if args.device.startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats()
+        with torch.no_grad():
+            _, t = timed(lambda: conv(x), args.repeat, args.device)
+        # CPU allocations are not tracked
+        peak = '%.1f MB' % (torch.cuda.max_memory_allocated() / 2 ** 20) if args.device.startswith('cuda') else 'n/a'
+        print('%s\t%d\t\t%.4fs\t\t%s' % (name.ljust(10), sum(p.numel() for p in conv.parameters()), t, peak))
+
+
+def bench_ckpt(args):
+    '''
+    best-model checkpoint of the cls model in the torch format against the compact formats,
+    which load the frozen weights on their grid: the largest change of a frozen weight
+    '''
+    print('format\tsize\t\tsave\t\tload\t\ttorch.load\tmax |dW|')
+    for fmt in ['torch', 'fp16', 'int8']:
+        model = model_cls_rand.get_model(10, normal_channel=False, c_prune_rate=1, num_feat=args.num_feat,
+                                         hard_mode=None).to(args.device)
+        model, cond_dict = utils.replace_model_weight(model, 0.5)
+        for name, p in model.named_parameters():
+            p.requires_grad = 'fc' in name
+        optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad])
+        state = {'epoch': 1, 'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(),
+                 'cond_dict': cond_dict}
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'best_model.pth')
+            writer = CheckpointWriter(fmt)
+            t = time()
+            writer.save(state, path, model)
+            t_save = time() - t     # the snapshot, the write runs on the background thread
+            writer.close()
+            size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+            loaded, t_load = timed(lambda: load_checkpoint(path), args.repeat, 'cpu')
+            _, t_torch = timed(lambda: torch.load(path), args.repeat, 'cpu')
+        # the frozen weights come back on the grid, everything else as saved
+        snapped = cond_dict if fmt == 'torch' else snap_conductances(cond_dict, fmt)
+        d_w = 0.
+        for k, v in model.state_dict().items():
+            expected = snapped[k][0] - snapped[k][1] if k in snapped else v
+            assert torch.equal(loaded['model_state_dict'][k].to(v), expected.to(v)), 'checkpoint changed %s' % k
+            d_w = max(d_w, (loaded['model_state_dict'][k].to(v) - v).abs().max().item())
+        t_torch = '%.4fs' % t_torch if fmt == 'torch' else '-'
+        print('%s\t%.1f MB\t\t%.4fs\t\t%.4fs\t\t%s\t\t%.3g' % (fmt, size / 2 ** 20, t_save, t_load, t_torch, d_w))
+
+
+def synthetic_shapes(n, num_points):
+    '''
+    Point clouds on a sphere, cube, cylinder or cone surface, every one stretched, rotated
+    and jittered at random, in the unit sphere.
+    Return:
+        points [n, N, 3], labels [n]
+    '''
+    label = torch.arange(n) % 4
+    u = torch.rand(n, num_points, 3)
+    theta = 2 * torch.pi * u[..., 0]
+    sphere = F.normalize(torch.randn(n, num_points, 3), dim=-1)
+    cube = u * 2 - 1
+    face = F.one_hot(torch.randint(3, (n, num_points)), 3).bool()
+    cube = torch.where(face, torch.sign(torch.randn(n, num_points, 3)), cube)
+    cylinder = torch.stack([theta.cos(), theta.sin(), u[..., 1] * 2 - 1], -1)
+    h = u[..., 1].sqrt()    # uniform over the cone surface
+    cone = torch.stack([h * theta.cos(), h * theta.sin(), 1 - 2 * h], -1)
+    points = torch.stack([sphere, cube, cylinder, cone])[label, torch.arange(n)]
+    rotation = torch.linalg.qr(torch.randn(n, 3, 3))[0]
+    points = points * (0.6 + 0.4 * torch.rand(n, 1, 3)) @ rotation + 0.01 * torch.randn_like(points)
+    points = points - points.mean(1, keepdim=True)
+    return points / points.norm(dim=-1).max(1)[0].view(n, 1, 1), label
+
+
+def bench_blocksparse(args):
+    '''
+    50% sparse conductance masks of random cells against structured (rows, cols) blocks, each
+    zeroing a pos/neg pair together (W 50% zero) or pos and neg independently (W 25% zero):
+    a 259 -> 256 1x1 conv dense and block sparse for --block and taller blocks, and the ridge
+    readout test accuracy of the cls model on synthetic shapes with every mask, with the
+    feature extraction time dense and with set_block_sparse for the block masks
+    '''
+    block = tuple(map(int, args.block.split(',')))
+    x = torch.randn(args.batch_size, 259, args.nsample, args.npoint, device=args.device)
+    print('block\t\tblocks kept\tdense\t\tblock sparse\tspeedup')
+    for sparse_block in [block, (32, block[1]), (128, block[1]), (256, block[1])]:
+        layer = NoiseConv(259, 256, mode=None, vmm_budget=args.mem_budget).to(args.device)
+        utils.replace_model_weight(layer, 0.5, sparse_block, True)
+        layer.sparse_block = sparse_block
+        with torch.no_grad():
+            ref, t_dense = timed(lambda: layer.pointwise(layer.conv, x), args.repeat, args.device)
+            out, t_sparse = timed(lambda: layer(x), args.repeat, args.device)
+        assert torch.allclose(out, ref, atol=1e-5 * ref.abs().max().item()), 'block-sparse conv differs from dense'
+        weight, _ = layer.block_sparse_weight()
+        kept = weight.shape[-1] / (-(-259 // sparse_block[1]) * sparse_block[1])
+        print('%dx%d\t\t%.2f\t\t%.4fs\t\t%.4fs\t\t%.2fx' % (*sparse_block, kept, t_dense, t_sparse, t_dense / t_sparse))
+    del x, ref, out
+
+    # blocks over all output channels of every conv, the ones set_block_sparse runs sparse
+    column = (1024, block[1])
+    masks = [('random', None, False), ('random shared', None, True),
+             ('%dx%d independent' % block, block, False), ('%dx%d' % block, block, True),
+             ('%dx%d' % column, column, True)]
+    points, label = synthetic_shapes(400, 1024)
+    n_train = 300
+    print('mask\t\t\tW zero\ttest accuracy\t\tsparse convs\tfeatures dense\tblock sparse')
+    for name, mask_block, shared in masks:
+        accs, zeros, t_dense, t_sparse, n_sparse = [], [], 0., 0., 0
+        for seed in range(args.seeds):
+            torch.manual_seed(seed)
+            model = model_cls_rand.get_model(4, normal_channel=False, c_prune_rate=1, num_feat=args.num_feat,
+                                             hard_mode=None).to(args.device).eval()
+            model, cond_dict = utils.replace_model_weight(model, 0.5, mask_block, shared)
+            zeros.append(torch.cat([(pos - neg).flatten() == 0 for pos, neg in cond_dict.values()]).float().mean().item())
+
+            def features():
+                torch.manual_seed(seed)     # same FPS starts
+                with torch.no_grad():
+                    return torch.cat([model.extract_features(points[i:i + args.batch_size].to(args.device).transpose(2, 1))[0]
+                                      for i in range(0, len(points), args.batch_size)])
+            feature, t = timed(features, 1, args.device)
+            t_dense += t
+            if mask_block is not None:
+                n_sparse = len(set_block_sparse(model, mask_block))
+                sparse_feature, t = timed(features, 1, args.device)
+                t_sparse += t
+                assert torch.allclose(sparse_feature, feature, atol=1e-4 * feature.abs().max().item()), \
+                    'block-sparse features differ for the %s mask' % name
+
+            ridge = RidgeReadout(feature.shape[1], 4, device=args.device)
+            ridge.update(feature[:n_train], label[:n_train])
+            weight, bias = ridge.solve(1e-3 * ridge.HtH.diagonal()[:-1].mean().item())
+            pred = (feature[n_train:].double() @ weight.t() + bias).max(1)[1]
+            accs.append((pred.cpu() == label[n_train:]).float().mean().item())
+        accs = torch.tensor(accs)
+        sparse = '%d\t\t%.3fs\t\t%.3fs' % (n_sparse, t_dense / args.seeds, t_sparse / args.seeds) if mask_block else \
+            '-\t\t%.3fs' % (t_dense / args.seeds)
+        print('%s\t%.2f\t%.4f +- %.4f\t%s' % (name.ljust(20), sum(zeros) / len(zeros), accs.mean(),
+                                               accs.std() if len(accs) > 1 else 0., sparse))
+
+
+def random_bn_stats(model):
+    '''trained-looking BN statistics and affine parameters, negative scales included'''
+    with torch.no_grad():
+        for bn in model.modules():
+            if isinstance(bn, torch.nn.modules.batchnorm._BatchNorm):
+                bn.running_mean.normal_(0, 0.1)
+                bn.running_var.uniform_(0.5, 2)
+                bn.weight.uniform_(-1, 1)
+                bn.bias.normal_(0, 0.1)
+    return model
+
+
+def bench_fold(args):
+    '''cls model with two fc layers and a FeaturePropagation, folded for inference against unfolded'''
+    def make():
+        torch.manual_seed(0)
+        model = model_cls_rand.get_model(10, normal_channel=False, c_prune_rate=2, num_fc=2, hard_mode=None)
+        model, _ = utils.replace_model_weight(model, 0.5)
+        return random_bn_stats(model).to(args.device).eval()
+
+    def seeded(model, xyz):
+        torch.manual_seed(1)    # same FPS start for every run
+        return model(xyz)[0]
+
+    def seeded_seg(model, xyz, cls_label):
+        torch.manual_seed(1)
+        return model(xyz, cls_label)[0]
+
+    model = make()
+    folded = fold_for_inference(model, inplace=False)
+    # a folded state_dict loads into a folded model of the same arguments
+    buffer = io.BytesIO()
+    torch.save(folded.state_dict(), buffer)
+    buffer.seek(0)
+    loaded = fold_for_inference(make())
+    loaded.load_state_dict(torch.load(buffer))
+
+    print('N	unfolded	folded		speedup	max |diff|')
+    for N in map(int, args.num_points.split(',')):
+        xyz = torch.rand(args.batch_size, 3, N, device=args.device)
+        with torch.no_grad():
+            ref, t_ref = timed(lambda: seeded(model, xyz), args.repeat, args.device)
+            out, t = timed(lambda: seeded(folded, xyz), args.repeat, args.device)
+            assert torch.equal(seeded(loaded, xyz), out), 'reloaded folded model differs for N=%d' % N
+        assert torch.allclose(out, ref, atol=1e-5 * ref.abs().max().item()), 'folded model differs for N=%d' % N
+        print('%d	%.4fs		%.4fs		%.2fx	%.2e' % (N, t_ref, t, t_ref / t, (out - ref).abs().max().item()))
+
+    fp = random_bn_stats(FeaturePropagation(128 + 64, [128, 64])).to(args.device).eval()
+    fp_folded = fold_for_inference(fp, inplace=False)
+    N, S = int(args.num_points.split(',')[-1]), args.npoint
+    inputs = [torch.rand(args.batch_size, 3, N, device=args.device), torch.rand(args.batch_size, 3, S, device=args.device),
+              torch.randn(args.batch_size, 64, N, device=args.device), torch.randn(args.batch_size, 128, S, device=args.device)]
+    with torch.no_grad():
+        ref, t_ref = timed(lambda: fp(*inputs), args.repeat, args.device)
+        out, t = timed(lambda: fp_folded(*inputs), args.repeat, args.device)
+    assert torch.allclose(out, ref, atol=1e-5 * ref.abs().max().item()), 'folded FeaturePropagation differs'
+    print('FP %d <- %d	%.4fs		%.4fs		%.2fx	%.2e' % (N, S, t_ref, t, t_ref / t, (out - ref).abs().max().item()))
+
+    # the part segmentation model, the FP layers of --fold in train_segmentation.py
+    from models.model_part_seg import get_model
+    torch.manual_seed(0)
+    seg = get_model(50, c_prune_rate=2, feat1=375, num_feat=750)
+    seg, _ = utils.replace_model_weight(seg, 0.5)
+    seg = random_bn_stats(seg).to(args.device).eval()
+    seg_folded = fold_for_inference(seg, inplace=False)
+    xyz = torch.rand(args.batch_size, 3, N, device=args.device)
+    cls_label = F.one_hot(torch.randint(0, 16, (args.batch_size, 1), device=args.device), 16).float()
+    with torch.no_grad():
+        ref, t_ref = timed(lambda: seeded_seg(seg, xyz, cls_label), args.repeat, args.device)
+        out, t = timed(lambda: seeded_seg(seg_folded, xyz, cls_label), args.repeat, args.device)
+    assert torch.allclose(out, ref, atol=1e-5 * ref.abs().max().item()), 'folded segmentation model differs'
+    print('seg %d	%.4fs		%.4fs		%.2fx	%.2e' % (N, t_ref, t, t_ref / t, (out - ref).abs().max().item()))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    torch.manual_seed(0)
+    if args.bench == 'select':
+        bench_select(args)
+    elif args.bench == 'grid':
+        bench_grid(args)
+    elif args.bench == 'fused':
+        bench_fused(args)
+    elif args.bench == 'fps':
+        bench_fps(args)
+    elif args.bench == 'share':
+        bench_share(args)
+    elif args.bench == 'chunk':
+        bench_chunk(args)
+    elif args.bench == 'stream':
+        bench_stream(args)
+    elif args.bench == 'ensemble':
+        bench_ensemble(args)
+    elif args.bench == 'bitplane':
+        bench_bitplane(args)
+    elif args.bench == 'vmm':
+        bench_vmm(args)
+    elif args.bench == 'crossbar':
+        bench_crossbar(args)
+    elif args.bench == 'calib':
+        bench_calib(args)
+    elif args.bench == 'mc':
+        bench_mc(args)
+    elif args.bench == 'procedural':
+        bench_procedural(args)
+    elif args.bench == 'ckpt':
+        bench_ckpt(args)
+    elif args.bench == 'blocksparse':
+        bench_blocksparse(args)
+    elif args.bench == 'fold':
+        bench_fold(args)
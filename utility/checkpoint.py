@@ -0,0 +1,175 @@
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def quantize_conductance(pos, neg, fmt):
+    '''
+    Conductance pair on the grid of the compact format, float32.
+    fp16 rounds every cell to half precision; int8 puts the cells of both on the 256 levels
+    l * step. The step is a power of two, so the levels are exact in float32, zero stays
+    level 0, W = pos - neg is a multiple of the step and quantizing twice changes nothing.
+    Return:
+        pos, neg, and for int8 the step of the levels, else None
+    '''
+    pos, neg = pos.float(), neg.float()
+    if fmt == 'fp16':
+        return pos.half().float(), neg.half().float(), None
+    assert min(pos.min().item(), neg.min().item()) >= 0, 'int8 conductances must not be negative'
+    hi = max(pos.max().item(), neg.max().item(), 1e-12)
+    step = 2. ** math.ceil(math.log2(hi / 255))
+    pos, neg = [torch.round(g / step).clamp(max=255) * step for g in [pos, neg]]
+    return pos, neg, step
+
+
+def snap_conductances(cond_dict, fmt):
+    '''
+    Copy of cond_dict with every pair on the grid of the compact format, the pairs a compact
+    checkpoint stores; the model keeps training with the pairs as they are.
+    '''
+    snapped = {}
+    for name, (pos, neg) in cond_dict.items():
+        q_pos, q_neg, _ = quantize_conductance(pos, neg, fmt)
+        snapped[name] = (q_pos.to(pos), q_neg.to(neg))
+    return snapped
+
+
+def snapshot(obj):
+    '''copy of the tensors of a nested state on the CPU, safe to write while training goes on'''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def save_conductance(path, cond_dict, fmt):
+    '''
+    The frozen conductance pairs, put on the grid of fmt, as one raw file: a json header with
+    the name, shape and step of every pair, then their dense [2, ...] planes of pos and neg,
+    fp16 values or uint8 levels, which load_conductance expands with a single cast.
+    '''
+    pairs, planes = [], []
+    for name, pair in cond_dict.items():
+        pos, neg, step = quantize_conductance(*[g.cpu() for g in pair], fmt)
+        cells = torch.stack([pos, neg])
+        planes.append(cells.half() if fmt == 'fp16' else (cells / step).to(torch.uint8))
+        pairs.append({'name': name, 'shape': list(pos.shape), 'step': step})
+    header = json.dumps({'format': fmt, 'pairs': pairs}).encode()
+    with open(path, 'wb') as f:
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for cells in planes:
+            f.write(cells.numpy().tobytes())
+
+
+def load_conductance(path):
+    '''cond_dict of save_conductance, float32 on the CPU'''
+    with open(path, 'rb') as f:
+        header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+        dtype = '<f2' if header['format'] == 'fp16' else 'u1'
+        cells = torch.from_numpy(np.fromfile(f, dtype=dtype)).float()
+    cond_dict, start = {}, 0
+    for pair in header['pairs']:
+        numel = 2 * int(np.prod(pair['shape']))
+        pos, neg = cells[start:start + numel].view(2, *pair['shape'])
+        if pair['step'] is not None:
+            pos.mul_(pair['step'])
+            neg.mul_(pair['step'])
+        cond_dict[pair['name']] = (pos, neg)
+        start += numel
+    return cond_dict
+
+
+class CheckpointWriter(object):
+    '''
+    Best-model checkpoints written on a background thread, in the torch format of the train
+    scripts or in a compact format for the random-weight models.
+
+    The compact format splits the frozen conv weights off the state: their conductance
+    pairs go to conductance.bin next to the checkpoint, once per writer (see save_conductance),
+    and every save writes only the rest, the readout, BN and scaling parameters and the
+    optimizer. The pairs are stored on the grid of the format, see snap_conductances, so a
+    compact checkpoint loads the frozen weights rounded to it, not the ones trained with. A
+    save takes a CPU snapshot of the state before returning, so training can go on while it
+    is written; a new save waits for the previous one. The dense planes load with a cast and
+    the state without the frozen weights is smaller, so load_checkpoint is faster than
+    torch.load of the torch format, see bench_grouping --bench ckpt.
+
+    Usage:
+        writer = CheckpointWriter('int8')
+        writer.save(state, savepath, classifier)
+        writer.close()
+        checkpoint = load_checkpoint(savepath)
+    '''
+    def __init__(self, fmt='torch'):
+        assert fmt in ['torch', 'fp16', 'int8'], 'fmt must be torch or fp16 or int8!'
+        self.fmt = fmt
+        self.pool = ThreadPoolExecutor(1)
+        self.pending = None
+        self.conductance_written = set()
+
+    def save(self, state, path, model=None):
+        '''
+        state: the checkpoint dict of the train scripts, with model_state_dict and cond_dict
+        model: the model of model_state_dict, its frozen parameters are the ones stored once
+        '''
+        state = dict(state)
+        cond_dict = state.pop('cond_dict', None)
+        conductance = None
+        if self.fmt != 'torch' and cond_dict:
+            frozen = {name for name, p in model.named_parameters() if not p.requires_grad}
+            cond_dict = {name: pair for name, pair in cond_dict.items() if name in frozen}
+            state['model_state_dict'] = {k: v for k, v in state['model_state_dict'].items() if k not in cond_dict}
+            state['conductance'] = 'conductance.bin'
+            conductance = os.path.join(os.path.dirname(path), state['conductance'])
+            if conductance in self.conductance_written:
+                conductance, cond_dict = None, None
+            else:
+                self.conductance_written.add(conductance)
+                cond_dict = snapshot(cond_dict)
+        elif cond_dict is not None:
+            state['cond_dict'] = cond_dict
+        state = snapshot(state)
+
+        self.wait()
+        self.pending = self.pool.submit(self._write, state, path, conductance, cond_dict)
+        return self.pending
+
+    def _write(self, state, path, conductance, cond_dict):
+        if conductance is not None:
+            save_conductance(conductance, cond_dict, self.fmt)
+        # write then rename, a crash never leaves a truncated best model
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+
+def load_checkpoint(path, map_location=None):
+    '''
+    A checkpoint of the train scripts in either format, as the torch format dict: the frozen
+    weights of a compact checkpoint are put back into model_state_dict and cond_dict.
+    '''
+    state = torch.load(path, map_location=map_location)
+    if 'conductance' in state:
+        cond_dict = load_conductance(os.path.join(os.path.dirname(path), state.pop('conductance')))
+        model_state = dict(state['model_state_dict'])
+        for name, (pos, neg) in cond_dict.items():
+            model_state[name] = pos - neg
+        state['model_state_dict'] = model_state
+        state['cond_dict'] = cond_dict
+    return state
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def extractor_fingerprint(model, **config):
+    '''
+    sha1 of what the stored features depend on: the state of every SA/FP layer of the model
+    (conv weights, scaling, BN statistics, static input ranges), their grouping, noise and
+    hardware settings, the ensemble reduction, and config, e.g. the data and augmentation
+    arguments. The layers are found by their mlp_convs.
+    '''
+    digest = hashlib.sha1()
+    for name, module in model.named_modules():
+        if not hasattr(module, 'mlp_convs'):
+            continue
+        act = getattr(module, 'act', None)
+        settings = {k: getattr(module, k, None) for k in ['npoint', 'radius', 'nsample', 'group_all', 'ensemble',
+                                                          'distance_type', 'grouping']}
+        settings['act'] = None if act is None else getattr(act, '__name__', type(act).__name__)
+        settings['convs'] = []
+        for conv in module.mlp_convs:
+            hard, procedural = getattr(conv, 'hard_weight', None), getattr(conv, 'procedural', None)
+            settings['convs'].append({
+                **{k: getattr(conv, k, None) for k in ['noise', 'noise_mode', 'mode', 'quant_bit', 'hardware']},
+                'hard_weight': None if hard is None else [type(hard).__name__] + [
+                    getattr(hard, k, None) for k in ['noise', 'read_noise', 'adc_bits', 'rows', 'cols']],
+                'procedural': None if procedural is None else [procedural.seed, procedural.sparsity, procedural.rows]})
+        digest.update(json.dumps([name, settings], sort_keys=True).encode())
+        for key, value in sorted(module.state_dict().items()):
+            digest.update(key.encode())
+            digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+    config = dict(config, ensemble_reduce=getattr(model, 'ensemble_reduce', None))
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class FeatureStore(object):
+    '''
+    Sharded on-disk store of frozen pre-readout features.
+
+    With the random SA/FP stack frozen, the readout only ever sees the same features, so
+    they are extracted once and every readout epoch becomes a pass over a matrix. Each
+    sample keeps `views` independently augmented copies. Row sample * views + view of the
+    feature matrix lives in one of the memmapped shards features_%03d.npy; labels are
+    stored per row as well, since the datasets resample their points on every access.
+    index.json records the layout and written.npy which rows are filled, so an
+    interrupted extraction resumes and a finished one is reused. index.json also holds
+    the fingerprint of the extractor (see extractor_fingerprint); a store of another
+    extractor, e.g. other weights, radii or noise, is rebuilt.
+
+    Usage:
+        store = FeatureStore('log/.../feature_store/train', len(dataset), (1024,), views=4,
+                             labels={'target': ((), 'int64')}, extractor=extractor_fingerprint(classifier))
+        fill(store, loader, extract)
+        for feature, labels in store.batches(128, shuffle=True):
+            ...
+    '''
+    def __init__(self, root, num_samples, feature_shape, views=1, dtype='float16', labels=None, shard_bytes=2 ** 30,
+                 extractor=None):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        labels = {name: [list(shape), label_dtype] for name, (shape, label_dtype) in (labels or {}).items()}
+        row_bytes = int(np.prod(feature_shape)) * np.dtype(dtype).itemsize
+        meta = {'num_samples': num_samples, 'views': views, 'feature_shape': list(feature_shape),
+                'dtype': dtype, 'labels': labels, 'shard_rows': max(1, shard_bytes // row_bytes),
+                'extractor': extractor}
+
+        index_path = os.path.join(root, 'index.json')
+        mode = 'w+'
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                if json.load(f) == meta:
+                    mode = 'r+'
+        self.meta = meta
+        self.num_samples, self.views = num_samples, views
+        self.shard_rows = meta['shard_rows']
+        num_rows = num_samples * views
+
+        self.shards = []
+        for i, start in enumerate(range(0, num_rows, self.shard_rows)):
+            shape = (min(self.shard_rows, num_rows - start), *feature_shape)
+            self.shards.append(self._open('features_%03d.npy' % i, mode, dtype, shape))
+        self.labels = {name: self._open('%s.npy' % name, mode, label_dtype, (num_rows, *shape))
+                       for name, (shape, label_dtype) in labels.items()}
+        self.written = self._open('written.npy', mode, np.bool_, (num_samples, views))
+        if mode == 'w+':
+            self.written[:] = False
+            with open(index_path, 'w') as f:
+                json.dump(meta, f)
+
+    def _open(self, name, mode, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(self.root, name), mode=mode, dtype=dtype, shape=shape)
+
+    def complete(self, view=None):
+        return bool(self.written.all() if view is None else self.written[:, view].all())
+
+    def write(self, indices, view, feature, **labels):
+        '''
+        Input:
+            indices: sample indices of the batch, [B]
+            feature: pre-readout features, [B, *feature_shape]
+            labels: label arrays by name, [B, *shape]
+        '''
+        indices = np.asarray(indices)
+        rows = indices * self.views + view
+        feature = feature.detach().cpu().numpy()
+        for shard, offset, pos in self._locate(rows):
+            self.shards[shard][offset] = feature[pos]
+        for name, value in labels.items():
+            self.labels[name][rows] = torch.as_tensor(value).cpu().numpy()
+        self.written[indices, view] = True
+
+    def _locate(self, rows):
+        '''group rows by shard: (shard, offsets in the shard, positions in rows)'''
+        shard = rows // self.shard_rows
+        for s in np.unique(shard):
+            pos = np.nonzero(shard == s)[0]
+            yield s, rows[pos] - s * self.shard_rows, pos
+
+    def read(self, rows):
+        '''
+        Return:
+            feature: float32 tensor, [len(rows), *feature_shape]
+            labels: dict of int64 tensors, [len(rows), *shape]
+        '''
+        rows = np.sort(rows)    # sequential reads, the batch order does not matter
+        feature = np.empty((len(rows), *self.meta['feature_shape']), dtype=np.float32)
+        for shard, offset, pos in self._locate(rows):
+            feature[pos] = self.shards[shard][offset]
+        labels = {name: torch.from_numpy(value[rows].astype(np.int64)) for name, value in self.labels.items()}
+        return torch.from_numpy(feature), labels
+
+    def batches(self, batch_size, shuffle=True, drop_last=False, indices=None):
+        '''one pass over the samples, or only over the sample indices given, each with a randomly chosen view'''
+        samples = torch.arange(self.num_samples) if indices is None else torch.as_tensor(indices)
+        order = samples[torch.randperm(len(samples))] if shuffle else samples
+        views = torch.randint(0, self.views, (self.num_samples,)) if shuffle else torch.zeros(self.num_samples, dtype=torch.long)
+        rows = (order * self.views + views[order]).numpy()
+        stop = len(rows) - len(rows) % batch_size if drop_last else len(rows)
+        for start in range(0, stop, batch_size):
+            yield self.read(rows[start:start + batch_size])
+
+    def __len__(self):
+        return self.num_samples
+
+    def flush(self):
+        for m in self.shards + list(self.labels.values()) + [self.written]:
+            m.flush()
+
+
+def fill(store, loader, extract):
+    '''
+    Extract the missing views of every sample into the store.
+    loader must not shuffle or drop samples; extract maps one of its batches to
+    (feature, labels dict) and applies the augmentation of a view.
+    '''
+    for view in range(store.views):
+        if store.complete(view):
+            continue
+        start = 0
+        for batch in tqdm(loader, total=len(loader), desc='feature view %d' % view):
+            feature, labels = extract(batch)
+            store.write(np.arange(start, start + feature.shape[0]), view, feature, **labels)
+            start += feature.shape[0]
+        store.flush()
+    return store
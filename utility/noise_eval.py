@@ -0,0 +1,189 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models.model_utils import shared_copy
+from utility.readout import accuracy
+
+
+def expand_realisations(model, realisations):
+    '''
+    Copy of the model whose SA/FP stack runs R weight realisations side by side, as an ensemble
+    of R times its members (see --ensemble): every conv becomes a grouped conv over R copies of
+    its weight blocks and its bn is tiled R times. The layers are found by their mlp_convs.
+    Input:
+        model: a model_cls_rand or model_part_seg model, its SA/FP convs not in vmm mode
+    Return:
+        the expanded copy in eval mode, and the names of its expanded conv weights
+    '''
+    # share the neighbourhood caches and crossbar backends instead of copying them
+    model = shared_copy(model).eval()
+
+    names = []
+    for prefix, module in model.named_modules():
+        if not hasattr(module, 'mlp_convs') or not hasattr(module, 'ensemble'):
+            continue
+        for i, conv in enumerate(module.mlp_convs):
+            assert conv.mode != 'vmm' or not conv.hardware, 'vmm mode does not support grouped convs'
+            assert getattr(conv, 'procedural', None) is None, 'procedural weights have no conductances to program'
+            expand_conv(conv, realisations)
+            module.mlp_bns[i] = expand_bn(module.mlp_bns[i], realisations)
+            names.append('%s.mlp_convs.%d.conv.weight' % (prefix, i))
+        module.ensemble *= realisations
+    return model, names
+
+
+@torch.no_grad()
+def expand_conv(layer, realisations):
+    '''NoiseConv/NoiseConv1d with groups G -> R * G, its weight, bias and static input ranges tiled R times'''
+    conv = layer.conv
+    new = type(conv)(conv.in_channels * realisations, conv.out_channels * realisations, conv.kernel_size,
+                     groups=conv.groups * realisations, bias=conv.bias is not None).to(conv.weight)
+    new.weight.copy_(conv.weight.repeat(realisations, *[1] * (conv.weight.dim() - 1)))
+    new.weight.requires_grad = False
+    if conv.bias is not None:
+        new.bias.copy_(conv.bias.repeat(realisations))
+        new.bias.requires_grad = False
+    layer.conv = new
+    layer.in_channels, layer.out_channels = new.in_channels, new.out_channels
+    for name in ['quant_step', 'quant_zero']:
+        buf = getattr(layer, name, None)
+        if buf is not None and buf.shape[1] > 1:
+            setattr(layer, name, buf.repeat(1, realisations, *[1] * (buf.dim() - 2)))
+    return layer
+
+
+@torch.no_grad()
+def expand_bn(bn, realisations):
+    new = type(bn)(bn.num_features * realisations, eps=bn.eps, momentum=bn.momentum, affine=bn.affine,
+                   track_running_stats=bn.track_running_stats).to(next(iter(bn.state_dict().values())).device)
+    new.load_state_dict({k: v.repeat(realisations) if v.dim() else v for k, v in bn.state_dict().items()})
+    return new.eval()
+
+
+class MonteCarloEvaluator(object):
+    '''
+    Test accuracy under programming noise for R realisations of the conductances at once.
+
+    replace_model_weight_with_cond programs one realisation, pos + pos * noise * eps and
+    neg + neg * noise * eps, of every SA/FP conv, and the test set is run again for each.
+    Here R realisations are drawn in one go and loaded into a copy of the model whose convs
+    run them as R groups (see expand_realisations). One loader pass, and one FPS, ball query
+    and 3-NN per batch, serve all R; only the convs grow R times. The readout is noise free
+    and applied to the features of every realisation. The conductance pairs are moved to the
+    device once, entries for other convs (the seg readout conv2) are ignored.
+
+    Usage:
+        mc = MonteCarloEvaluator(classifier, cond_dict, noise=0.05, realisations=32)
+        instance_acc, class_acc = mc.classification(testDataLoader, num_class)    # [R] each
+    '''
+    def __init__(self, model, cond_dict, noise, realisations, nbr_cache=None):
+        self.noise = noise
+        self.realisations = realisations
+        # readout input of the unexpanded model: concatenated or averaged members
+        self.members = getattr(model, 'ensemble', 1)
+        self.reduce = getattr(model, 'ensemble_reduce', 'concat')
+        self.model, names = expand_realisations(model, realisations)
+        self.model.ensemble_reduce = 'concat'
+        self.nbr_cache = nbr_cache
+        if nbr_cache is not None:
+            nbr_cache.attach(self.model)
+
+        params = dict(self.model.named_parameters())
+        self.device = next(iter(params.values())).device
+        self.cond = {name: (cond_dict[name][0].to(params[name]), cond_dict[name][1].to(params[name]))
+                     for name in names if name in cond_dict}
+
+    @torch.no_grad()
+    def draw(self):
+        '''program a fresh set of R realisations into the expanded convs'''
+        params = dict(self.model.named_parameters())
+        for name, (pos, neg) in self.cond.items():
+            eps = torch.randn(2, self.realisations, *pos.shape, dtype=pos.dtype, device=pos.device)
+            weight = pos + eps[0] * self.noise * pos - (neg + eps[1] * self.noise * neg)   # [R, out, in, ...]
+            params[name].copy_(weight.reshape(params[name].shape))
+
+    def per_realisation(self, feature):
+        '''[B, R*E*D, ...] features of the expanded stack -> [B*R, E*D or D, ...] readout inputs'''
+        B = feature.shape[0]
+        feature = feature.reshape(B * self.realisations, self.members, -1, *feature.shape[2:])
+        return feature.mean(1) if self.reduce == 'mean' else feature.flatten(1, 2)
+
+    def batches(self, loader):
+        for points, *labels in loader:
+            if self.nbr_cache is not None:
+                self.nbr_cache.set_batch(labels[-1])
+            yield points.float().to(self.device).transpose(2, 1), labels
+
+    @torch.no_grad()
+    def classification(self, loader, num_class):
+        '''
+        Input:
+            loader: yields (points, target), or (points, target, index) with a neighbourhood cache
+        Return:
+            instance and class accuracy of every realisation, [R] each
+        '''
+        self.draw()
+        pred_choice, targets = [], []
+        for points, (target, *_) in self.batches(loader):
+            feature = self.per_realisation(self.model.sa_features(points))
+            pred = self.model.head(feature.view(feature.shape[0], -1))
+            pred_choice.append(pred.view(points.shape[0], self.realisations, -1).max(2)[1].cpu())
+            targets.append(target.cpu())
+        pred_choice, target = torch.cat(pred_choice), torch.cat(targets)
+        acc = np.array([accuracy(pred, target, num_class) for pred in pred_choice.t()])
+        return acc[:, 0], acc[:, 1]
+
+    @torch.no_grad()
+    def segmentation(self, loader, seg_classes, num_classes=16, num_part=50):
+        '''
+        Part segmentation metrics as in the test loop of train_segmentation.py.
+        Input:
+            loader: yields (points, label, target), or (points, label, target, index) with a neighbourhood cache
+            seg_classes: part labels of every shape category
+        Return:
+            dict of accuracy, class_avg_accuracy, class_avg_iou and inctance_avg_iou, [R] each
+        '''
+        self.draw()
+        R = self.realisations
+        parts = {cat: torch.tensor(labels, device=self.device) for cat, labels in seg_classes.items()}
+        seg_label_to_cat = {label: cat for cat, labels in seg_classes.items() for label in labels}
+        total_correct, total_seen = torch.zeros(R, dtype=torch.float64), 0
+        seen_class = torch.zeros(num_part, dtype=torch.float64)
+        correct_class = torch.zeros(R, num_part, dtype=torch.float64)
+        shape_ious = {cat: [] for cat in seg_classes}
+
+        for points, (label, target, *_) in self.batches(loader):
+            B, _, N = points.shape
+            one_hot = F.one_hot(label.long().view(B), num_classes).float().to(self.device)
+            feature, _ = self.model.extract_features(points, one_hot)
+            logits = self.model.head(self.per_realisation(feature)).view(B, R, N, -1)
+            target = target.long().to(self.device)
+
+            pred = torch.empty(B, R, N, dtype=torch.long, device=self.device)
+            for i in range(B):
+                cat = seg_label_to_cat[target[i, 0].item()]
+                cat_parts = parts[cat]
+                pred[i] = logits[i][..., cat_parts].max(-1)[1] + cat_parts[0]
+                pred_part = pred[i].unsqueeze(-1) == cat_parts      # [R, N, P]
+                true_part = target[i].unsqueeze(-1) == cat_parts    # [N, P]
+                inter = (pred_part & true_part).sum(1).double()
+                union = (pred_part | true_part).sum(1).double()
+                # a part neither present nor predicted counts as a perfect match
+                iou = torch.where(union == 0, torch.ones_like(union), inter / union.clamp(min=1))
+                shape_ious[cat].append(iou.mean(1).cpu())
+
+            correct = (pred == target.unsqueeze(1)).transpose(0, 1).reshape(R, -1)   # [R, B*N]
+            total_correct += correct.sum(1).double().cpu()
+            total_seen += B * N
+            seen_class += torch.bincount(target.flatten(), minlength=num_part).double().cpu()
+            correct_class += torch.zeros(R, num_part, dtype=torch.float64, device=self.device).index_add_(
+                1, target.flatten(), correct.double()).cpu()
+
+        shape_ious = {cat: torch.stack(ious) for cat, ious in shape_ious.items() if len(ious)}    # [n_cat, R]
+        return {
+            'accuracy': (total_correct / total_seen).numpy(),
+            'class_avg_accuracy': (correct_class / seen_class).mean(1).numpy(),
+            'class_avg_iou': torch.stack([ious.mean(0) for ious in shape_ious.values()]).mean(0).numpy(),
+            'inctance_avg_iou': torch.cat(list(shape_ious.values())).mean(0).numpy(),
+        }
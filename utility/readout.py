@@ -0,0 +1,258 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class RidgeReadout(object):
+    '''
+    Closed-form ridge regression for the linear readout of the random-feature models.
+
+    Only the readout is trained, so its least squares fit needs nothing but H^T H and
+    H^T Y of the frozen features H and one-hot targets Y. Both are accumulated in
+    float64 over one pass of the loader, and every regularisation strength lam is then
+    a single Cholesky solve of (H^T H + lam I) W = H^T Y. The bias is not regularised.
+
+    Usage:
+        ridge = RidgeReadout(classifier.fc[-1].linear.in_features, num_class)
+        for feature, target in extract_features(classifier, loader):
+            ridge.update(feature, target)
+        ridge.load(classifier.fc[-1].linear, lam=1.)
+    '''
+    def __init__(self, in_features, num_class, bias=True, device=None):
+        self.in_features = in_features
+        self.num_class = num_class
+        self.bias = bias
+        dim = in_features + int(bias)
+        self.HtH = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+        self.HtY = torch.zeros(dim, num_class, dtype=torch.float64, device=device)
+        self.count = 0
+
+    def _design(self, feature):
+        H = feature.detach().to(self.HtH.device, torch.float64)
+        if self.bias:
+            H = torch.cat([H, torch.ones(H.shape[0], 1, dtype=H.dtype, device=H.device)], 1)
+        return H
+
+    def update(self, feature, target):
+        '''
+        Input:
+            feature: readout input, [B, in_features]
+            target: class index, [B]
+        '''
+        H = self._design(feature)
+        Y = torch.nn.functional.one_hot(target.long().to(H.device), self.num_class).to(H.dtype)
+        self.HtH += H.t() @ H
+        self.HtY += H.t() @ Y
+        self.count += H.shape[0]
+
+    def solve(self, lam):
+        '''
+        Return:
+            weight: [num_class, in_features], bias: [num_class] (None without bias)
+        '''
+        reg = torch.full((self.HtH.shape[0],), float(lam), dtype=self.HtH.dtype, device=self.HtH.device)
+        if self.bias:
+            reg[-1] = 0
+        L = torch.linalg.cholesky(self.HtH + torch.diag(reg))
+        W = torch.cholesky_solve(self.HtY, L)    # [in_features (+1), num_class]
+        weight = W[:self.in_features].t()
+        bias = W[self.in_features] if self.bias else None
+        return weight, bias
+
+    @torch.no_grad()
+    def load(self, linear, lam):
+        '''write the solution for lam into an nn.Linear'''
+        weight, bias = self.solve(lam)
+        linear.weight.copy_(weight.to(linear.weight))
+        if bias is not None and linear.bias is not None:
+            linear.bias.copy_(bias.to(linear.bias))
+        return linear
+
+
+class RLSReadout(object):
+    '''
+    Online sequential (recursive least squares) fit of the linear readout, as in OS-ELM.
+
+    Keeps the inverse covariance P = (forget-weighted H^T H + lam I')^-1 and the weights W,
+    and folds in every mini-batch of k samples with a rank-k update, so the cost per batch
+    is constant no matter how many samples have been seen. As in RidgeReadout the bias is
+    not regularised, I' is the identity without the bias entry, so the first batch is
+    solved in closed form (the initial phase of OS-ELM) instead of starting from P = I / lam.
+    With forget < 1 older samples are down-weighted by forget per batch, which lets a
+    deployed readout follow drift.
+    The state is a dict of tensors that can be stored with the checkpoint.
+
+    Usage:
+        rls = RLSReadout(classifier.fc[-1].linear.in_features, num_class, forget=0.999)
+        for feature, target in extract_features(classifier, loader):
+            rls.update(feature, target)
+        rls.load(classifier.fc[-1].linear)
+        state['rls_state_dict'] = rls.state_dict()
+    '''
+    def __init__(self, in_features, num_class, lam=1., forget=1., bias=True, device=None):
+        assert 0 < forget <= 1, 'forgetting factor must be in (0, 1]'
+        self.in_features = in_features
+        self.num_class = num_class
+        self.lam = lam
+        self.forget = forget
+        self.bias = bias
+        dim = in_features + int(bias)
+        self.P = torch.eye(dim, dtype=torch.float64, device=device) / lam
+        self.W = torch.zeros(dim, num_class, dtype=torch.float64, device=device)
+        self.count = 0
+
+    @classmethod
+    def from_ridge(cls, ridge, lam, forget=1.):
+        '''start from a batch solution, the initial phase of OS-ELM'''
+        rls = cls(ridge.in_features, ridge.num_class, lam=lam, forget=forget, bias=ridge.bias, device=ridge.HtH.device)
+        rls.solve(ridge.HtH, ridge.HtY)
+        rls.count = ridge.count
+        return rls
+
+    def solve(self, HtH, HtY):
+        '''P and W of the ridge solution for HtH and HtY, the bias not regularised'''
+        reg = torch.full((HtH.shape[0],), float(self.lam), dtype=HtH.dtype, device=HtH.device)
+        if self.bias:
+            reg[-1] = 0
+        self.P = torch.cholesky_inverse(torch.linalg.cholesky(HtH + torch.diag(reg)))
+        self.W = self.P @ HtY
+
+    def update(self, feature, target):
+        '''
+        Input:
+            feature: readout input, [k, in_features]
+            target: class index, [k]
+        '''
+        H = feature.detach().to(self.P.device, torch.float64)
+        if self.bias:
+            H = torch.cat([H, torch.ones(H.shape[0], 1, dtype=H.dtype, device=H.device)], 1)
+        Y = torch.nn.functional.one_hot(target.long().to(H.device), self.num_class).to(H.dtype)
+        if self.count == 0:
+            self.solve(H.t() @ H, H.t() @ Y)
+            self.count += H.shape[0]
+            return
+
+        P = self.P / self.forget
+        PHt = P @ H.t()    # [dim, k]
+        S = torch.eye(H.shape[0], dtype=H.dtype, device=H.device) + H @ PHt
+        gain = torch.linalg.solve(S, PHt.t()).t()    # P H^T S^-1, S is symmetric
+        self.W = self.W + gain @ (Y - H @ self.W)
+        P = P - gain @ PHt.t()
+        self.P = (P + P.t()) / 2    # keep P symmetric against rounding drift
+        self.count += H.shape[0]
+
+    @torch.no_grad()
+    def load(self, linear):
+        '''write the current solution into an nn.Linear'''
+        linear.weight.copy_(self.W[:self.in_features].t().to(linear.weight))
+        if self.bias and linear.bias is not None:
+            linear.bias.copy_(self.W[self.in_features].to(linear.bias))
+        return linear
+
+    def state_dict(self):
+        return {'P': self.P.cpu(), 'W': self.W.cpu(), 'count': self.count,
+                'lam': self.lam, 'forget': self.forget, 'bias': self.bias}
+
+    def load_state_dict(self, state):
+        # P holds the samples down-weighted by the stored forget, resuming with another one would mix both
+        assert state['forget'] == self.forget, 'rls state was saved with forget %g, not %g' % (state['forget'], self.forget)
+        assert state['bias'] == self.bias, 'rls state was saved with bias=%s' % state['bias']
+        self.P = state['P'].to(self.P.device)
+        self.W = state['W'].to(self.W.device)
+        self.count = state['count']
+        self.lam = state.get('lam', self.lam)
+        return self
+
+
+class MultiHeadReadout(nn.Module):
+    '''
+    K independent copies of the readout layer, trained side by side on the same features.
+
+    A sweep over learning rate and weight decay only changes the readout, so instead of
+    re-running the frozen extractor for every configuration, one run feeds each batch of
+    features to one head per (lr, decay) pair. Every head is its own parameter group of a
+    single optimizer and the loss is the sum of the per-head losses, so each head sees
+    exactly the gradients and updates of a separate run with its hyper-parameters.
+    All heads start from the same copy of the readout.
+
+    Usage:
+        heads = MultiHeadReadout(classifier.fc[-1], lrs=[1e-3, 1e-2], decays=[0, 1e-4])
+        optimizer = heads.optimizer('Adam')
+        pred = heads(classifier.hidden(feature))    # [K, B, num_class]
+        heads.loss(pred, target).backward()
+        heads.load(classifier.fc[-1], k)
+    '''
+    def __init__(self, readout, lrs, decays):
+        super(MultiHeadReadout, self).__init__()
+        self.config = [(float(lr), float(decay)) for lr in lrs for decay in decays]
+        self.heads = nn.ModuleList([copy.deepcopy(readout) for _ in self.config])
+
+    def __len__(self):
+        return len(self.heads)
+
+    def forward(self, x):
+        '''
+        Input:
+            x: readout input, [B, D]
+        Return:
+            log class probabilities of every head, [K, B, num_class]
+        '''
+        return torch.stack([F.log_softmax(head(x), -1) for head in self.heads])
+
+    def loss(self, pred, target):
+        '''sum over the heads of their mean nll loss'''
+        K, B, _ = pred.shape
+        return F.nll_loss(pred.flatten(0, 1), target.long().repeat(K), reduction='sum') / B
+
+    def optimizer(self, name='Adam', momentum=0.9):
+        groups = [{'params': head.parameters(), 'lr': lr, 'weight_decay': decay}
+                  for head, (lr, decay) in zip(self.heads, self.config)]
+        if name == 'Adam':
+            return torch.optim.Adam(groups, betas=(0.9, 0.999), eps=1e-08)
+        return torch.optim.SGD(groups, momentum=momentum)
+
+    @torch.no_grad()
+    def load(self, readout, k):
+        '''copy head k into the readout layer of the model'''
+        readout.load_state_dict(self.heads[k].state_dict())
+        return readout
+
+
+def held_out_split(num_samples, fraction, seed=0):
+    '''
+    Mask of the samples held out for validation, [num_samples]: the first fraction of a seeded
+    permutation of the dataset indices, so every run holds out the same samples.
+    '''
+    held_out = torch.zeros(num_samples, dtype=torch.bool)
+    order = torch.randperm(num_samples, generator=torch.Generator().manual_seed(seed))
+    held_out[order[:int(round(fraction * num_samples))]] = True
+    return held_out
+
+
+def extract_features(model, loader, cuda=True, nbr_cache=None):
+    '''
+    Yield the readout input of every batch, see get_model.extract_features.
+    The loader yields (points, target) or (points, target, index) with a neighbourhood cache.
+    '''
+    model = model.eval()
+    if nbr_cache is not None:
+        nbr_cache.attach(model)
+    for points, target, *index in loader:
+        if nbr_cache is not None:
+            nbr_cache.set_batch(index[0])
+        if cuda:
+            points, target = points.cuda(), target.cuda()
+        with torch.no_grad():
+            feature, _ = model.extract_features(points.transpose(2, 1))
+        yield feature, target
+
+
+def accuracy(pred_choice, target, num_class):
+    '''instance accuracy and mean per-class accuracy of the predicted class indices'''
+    pred_choice, target = pred_choice.cpu().numpy(), target.cpu().numpy()
+    correct = pred_choice == target
+    class_acc = [correct[target == cat].mean() for cat in range(num_class) if np.any(target == cat)]
+    return correct.mean(), np.mean(class_acc)
@@ -1,29 +1,61 @@
+import math
+
 import numpy as np
 import torch
 
 
-def cond2weight(weight, sparsity=0.):
+def block_mask(shape, block, sparsity):
+    '''
+    0/1 mask of a [out, in, ...] weight in (rows, cols) blocks of its [out, in] matrix.
+    Every row of blocks keeps the same number of blocks, chosen at random, as a crossbar that
+    leaves whole tiles unprogrammed would, so the weight runs as a balanced block-sparse matmul,
+    see NoiseModule.block_sparse_forward. The blocks at the right and bottom edges are cropped.
+    '''
+    out, fan_in = shape[0], int(np.prod(shape[1:]))
+    rows, cols = block
+    row_blocks, col_blocks = math.ceil(out / rows), math.ceil(fan_in / cols)
+    keep = col_blocks - int(round(col_blocks * sparsity))
+    mask = torch.zeros(row_blocks, col_blocks)
+    mask.scatter_(1, torch.rand(row_blocks, col_blocks).argsort(1)[:, :keep], 1)
+    mask = mask.repeat_interleave(rows, 0).repeat_interleave(cols, 1)[:out, :fan_in]
+    return mask.reshape(shape)
+
+
+def cond2weight(weight, sparsity=0., block=None, shared=None):
+    '''
+    Conductance pair (pos, neg) of a random weight W = pos - neg, with a fraction sparsity of
+    the cells of each zeroed, in random cells or in (rows, cols) blocks, see block_mask.
+    shared zeroes a pos/neg pair together, so W has the zeros, else pos and neg are masked
+    independently and W keeps a single cell where only one of them is zero. None shares the
+    block masks and not the cell masks.
+    '''
     cond_mean = 34.05538
     cond_std = 5.32269
     pos = torch.randn_like(weight) * cond_std + cond_mean
     neg = torch.randn_like(weight) * cond_std + cond_mean
-    if sparsity != 0:
+    shared = block is not None if shared is None else shared
+    if sparsity != 0 and block is not None:
+        # structured: the zero blocks of W, or of pos and neg each
+        mask = block_mask(weight.shape, block, sparsity).to(weight)
+        neg_mask = mask if shared else block_mask(weight.shape, block, sparsity).to(weight)
+        pos, neg = pos * mask, neg * neg_mask
+    elif sparsity != 0:
         mask = torch.ones_like(pos).flatten()
         idx = int(mask.numel() * sparsity)
         mask[: idx] = 0
         pos_idx = torch.randperm(mask.numel())
-        neg_idx = torch.randperm(mask.numel())
+        neg_idx = pos_idx if shared else torch.randperm(mask.numel())
         pos = pos * mask[pos_idx].view(pos.shape)
         neg = neg * mask[neg_idx].view(neg.shape)
     return pos, neg
 
 
-def replace_model_weight(model: torch.nn.Module, sparsity=0.5):
+def replace_model_weight(model: torch.nn.Module, sparsity=0.5, block=None, shared=None):
     model_with_cond = {}
     for name, param in model.named_parameters():
         if 'conv' in name and 'weight' in name:
             # p = torch.nn.Parameter(cond2weight(param, sparsity))
-            pos, neg = cond2weight(param, sparsity)
+            pos, neg = cond2weight(param, sparsity, block, shared)
             param.data = pos - neg
             model_with_cond[name] = (pos, neg)
     return model, model_with_cond